@@ -1,17 +1,28 @@
 # app.py
-import os
+import asyncio, os
 from pathlib import Path
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import PlainTextResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 
-from linebot import LineBotApi, WebhookHandler
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage
 
+from idempotency import IDEMPOTENCY
+from line_client import LineClient
+from lazy_xlsx import LazyXlsx, quote_record
+from metrics import REQUESTS, log_event, render as render_metrics, timed
+from output_store import OutputStore
+from profiling import profiled
 from user_input_parsing import parse_user_text
-from make_quote_linux import make_quote
-from remove_watermark import remove_watermark
+from quote_jobs import QuoteJobQueue, QueueFull, QuoteJob, run_quote_job, run_xlsx_job
+from result_cache import RESULT_CACHE
+from soffice_batch import close_batcher
+from soffice_pool import close_pool, pool_status
+from soffice_scheduler import close_scheduler
+from template_registry import TemplateRegistry, UnknownTemplate
+from warmup import WARMUP, warm_worker
 
 # ---- 環境變數 ----
 load_dotenv()
@@ -19,44 +30,167 @@ CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 CHANNEL_TOKEN  = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 TEMPLATE_XLSX  = os.getenv("TEMPLATE_XLSX", "維修報價單範本.xlsx")
 SHEET_NAME     = os.getenv("SHEET_NAME")  # 例如：貝拉5；不填=第一張
-PDF_ENGINE     = os.getenv("PDF_ENGINE", "libreoffice")  # 或 aspose
+TEMPLATES_FILE = os.getenv("TEMPLATES_FILE", "templates.json")  # 多範本設定（見 template_registry.py）；不存在時只用上面兩個
+PDF_ENGINE     = os.getenv("PDF_ENGINE", "libreoffice")  # 或 aspose / native / overlay
+WANT_XLSX      = os.getenv("WANT_XLSX", "1") != "0"      # 0 = 只出 PDF（僅 native / overlay 引擎）
+LAZY_XLSX      = os.getenv("LAZY_XLSX", "0") == "1"      # 1 = xlsx 等第一次下載才產生（僅 native / overlay 引擎）
 SOFFICE_PATH   = os.getenv("SOFFICE_PATH")  # 例如 /usr/bin/soffice 或 Windows 的路徑
 PUBLIC_BASE_URL= os.getenv("PUBLIC_BASE_URL", "http://localhost:8000")  # 給 LINE 用的可公開網址
 OUTPUT_DIR     = os.getenv("OUTPUT_DIR", "public")
+JOB_MODE       = os.getenv("JOB_MODE", "process")       # process（Aspose 只在子程序）或 thread
+JOB_WORKERS    = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_MAX  = int(os.getenv("JOB_QUEUE_MAX", "20"))  # 排隊上限（不含執行中）
+JOB_MAX_TASKS  = int(os.getenv("JOB_MAX_TASKS", "200"))     # 每個 worker 處理幾件後換新；0 = 不換
+JOB_MAX_RSS_MB = float(os.getenv("JOB_MAX_RSS_MB", "1500"))  # worker 常駐記憶體超過就換新；0 = 不限
 
 if not CHANNEL_SECRET or not CHANNEL_TOKEN:
     raise RuntimeError("請設定 LINE_CHANNEL_SECRET / LINE_CHANNEL_ACCESS_TOKEN")
+# 微批次要把同時間的轉檔收進同一個程序才能合併；process 模式每個 worker 一次只跑一件，永遠湊不成批
+if JOB_MODE == "process" and float(os.getenv("SOFFICE_BATCH_WINDOW_MS", "0")) > 0:
+    raise RuntimeError("SOFFICE_BATCH_WINDOW_MS>0 只能搭配 JOB_MODE=thread（process 模式下各 worker 無法合併批次）")
 
 # ---- 準備目錄與 LINE SDK ----
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-line_bot_api = LineBotApi(CHANNEL_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+output_store = OutputStore(OUTPUT_DIR)      # 分片 + TTL / 容量上限，見 output_store.py
+RESULT_CACHE.exists = output_store.exists   # 按需 xlsx 還沒產生也算存在
+# PDF 需要先有 xlsx 的引擎（libreoffice / aspose）xlsx 本來就會產生，按需模式沒有意義
+LAZY_XLSX = LAZY_XLSX and WANT_XLSX and PDF_ENGINE.lower() in ("native", "overlay")
+templates = TemplateRegistry(TEMPLATES_FILE, TEMPLATE_XLSX, SHEET_NAME)  # 依訊息 / 客戶選範本，檔案更新自動重載
+line_client = LineClient(CHANNEL_TOKEN)     # aiohttp keep-alive 連線池，startup 時建立
+parser = WebhookParser(CHANNEL_SECRET)
+job_queue = QuoteJobQueue(workers=JOB_WORKERS, mode=JOB_MODE, max_pending=JOB_QUEUE_MAX,
+                          max_tasks=JOB_MAX_TASKS, max_rss_mb=JOB_MAX_RSS_MB)
+# 按需 xlsx 也在工作 worker 裡產生，web 程序不載入 Aspose
+lazy_xlsx = LazyXlsx(output_store, render=lambda **kw: job_queue.run(run_xlsx_job, **kw))
 
 # ---- FastAPI ----
 app = FastAPI(title="QuotationBot")
 
-# 靜態檔案（下載用）
-app.mount("/files", StaticFiles(directory=OUTPUT_DIR), name="files")
+# 背景處理中的事件（保留參照，避免 task 被 GC 回收）
+_event_tasks: set = set()
+
+@app.on_event("startup")
+async def _startup():
+    await line_client.start()
+    templates.load_all()  # 每個範本的版面索引先建好（純 XML，不載入 Aspose）
+    # 開了常駐池卻載不到 python-uno：每張報價單都會退回冷啟動 soffice，啟動時就大聲講
+    pool = pool_status()
+    if pool["size"] > 0 and not pool["uno"]:
+        log_event("soffice_pool_unavailable", level="error", size=pool["size"], to="subprocess",
+                  error=pool["error"])
+    # 重的模組（Aspose / PyMuPDF / soffice）在背景暖機，port 先綁好；暖完 /readyz 才回 200
+    warm_kwargs = dict(template_xlsx=TEMPLATE_XLSX, sheet=SHEET_NAME, pdf_engine=PDF_ENGINE,
+                       soffice_path=SOFFICE_PATH, want_xlsx=WANT_XLSX and not LAZY_XLSX)
+    WARMUP.start(job_queue, **warm_kwargs)
+    # worker pool 換新一代（記憶體超標）後，新 worker 也先暖機
+    job_queue.on_recycle = lambda: job_queue.warm(warm_worker, **warm_kwargs)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    job_queue.shutdown(wait=False)
+    close_pool()  # 收掉常駐 soffice worker，避免殭屍程序
+    close_batcher()
+    close_scheduler()  # 還在排隊的 soffice 轉檔直接放棄（改走 Aspose），不拖住關機
+    if _event_tasks:
+        await asyncio.wait(_event_tasks, timeout=5)
+    await line_client.close()
+    IDEMPOTENCY.close()
 
 @app.get("/healthz")
 async def health():
     return {"ok": True}
 
+# 給負載平衡器：暖機完成前回 503，不要把使用者導過來（/healthz 只表示程序活著）
+@app.get("/readyz")
+async def ready():
+    status = {**WARMUP.status(), "soffice_pool": pool_status()}
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/templates")
+async def list_templates():
+    return templates.describe()
+
+@app.get("/workers")
+async def workers():
+    return {**job_queue.stats(), "soffice_pool": pool_status()}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+# 下載：/files/<token>.pdf（ETag / Range / 304 見 output_store.py）
+@app.api_route("/files/{name}", methods=["GET", "HEAD"])
+async def files(name: str, request: Request):
+    if name.endswith(".xlsx") and lazy_xlsx.pending(name):
+        # 按需產生的 xlsx：第一次下載時才產（Aspose 很重，丟到 thread）
+        await asyncio.to_thread(lazy_xlsx.materialize, name)
+    try:
+        return output_store.response(request, name)
+    except HTTPException:
+        # 舊版直接放在 OUTPUT_DIR 底下、以客戶名稱命名的檔案，連結仍然有效
+        legacy = Path(OUTPUT_DIR) / name
+        if "/" not in name and "\\" not in name and legacy.is_file():
+            return FileResponse(legacy)
+        raise
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache")
+async def cache_stats():
+    return {"results": RESULT_CACHE.stats(), "webhook_events": IDEMPOTENCY.stats(),
+            "files": output_store.stats(), "lazy_xlsx": lazy_xlsx.stats()}
+
 @app.post("/callback")
 async def callback(request: Request):
     signature = request.headers.get("X-Line-Signature", "")
     body = (await request.body()).decode("utf-8")
+    # 驗簽（HMAC）與 JSON 解析丟到 thread，不占 event loop
     try:
-        handler.handle(body, signature)
+        events = await asyncio.to_thread(parser.parse, body, signature)
+    except InvalidSignatureError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+    # 先回 200 給 LINE，同一個 body 裡的多個事件在背景並行處理
+    for ev in events:
+        task = asyncio.create_task(_handle_event(ev))
+        _event_tasks.add(task)
+        task.add_done_callback(_event_done)
     return PlainTextResponse("OK")
 
+def _event_done(task: asyncio.Task):
+    _event_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log_event("event_failed", level="error", error=repr(task.exception()))
+
 # ---- LINE 事件處理 ----
-@handler.add(MessageEvent, message=TextMessage)
-def on_text(event: MessageEvent):
+async def _handle_event(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        # PROFILE_SAMPLE>0 時抽樣剖析（見 profiling.py）；同一請求在 worker 端的 make_quote 也會被抽中
+        with timed("on_text") as rec, profiled("on_text", _event_key(event)) as cap:
+            outcome = await on_text(event)
+            if cap is not None:
+                cap.note(outcome=outcome)
+        REQUESTS.inc(outcome=outcome)
+        log_event("on_text", request=_event_key(event), outcome=outcome, ms=round(rec["seconds"] * 1000, 1))
+
+async def on_text(event: MessageEvent) -> str:
+    """處理一則文字訊息，回傳處理結果（給 metrics 分類用）。"""
     text = event.message.text
-    sets, items = parse_user_text(text)
+    with timed("parse"):
+        sets, items = parse_user_text(text)
+
+    try:
+        tpl = templates.select(sets.pop("Template", None), client=sets.get("ClientName"))
+    except UnknownTemplate as e:
+        await line_client.reply(event.reply_token, str(e))
+        return "unknown_template"
 
     if not items:
         example = (
@@ -67,48 +201,114 @@ def on_text(event: MessageEvent):
             "----\n"
             "產品: 嬤嬤啦餐飲配送機器人\n說明: 快跑電池保護蓋組件\n數量: 2\n單價: 500\n優惠單價: 450"
         )
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="我需要至少一筆產品資訊喔～\n\n" + example)
-        )
-        return
+        await line_client.reply(event.reply_token, "我需要至少一筆產品資訊喔～\n\n" + example)
+        return "no_items"
 
-    # 檔名基底（放 public/ 下）
-    client = sets.get("ClientName", "客戶")
-    base = f"{client}_{event.timestamp}"  # 保證唯一
-    base_path = str(Path(OUTPUT_DIR) / base)
+    # LINE 重送的同一事件：掛回原本的工作或直接回結果，不再產一次
+    event_key = _event_key(event)
+    seen = IDEMPOTENCY.claim(event_key) if event_key else None
+    if seen is not None:
+        if seen["status"] == "done":
+            await line_client.reply(event.reply_token, _result_message(seen["result"]))
+            return "duplicate_done"
+        if seen["status"] == "pending" or job_queue.get(seen["job_id"]) is not None:
+            await line_client.reply(event.reply_token, f"⏳ 報價單仍在產生中…（編號 {seen['job_id'] or '-'}）")
+            return "duplicate_inflight"
+        # 紀錄是上一個程序留下的，工作已不存在：重新佔位再跑
+        IDEMPOTENCY.release(event_key)
+        IDEMPOTENCY.claim(event_key)
 
+    # 佔位到 set_job 之間任何例外（含取消）都要放掉佔位，否則重送會一直被當成「產生中」
+    owned = bool(event_key)
     try:
-        xlsx_out, pdf_out = make_quote(
-            xlsx_in=TEMPLATE_XLSX,
-            name=base_path,               # 讓輸出直接存到 public/ 下
-            sheet=SHEET_NAME,
-            sets=sets,
-            items=items,
-            pdf_engine=PDF_ENGINE,
-            soffice_path=SOFFICE_PATH,
-        )
-    except Exception as e:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"產生報價單失敗：{e}")
-        )
-        return
+        # 同樣內容 + 同範本/分頁/引擎已產過：直接回上次的連結
+        cache_key = RESULT_CACHE.key(tpl["path"], tpl["sheet"], PDF_ENGINE, sets, items, want_xlsx=WANT_XLSX)
+        cached = RESULT_CACHE.get(cache_key)
+        if cached is not None:
+            if event_key:
+                IDEMPOTENCY.complete(event_key, "done", cached)
+                owned = False
+            await line_client.reply(event.reply_token, _result_message(cached))
+            return "cache_hit"
+
+        # 檔名基底：先寫到暫存區，完成後由 output_store 搬進分片目錄、換成 token 網址
+        client = sets.get("ClientName", "客戶")
+        base = f"{client}_{event.timestamp}"  # 保證唯一
+        base_path = str(output_store.staging_dir / base)
+        target = _push_target(event)
+        # 按需模式：這次只畫 PDF，xlsx 先存紀錄
+        record = quote_record(tpl["path"], tpl["sheet"], sets, items, template_row=tpl["template_row"],
+                              first_insert_row=tpl["first_insert_row"]) if LAZY_XLSX else None
+
+        try:
+            job = job_queue.submit(
+                run_quote_job,
+                template_xlsx=tpl["path"],
+                base_path=base_path,
+                sheet=tpl["sheet"],
+                sets=sets,
+                items=items,
+                template_row=tpl["template_row"],
+                first_insert_row=tpl["first_insert_row"],
+                pdf_engine=PDF_ENGINE,
+                soffice_path=SOFFICE_PATH,
+                want_xlsx=WANT_XLSX and not LAZY_XLSX,
+                request_id=event_key,
+                on_done=lambda j: _deliver(j, target, cache_key, event_key, record, f"{base}.xlsx", tpl["path"]),
+            )
+        except QueueFull:
+            await line_client.reply(event.reply_token, "目前報價單排隊人數較多，請稍後再傳一次 🙏")
+            return "queue_full"
 
-    # 轉為可下載 URL
-    xlsx_url = f"{PUBLIC_BASE_URL}/files/{Path(xlsx_out).name}"
-    pdf_url  = f"{PUBLIC_BASE_URL}/files/{Path(pdf_out).name}"
+        if event_key:
+            IDEMPOTENCY.set_job(event_key, job.id)
+            owned = False
+    finally:
+        if owned:
+            IDEMPOTENCY.release(event_key)
 
-    p = Path(pdf_out)  # 例如 /app/public/凱凱超級公司_....pdf
-    output_to_user_pdf = str(p.with_name(p.stem + "_clean.pdf"))
+    # reply token 很快就失效，先回覆「已收到」，完成後再用 push_message 送連結
+    await line_client.reply(event.reply_token, f"⏳ 已收到，報價單產生中…（編號 {job.id}）")
+    return "queued"
 
-    output_to_user_pdf = remove_watermark(input_pdf = str(p), output_to_user_pdf = output_to_user_pdf)
-    pdf_url_to_user  = f"{PUBLIC_BASE_URL}/files/{Path(output_to_user_pdf).name}"
+def _event_key(event: MessageEvent) -> str | None:
+    # webhookEventId 是每個事件唯一且重送不變的 ID；舊版 SDK 沒有時退回訊息 ID
+    return getattr(event, "webhook_event_id", None) or getattr(event.message, "id", None)
 
-    msg = (
-        "✅ 報價單已完成！\n"
-        f"Excel：{xlsx_url}\n"
+def _push_target(event: MessageEvent) -> str:
+    src = event.source
+    return getattr(src, "group_id", None) or getattr(src, "room_id", None) or src.user_id
+
+def _result_message(result: dict) -> str:
+    # 轉為可下載 URL（只含 token，不露出客戶名稱）
+    pdf_url_to_user = f"{PUBLIC_BASE_URL}/files/{output_store.url_name(result['pdf'])}"
+    msg = "✅ 報價單已完成！\n"
+    if result.get("xlsx"):
+        msg += f"Excel：{PUBLIC_BASE_URL}/files/{output_store.url_name(result['xlsx'])}\n"
+    msg += (
         f"PDF：{pdf_url_to_user}\n"
         "(連結有效取決於你伺服器是否持續運作)"
     )
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+    return msg
+
+def _deliver(job: QuoteJob, target: str, cache_key: str | None = None, event_key: str | None = None,
+             xlsx_record: dict | None = None, xlsx_name: str | None = None, template_xlsx: str | None = None):
+    # 在工作佇列的執行緒裡被呼叫：push 交回 event loop 送出，不在這裡等
+    if job.status == "done":
+        try:
+            job.result = {k: output_store.put(job.result[k]) if job.result.get(k) else None for k in ("xlsx", "pdf")}
+            if xlsx_record is not None:
+                job.result["xlsx"] = lazy_xlsx.store_record(xlsx_name, xlsx_record)
+        except OSError as e:
+            job.status, job.error = "failed", f"存放產出檔失敗：{e}"
+    log_event("quote_job", job=job.id, request=event_key, status=job.status,
+              wait_ms=round(((job.started or job.finished) - job.created) * 1000, 1),
+              run_ms=round((job.finished - (job.started or job.finished)) * 1000, 1), error=job.error)
+    if event_key:
+        IDEMPOTENCY.complete(event_key, job.status, job.result if job.status == "done" else None, job.id)
+    if job.status != "done":
+        line_client.push_threadsafe(target, f"產生報價單失敗：{job.error}")
+        return
+    if cache_key:
+        RESULT_CACHE.put(cache_key, job.result, template_xlsx=template_xlsx)
+    line_client.push_threadsafe(target, _result_message(job.result))
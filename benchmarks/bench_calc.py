@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# benchmarks/bench_calc.py
+# 比較 calc_mode（python / chain / full）在不同明細筆數下的「填值 + 計算」耗時，
+# 並檢查 python 模式填入的 FinalPrice 快取值與整本重算結果一致。
+#
+# 用法：
+#   python benchmarks/bench_calc.py --in 維修報價單範本.xlsx --sizes 1 10 100 --repeat 3
+
+import argparse, os, sys, time
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from make_quote_linux import (
+    CALC_MODES, open_book, write_items_and_total, calculate_quote,
+)
+
+def make_items(n: int):
+    return [
+        {"Product": f"產品{i}", "Desc": f"說明{i}", "Count": i % 5 + 1,
+         "Price": 100.0 + i, "ProvidePrice": 90.0 + i}
+        for i in range(n)
+    ]
+
+def run_once(xlsx_in: str, sheet: str | None, items, calc_mode: str):
+    wb = open_book(xlsx_in)
+    sheet_name = sheet or wb.worksheets[0].name
+    t0 = time.perf_counter()
+    write_items_and_total(wb, sheet_name, items, recalc=False)
+    calculate_quote(wb, calc_mode, ["FinalPrice"])
+    elapsed = time.perf_counter() - t0
+    rng = wb.worksheets.get_range_by_name("FinalPrice")
+    value = rng.worksheet.cells.get(rng.first_row, rng.first_column).value
+    return elapsed, value
+
+def main():
+    ap = argparse.ArgumentParser(description="calc_mode 效能比較")
+    ap.add_argument("--in", dest="xlsx_in", default="維修報價單範本.xlsx")
+    ap.add_argument("--sheet", default=None)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    print(f"{'items':>6} " + " ".join(f"{m:>12}" for m in CALC_MODES) + "   FinalPrice")
+    for n in args.sizes:
+        items = make_items(n)
+        cols, values = [], {}
+        for mode in CALC_MODES:
+            runs = [run_once(args.xlsx_in, args.sheet, items, mode) for _ in range(args.repeat)]
+            cols.append(f"{median(r[0] for r in runs) * 1000:10.1f}ms")
+            values[mode] = runs[-1][1]
+        same = len({float(v) for v in values.values()}) == 1
+        print(f"{n:>6} " + " ".join(f"{c:>12}" for c in cols) + f"   {values['full']}{'' if same else '  (不一致!)'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# benchmarks/bench_parse.py
+# parse_user_text 吞吐量：數 MB 的貼文（價目表等級）下，新版單趟解析 vs 舊版（逐行 regex + 第二趟型別轉換）。
+# 另量從檔案逐行串流（iter_user_items）的吞吐與記憶體高峰，並先用隨機輸入確認新舊結果一致。
+#
+# 用法：
+#   python benchmarks/bench_parse.py --mb 1 4 16 --repeat 3 [--json out.json]
+
+import argparse, json, os, random, re, sys, tempfile, time, tracemalloc
+from pathlib import Path
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_input_parsing import HEADER_MAP, ITEM_MAP, iter_user_items, parse_user_text
+
+# ---------------- 舊版實作（比較基準，照抄改寫前的 parse_user_text） ----------------
+def parse_legacy(text: str):
+    lines = [re.sub(r"﻿", "", l).strip() for l in text.splitlines()]
+    blocks, buf = [], []
+    for ln in lines:
+        if not ln or re.fullmatch(r"-{3,}", ln):
+            if buf:
+                blocks.append(buf); buf = []
+            continue
+        buf.append(ln)
+    if buf: blocks.append(buf)
+    sets, items, current = {}, [], {}
+
+    def flush():
+        nonlocal current
+        if any(v for v in current.values()):
+            items.append(current)
+        current = {}
+
+    for blk in blocks:
+        for ln in blk:
+            m = re.split(r"[:：]", ln, maxsplit=1)
+            if len(m) != 2:
+                continue
+            k = m[0].strip().strip().lower()
+            v = m[1].strip()
+            key = HEADER_MAP.get(k)
+            if key:
+                sets[key] = v
+                continue
+            key = ITEM_MAP.get(k)
+            if key:
+                if key == "Product" and current.get("Product"):
+                    flush()
+                current[key] = v
+        flush()
+    for it in items:
+        if "Count" in it:
+            try: it["Count"] = int(float(str(it["Count"]).replace(",", "")))
+            except: pass
+        for pk in ("Price", "ProvidePrice"):
+            if pk in it:
+                try: it[pk] = float(str(it[pk]).replace(",", ""))
+                except: pass
+    return sets, items
+
+# ---------------- 測試資料 ----------------
+def make_text(target_bytes: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    out, size, i = ["客戶名稱：價目表客戶", "報價日期: 2025/10/17", ""], 0, 0
+    while size < target_bytes:
+        block = [f"產品：型號-{i:06d} 不鏽鋼零件", f"說明: 規格 {rnd.randint(1, 999)} mm，含安裝",
+                 f"數量：{rnd.randint(1, 50)}", f"單價: {rnd.randint(100, 99999):,}",
+                 f"優惠單價：{rnd.randint(100, 99999)}", "----" if i % 3 == 0 else ""]
+        out += block
+        size += sum(len(b.encode("utf-8")) + 1 for b in block)
+        i += 1
+    return "\n".join(out)
+
+def fuzz_text(rnd: random.Random) -> str:
+    keys = list(HEADER_MAP) + list(ITEM_MAP) + ["未知", "QTY", " 數量 "]
+    vals = ["", "3", "1,200", "x", "3.5", "  7 ", "nan", "inf", "產品A"]
+    lines = []
+    for _ in range(rnd.randint(0, 30)):
+        r = rnd.random()
+        if r < 0.15:
+            lines.append(rnd.choice(["", "   ", "---", "------", "--", "﻿"]))
+        elif r < 0.2:
+            lines.append("沒有冒號的一行")
+        else:
+            lines.append(f"{rnd.choice(keys)}{rnd.choice([':', '：', ' : '])}{rnd.choice(vals)}")
+    return "\n".join(lines)
+
+def check_equivalence(n: int = 5000):
+    rnd = random.Random(42)
+    for _ in range(n):
+        t = fuzz_text(rnd)
+        assert repr(parse_user_text(t)) == repr(parse_legacy(t)), f"新舊結果不同：{t!r}"  # repr：nan != nan
+
+# ---------------- 量測 ----------------
+def timeit(fn, repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t0)
+    return median(runs)
+
+def peak_mb(fn) -> float:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def main():
+    ap = argparse.ArgumentParser(description="parse_user_text 吞吐量")
+    ap.add_argument("--mb", type=float, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--json", dest="json_out", default=None)
+    args = ap.parse_args()
+
+    check_equivalence()
+    print("[CHECK] 新舊解析結果一致（隨機輸入 5000 組）")
+
+    results = []
+    print(f"{'MB':>6} {'items':>8} {'legacy MB/s':>12} {'new MB/s':>10} {'speedup':>8} {'stream MB/s':>12} "
+          f"{'str peak MB':>12} {'file peak MB':>13}")
+    for mb in args.mb:
+        text = make_text(int(mb * 1e6))
+        nbytes = len(text.encode("utf-8"))
+        _, items = parse_user_text(text)
+        legacy = timeit(lambda: parse_legacy(text), args.repeat)
+        new = timeit(lambda: parse_user_text(text), args.repeat)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+            f.write(text)
+            path = f.name
+        try:
+            def stream():
+                with open(path, encoding="utf-8") as fh:
+                    for _ in iter_user_items(fh):
+                        pass
+            streamed = timeit(stream, args.repeat)
+            str_peak = peak_mb(lambda: parse_user_text(text))
+            file_peak = peak_mb(stream)
+        finally:
+            os.unlink(path)
+        r = {"mb": nbytes / 1e6, "items": len(items),
+             "legacy_mb_s": nbytes / legacy / 1e6, "new_mb_s": nbytes / new / 1e6,
+             "speedup": legacy / new, "stream_mb_s": nbytes / streamed / 1e6,
+             "str_peak_mb": str_peak, "file_peak_mb": file_peak}
+        results.append(r)
+        print(f"{r['mb']:>6.1f} {r['items']:>8} {r['legacy_mb_s']:>12.1f} {r['new_mb_s']:>10.1f} "
+              f"{r['speedup']:>7.2f}x {r['stream_mb_s']:>12.1f} {r['str_peak_mb']:>12.1f} {r['file_peak_mb']:>13.1f}")
+
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# benchmarks/bench_soffice_batch.py
+# 量 soffice 微批次（soffice_batch.py）在不同窗口 / 批次上限下的吞吐與單筆延遲（p50/p95）。
+# 基準線 = window 0 + max_batch 1（每個請求各跑一次 soffice，等同舊行為）。
+# 請求以固定間隔陸續送出、由多個執行緒同時等待，模擬 webhook 同時湧入的情境。
+#
+# 用法：
+#   python benchmarks/bench_soffice_batch.py --in 維修報價單範本.xlsx --requests 16 --interval-ms 50 \
+#       --windows 0 50 200 --max-batch 8 [--json out.json]
+
+import argparse, json, os, sys, tempfile, threading, time
+from pathlib import Path
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from soffice_batch import SofficeBatcher
+from soffice_scheduler import find_soffice
+
+def run_case(soffice: str, src: str, n: int, interval: float, window_ms: float, max_batch: int):
+    batcher = SofficeBatcher(soffice, window_ms=window_ms, max_batch=max_batch if window_ms > 0 else 1)
+    lat: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as td:
+        def one(i: int):
+            nonlocal errors
+            t0 = time.perf_counter()
+            try:
+                batcher.convert(src, str(Path(td) / f"out{i}.pdf"))
+                with lock:
+                    lat.append(time.perf_counter() - t0)
+            except Exception:
+                with lock:
+                    errors += 1
+
+        threads = []
+        t0 = time.perf_counter()
+        for i in range(n):
+            th = threading.Thread(target=one, args=(i,))
+            th.start()
+            threads.append(th)
+            time.sleep(interval)
+        for th in threads:
+            th.join()
+        wall = time.perf_counter() - t0
+    stats = batcher.stats()
+    batcher.close()
+
+    lat.sort()
+    return {
+        "window_ms": window_ms,
+        "max_batch": max_batch if window_ms > 0 else 1,
+        "requests": n,
+        "errors": errors,
+        "wall_s": wall,
+        "throughput_per_s": n / wall if wall else 0.0,
+        "p50_ms": median(lat) * 1000 if lat else None,
+        "p95_ms": lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000 if lat else None,
+        "batches": stats["batches"],
+        "avg_batch": stats["avg_batch"],
+    }
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in", dest="xlsx_in", required=True, help="要轉的 xlsx（單張工作表）")
+    ap.add_argument("--requests", type=int, default=16)
+    ap.add_argument("--interval-ms", type=float, default=50, help="請求送出間隔")
+    ap.add_argument("--windows", type=float, nargs="+", default=[0, 50, 200], help="收集窗口（ms）；0 = 基準線")
+    ap.add_argument("--max-batch", type=int, default=8)
+    ap.add_argument("--soffice", dest="soffice_path", default=None)
+    ap.add_argument("--json", dest="json_out", default=None, help="結果另存 JSON")
+    args = ap.parse_args()
+
+    soffice = find_soffice(args.soffice_path)
+    if not soffice:
+        sys.exit("找不到 soffice")
+
+    results = []
+    print(f"{'window':>8} {'batch':>5} {'thru/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'batches':>8} {'err':>4}")
+    for w in args.windows:
+        r = run_case(soffice, args.xlsx_in, args.requests, args.interval_ms / 1000, w, args.max_batch)
+        results.append(r)
+        print(f"{r['window_ms']:>8.0f} {r['max_batch']:>5} {r['throughput_per_s']:>8.2f} "
+              f"{r['p50_ms'] or 0:>9.0f} {r['p95_ms'] or 0:>9.0f} {r['batches']:>8} {r['errors']:>4}")
+
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# benchmarks/bench_suite.py
+# 報價流程的整套 benchmark，不需要網路：結果存成 JSON，方便不同 commit 之間比較有沒有退步。
+#
+# 項目（--only 可挑選；缺套件 / 缺 soffice 的項目會記成 skipped，不會中斷整套）：
+#   parse      : parse_user_text，小段貼文與超大段貼文（--parse-items 筆）
+#   write      : write_items_and_total，1 / 10 / 100 / 1000 筆明細（Aspose）
+#   engines    : make_quote 各 PDF 引擎端到端（含各階段耗時，取自 StageReport）
+#   watermark  : strip_watermark_bytes，多頁 PDF（PyMuPDF 現場產生，含 Aspose 浮水印文字）
+#   callback   : 以 uvicorn 啟動 app.py，LINE API 換成本機替身（LINE_API_ENDPOINT），
+#                送出正確簽章的 webhook，量 /callback 回應、reply 到達、push（產檔完成）到達的時間
+#
+# 用法：
+#   python benchmarks/bench_suite.py --in 維修報價單範本.xlsx [--only parse watermark] [--json out.json]
+#   python benchmarks/bench_suite.py --compare base.json new.json [--threshold 0.15]
+
+import argparse, asyncio, base64, hashlib, hmac, json, os, platform, socket, subprocess, sys, tempfile, time, uuid
+from pathlib import Path
+from statistics import median
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECTIONS = ("parse", "write", "engines", "watermark", "callback")
+ENGINES = ("libreoffice", "aspose", "native", "overlay")
+
+# ---------------- 共用 ----------------
+def pct(values: List[float], p: float) -> float | None:
+    if not values:
+        return None
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    """秒 -> 毫秒統計。"""
+    ms = [v * 1000 for v in samples]
+    return {"n": len(ms), "median_ms": median(ms) if ms else None, "p95_ms": pct(ms, 0.95),
+            "min_ms": min(ms) if ms else None}
+
+def repeat(fn: Callable[[], Any], n: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
+
+def make_items(n: int) -> List[Dict[str, Any]]:
+    return [
+        {"Product": f"產品{i}", "Desc": f"說明{i}", "Count": i % 5 + 1,
+         "Price": 100.0 + i, "ProvidePrice": 90.0 + i}
+        for i in range(n)
+    ]
+
+def make_paste(n: int) -> str:
+    """模擬使用者貼到 LINE 的文字（混用全形冒號、分隔線與空白行）。"""
+    lines = ["客戶名稱：測試客戶", "報價日期: 2025/10/17", ""]
+    for i in range(n):
+        lines += [f"產品：產品{i}", f"說明: 規格 {i} 號", f"數量：{i % 5 + 1}",
+                  f"單價: {1000 + i:,}", f"優惠單價：{900 + i}", "----" if i % 2 else ""]
+    return "\n".join(lines)
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# ---------------- parse ----------------
+def bench_parse(args) -> Dict[str, Any]:
+    from user_input_parsing import parse_user_text
+
+    out = {}
+    for label, n, reps in (("small", 1, args.repeat * 100), ("large", args.parse_items, args.repeat)):
+        text = make_paste(n)
+        _, items = parse_user_text(text)
+        assert len(items) == n, f"parse {label}: 預期 {n} 筆，得到 {len(items)} 筆"
+        samples = repeat(lambda: parse_user_text(text), reps)
+        out[label] = {"items": n, "bytes": len(text.encode("utf-8")), **summarize(samples),
+                      "mb_per_s": len(text.encode("utf-8")) / median(samples) / 1e6}
+    return out
+
+# ---------------- write_items_and_total ----------------
+def bench_write(args) -> Dict[str, Any]:
+    from make_quote_linux import open_book, write_items_and_total
+
+    out = {}
+    for n in args.sizes:
+        items = make_items(n)
+        samples = []
+        for _ in range(args.repeat):
+            wb = open_book(args.xlsx_in)  # 每次都從乾淨的範本開始，不計入讀檔時間
+            sheet = args.sheet or wb.worksheets[0].name
+            t0 = time.perf_counter()
+            write_items_and_total(wb, sheet, items, recalc=False)
+            samples.append(time.perf_counter() - t0)
+        out[str(n)] = summarize(samples)
+    return out
+
+# ---------------- 各 PDF 引擎 ----------------
+def bench_engines(args) -> Dict[str, Any]:
+    from make_quote_linux import StageReport, make_quote
+
+    sets = {"ClientName": "測試客戶", "QuoteDate": "2025/10/17"}
+    items = make_items(args.engine_items)
+    out = {}
+    for engine in args.engines:
+        totals, stages = [], {}
+        try:
+            with tempfile.TemporaryDirectory() as td:
+                for i in range(args.repeat + 1):
+                    report = StageReport(engine=engine)
+                    t0 = time.perf_counter()
+                    make_quote(args.xlsx_in, name=str(Path(td) / f"q{i}"), sheet=args.sheet, sets=sets,
+                               items=items, pdf_engine=engine, soffice_path=args.soffice_path, report=report)
+                    if i == 0:
+                        continue  # 第一次含載入 / 暖機，不計
+                    totals.append(time.perf_counter() - t0)
+                    for r in report.stages:
+                        stages.setdefault(r["stage"], []).append(r["seconds"])
+        except Exception as e:
+            out[engine] = {"error": f"{type(e).__name__}: {e}"}
+            continue
+        out[engine] = {"items": len(items), **summarize(totals),
+                       "stages": {k: summarize(v)["median_ms"] for k, v in stages.items()}}
+    return out
+
+# ---------------- 浮水印 ----------------
+def make_watermarked_pdf(pages: int) -> bytes:
+    import fitz
+    from remove_watermark import WATERMARK_TEXT
+
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page()
+        page.insert_text((40, 30), WATERMARK_TEXT, fontsize=8, color=(1, 0, 0))
+        for row in range(40):
+            page.insert_text((40, 60 + row * 18), f"{p * 40 + row + 1:>4}  item {row}  qty {row % 5 + 1}  "
+                                                  f"price {1000 + row:,}", fontsize=10)
+    doc.set_metadata({"producer": "Aspose.Cells for Python via .NET", "creator": "Aspose.Cells"})
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def bench_watermark(args) -> Dict[str, Any]:
+    from remove_watermark import strip_watermark_bytes
+
+    out = {}
+    for pages in args.pages:
+        data = make_watermarked_pdf(pages)
+        cleaned = strip_watermark_bytes(data)
+        assert cleaned != data, "浮水印沒有被移除"
+        out[str(pages)] = {"bytes": len(data), **summarize(repeat(lambda: strip_watermark_bytes(data), args.repeat))}
+    return out
+
+# ---------------- /callback 端到端 ----------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def sign(secret: str, body: bytes) -> str:
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+def webhook_body(i: int, text: str) -> Dict[str, Any]:
+    return {
+        "destination": "Ubench",
+        "events": [{
+            "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": f"Ubench{i:06d}"},
+            "webhookEventId": uuid.uuid4().hex.upper(),
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"rt{i:06d}",
+            "message": {"type": "text", "id": str(10 ** 12 + i), "quoteToken": f"q{i}", "text": text},
+        }],
+    }
+
+class LineStandIn:
+    """本機版 LINE Messaging API：記下 reply / push 到達的時間與內容，可模擬延遲。"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.replies: Dict[str, float] = {}
+        self.pushes: Dict[str, tuple] = {}
+        self._runner = None
+        self.port = 0
+
+    async def _reply(self, request):
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.replies.setdefault(body.get("replyToken", ""), time.perf_counter())
+        return self._web.json_response({})
+
+    async def _push(self, request):
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        text = (body.get("messages") or [{}])[0].get("text", "")
+        self.pushes.setdefault(body.get("to", ""), (time.perf_counter(), text))
+        return self._web.json_response({"sentMessages": []})
+
+    async def start(self):
+        from aiohttp import web
+
+        self._web = web
+        app = web.Application()
+        app.router.add_post("/v2/bot/message/reply", self._reply)
+        app.router.add_post("/v2/bot/message/push", self._push)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self.port = _free_port()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+async def _wait_http(session, url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as r:
+                if r.status == 200:
+                    return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} 在 {timeout:.0f}s 內沒有回應")
+
+async def _run_callback(args) -> Dict[str, Any]:
+    import aiohttp
+
+    secret = "bench-secret"
+    standin = LineStandIn(args.line_latency_ms)
+    await standin.start()
+    port = _free_port()
+    td = tempfile.TemporaryDirectory()
+    env = {
+        **os.environ,
+        "LINE_CHANNEL_SECRET": secret, "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_API_ENDPOINT": f"http://127.0.0.1:{standin.port}",
+        "TEMPLATE_XLSX": os.path.abspath(args.xlsx_in), "PDF_ENGINE": args.callback_engine,
+        "OUTPUT_DIR": td.name, "PUBLIC_BASE_URL": f"http://127.0.0.1:{port}",
+        "RESULT_CACHE_TTL": "0",  # 每則訊息都要真的產檔
+        "JOB_QUEUE_MAX": str(max(20, args.requests)), "QUOTE_LOG_FORMAT": "json",
+    }
+    env.pop("IDEMPOTENCY_DB", None)
+    if args.sheet:
+        env["SHEET_NAME"] = args.sheet
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    acks, sent = [], {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            # /readyz：暖機（Aspose / 範本 / soffice）做完才開始量，/healthz 在綁好 port 時就回 200
+            await _wait_http(session, f"{base}/readyz", args.startup_timeout)
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def one(i: int):
+                body = json.dumps(webhook_body(i, make_paste(args.engine_items)), ensure_ascii=False).encode("utf-8")
+                headers = {"Content-Type": "application/json", "X-Line-Signature": sign(secret, body)}
+                async with sem:
+                    t0 = time.perf_counter()
+                    sent[i] = t0
+                    async with session.post(f"{base}/callback", data=body, headers=headers) as r:
+                        await r.read()
+                        if r.status != 200:
+                            raise RuntimeError(f"/callback 回 {r.status}")
+                    acks.append(time.perf_counter() - t0)
+
+            t_all = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.requests)))
+            deadline = time.monotonic() + args.push_timeout
+            while len(standin.pushes) < args.requests and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            wall = time.perf_counter() - t_all
+
+            # 驗簽：錯誤簽章必須被擋下
+            async with session.post(f"{base}/callback", data=b"{}", headers={"X-Line-Signature": "bad"}) as r:
+                bad_sig_status = r.status
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await standin.close()
+        td.cleanup()
+
+    replies = [standin.replies[f"rt{i:06d}"] - t for i, t in sent.items() if f"rt{i:06d}" in standin.replies]
+    pushes, failed = [], 0
+    for i, t in sent.items():
+        got = standin.pushes.get(f"Ubench{i:06d}")
+        if got is None:
+            continue
+        pushes.append(got[0] - t)
+        failed += "失敗" in got[1]
+    return {
+        "engine": args.callback_engine, "requests": args.requests, "concurrency": args.concurrency,
+        "line_latency_ms": args.line_latency_ms, "bad_signature_status": bad_sig_status,
+        "ack": summarize(acks), "reply": summarize(replies), "push": summarize(pushes),
+        "pushed": len(pushes), "push_failed": failed, "wall_s": wall,
+        "throughput_per_s": len(pushes) / wall if wall else 0.0,
+    }
+
+def bench_callback(args) -> Dict[str, Any]:
+    import aiohttp, linebot, uvicorn  # noqa: F401  缺套件時整項 skipped
+
+    return asyncio.run(_run_callback(args))
+
+# ---------------- 比較兩次結果 ----------------
+def _flatten(d: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            out.update(_flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and k.endswith("_ms"):
+            out[key] = float(v)
+    return out
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    base = _flatten(json.loads(Path(base_path).read_text(encoding="utf-8"))["results"])
+    new = _flatten(json.loads(Path(new_path).read_text(encoding="utf-8"))["results"])
+    worse = 0
+    print(f"{'metric':<48} {'base':>10} {'new':>10} {'change':>8}")
+    for k in sorted(base.keys() & new.keys()):
+        if not base[k]:
+            continue
+        change = new[k] / base[k] - 1
+        flag = ""
+        if change > threshold:
+            flag, worse = "  <-- 變慢", worse + 1
+        print(f"{k:<48} {base[k]:>10.2f} {new[k]:>10.2f} {change:>+7.1%}{flag}")
+    print(f"[COMPARE] {worse} 項變慢超過 {threshold:.0%}")
+    return 1 if worse else 0
+
+# ---------------- CLI ----------------
+RUNNERS = {"parse": bench_parse, "write": bench_write, "engines": bench_engines,
+           "watermark": bench_watermark, "callback": bench_callback}
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="報價流程 benchmark（離線）")
+    ap.add_argument("--in", dest="xlsx_in", default=os.path.join(ROOT, "維修報價單範本.xlsx"))
+    ap.add_argument("--sheet", default=None)
+    ap.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--parse-items", type=int, default=5000, help="大段貼文的明細筆數")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="write 的明細筆數")
+    ap.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    ap.add_argument("--engine-items", type=int, default=10, help="engines / callback 每張報價單的明細筆數")
+    ap.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50], help="浮水印 PDF 頁數")
+    ap.add_argument("--soffice", dest="soffice_path", default=None)
+    ap.add_argument("--callback-engine", default="native", choices=ENGINES)
+    ap.add_argument("--requests", type=int, default=20, help="callback 送出的 webhook 數")
+    ap.add_argument("--concurrency", type=int, default=5)
+    ap.add_argument("--line-latency-ms", type=float, default=20, help="LINE 替身的回應延遲")
+    ap.add_argument("--startup-timeout", type=float, default=60)
+    ap.add_argument("--push-timeout", type=float, default=300)
+    ap.add_argument("--json", dest="json_out", default=None, help="結果 JSON（預設 benchmarks/results/<commit>.json）")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="比較兩份結果 JSON，不跑 benchmark")
+    ap.add_argument("--threshold", type=float, default=0.15, help="--compare 判定變慢的比例")
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare, args.threshold)
+
+    commit = git_commit()
+    results: Dict[str, Any] = {}
+    for name in args.only:
+        print(f"[BENCH] {name} ...", flush=True)
+        t0 = time.perf_counter()
+        try:
+            results[name] = RUNNERS[name](args)
+        except ImportError as e:
+            results[name] = {"skipped": f"缺少套件：{e.name or e}"}
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+        print(f"[BENCH] {name} 完成（{time.perf_counter() - t0:.1f}s）："
+              f"{json.dumps(results[name], ensure_ascii=False)[:300]}", flush=True)
+
+    doc = {
+        "meta": {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "args": {k: v for k, v in vars(args).items() if k != "compare"}},
+        "results": results,
+    }
+    out = Path(args.json_out or os.path.join(ROOT, "benchmarks", "results", f"{commit or 'unknown'}.json"))
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(doc, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"[BENCH] 結果已存：{out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
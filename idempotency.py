@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# idempotency.py
+# Webhook 重送去重：LINE 在我們回應太慢時會重送同一個事件（webhookEventId 相同、isRedelivery=true）。
+# 以事件 ID（沒有時用訊息 ID）為鍵記錄處理狀態，讓重送不會再跑一次產檔流程：
+#   - 第一次看到 → claim 成功，照常排工作
+#   - 工作還在跑 → 掛回同一個工作（回覆同一個編號，不另開工作）
+#   - 工作已完成 → 直接回傳存下的結果
+#
+# - 記憶體內以 LRU 保留最近 IDEMPOTENCY_MAX_ENTRIES 筆
+# - 設定 IDEMPOTENCY_DB（SQLite 檔案路徑）時同步寫入，重啟後仍認得已完成的事件；
+#   超過 IDEMPOTENCY_DB_TTL 秒的舊紀錄會定期清掉
+# - pending（已佔位、還沒排成工作）只在很短的時間內有效：超過 IDEMPOTENCY_PENDING_TTL 秒、
+#   或是上一個程序留下的（程序在佔位後當掉），視為過期，允許重新佔位
+#
+# 函式入口：
+#   IDEMPOTENCY.claim(key) -> dict | None     # None = 第一次看到（已佔位），否則回傳既有紀錄
+#   IDEMPOTENCY.set_job(key, job_id) / complete(key, status, result) / release(key)
+
+import json, os, sqlite3, threading, time
+from collections import OrderedDict
+from typing import Any, Dict
+
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB")  # 例如 data/webhook_events.sqlite3；不填 = 只放記憶體
+IDEMPOTENCY_DB_TTL = float(os.getenv("IDEMPOTENCY_DB_TTL", str(3 * 24 * 3600)))
+IDEMPOTENCY_PENDING_TTL = float(os.getenv("IDEMPOTENCY_PENDING_TTL", "30"))
+_STARTED = time.time()  # 比這更早的 pending 一定是上一個程序留下的
+_PRUNE_EVERY = 1000  # 每寫入幾筆清一次過期紀錄
+
+class IdempotencyStore:
+    def __init__(self, max_entries: int = IDEMPOTENCY_MAX_ENTRIES, db_path: str | None = IDEMPOTENCY_DB,
+                 pending_ttl: float = IDEMPOTENCY_PENDING_TTL):
+        self.max_entries = max(1, max_entries)
+        self.pending_ttl = pending_ttl
+        # key -> {"status": pending/running/done/failed, "job_id", "result", "updated"}
+        self._mem: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self.duplicates = 0
+        self.stale = 0
+        self._writes = 0
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_events ("
+                " key TEXT PRIMARY KEY, status TEXT NOT NULL, job_id TEXT, result TEXT, updated REAL NOT NULL)"
+            )
+
+    # ---- 內部：記憶體 + SQLite ----
+    def _load(self, key: str) -> Dict[str, Any] | None:
+        rec = self._mem.get(key)
+        if rec is not None:
+            self._mem.move_to_end(key)
+            return rec
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT status, job_id, result, updated FROM webhook_events WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        rec = {"status": row[0], "job_id": row[1], "result": json.loads(row[2]) if row[2] else None,
+               "updated": row[3]}
+        self._remember(key, rec)
+        return rec
+
+    def _remember(self, key: str, rec: Dict[str, Any]):
+        self._mem[key] = rec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _save(self, key: str, rec: Dict[str, Any]):
+        rec["updated"] = time.time()
+        self._remember(key, rec)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO webhook_events (key, status, job_id, result, updated) VALUES (?, ?, ?, ?, ?)",
+                (key, rec["status"], rec.get("job_id"),
+                 json.dumps(rec["result"], ensure_ascii=False) if rec.get("result") is not None else None,
+                 rec["updated"]),
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY == 0:
+                self._db.execute("DELETE FROM webhook_events WHERE updated < ?", (time.time() - IDEMPOTENCY_DB_TTL,))
+
+    # ---- 對外 ----
+    def claim(self, key: str) -> Dict[str, Any] | None:
+        """
+        第一次看到 key 時佔位並回傳 None；否則回傳既有紀錄的副本（呼叫端依 status 決定怎麼回）。
+        先前失敗的事件、過期的 pending 允許重新佔位再跑一次。
+        """
+        with self._lock:
+            rec = self._load(key)
+            if rec is not None and self._stale(rec):
+                self.stale += 1
+                rec = None
+            if rec is not None and rec["status"] != "failed":
+                self.duplicates += 1
+                return dict(rec)
+            self._save(key, {"status": "pending", "job_id": None, "result": None})
+            return None
+
+    def _stale(self, rec: Dict[str, Any]) -> bool:
+        if rec["status"] != "pending":
+            return False
+        updated = rec.get("updated") or 0.0
+        return updated < _STARTED or time.time() - updated > self.pending_ttl
+
+    def set_job(self, key: str, job_id: str):
+        with self._lock:
+            prev = self._load(key)
+            if prev is not None and prev.get("job_id") == job_id and prev["status"] in ("done", "failed"):
+                return  # 工作比 set_job 先做完：不要把結果蓋回 running
+            self._save(key, {"status": "running", "job_id": job_id, "result": None})
+
+    def complete(self, key: str, status: str, result: Any = None, job_id: str | None = None):
+        with self._lock:
+            prev = self._load(key) or {}
+            self._save(key, {"status": status, "job_id": job_id or prev.get("job_id"), "result": result})
+
+    def release(self, key: str):
+        """佔位後沒排成工作（例如佇列滿了）：移除紀錄，讓重送可以再試。"""
+        with self._lock:
+            self._mem.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM webhook_events WHERE key = ?", (key,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = {"entries": len(self._mem), "duplicates": self.duplicates, "stale": self.stale,
+                   "sqlite": self._db is not None}
+            if self._db is not None:
+                out["persisted"] = self._db.execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+            return out
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+IDEMPOTENCY = IdempotencyStore()
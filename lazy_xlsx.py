@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# lazy_xlsx.py
+# 按需產生 xlsx：大部分客戶只開 PDF，所以產檔時只畫 PDF（native / overlay 引擎），
+# xlsx 只先存一份精簡紀錄（範本 + 版本、分頁、sets、items），第一次有人下載 xlsx 時才用 Aspose 產生。
+#
+# - 紀錄放在 output_store 的 token 目錄（.quote.json），網址一開始就能給出去
+# - 同一個檔案同時被下載多次只產一次（每個 token 一把鎖，等待者都離開才移除）；同時產生的數量以 LAZY_XLSX_CONCURRENCY 限制
+# - 已產生的 xlsx 最多保留 LAZY_XLSX_KEEP 個，超過就刪最久沒用的實體檔（紀錄留著，之後可再產）
+# - 範本在產 PDF 之後被換掉時仍會產生，但印出警告（xlsx 會以新範本為準）
+#
+# 函式入口：
+#   LazyXlsx(store, render=None).store_record(download_name, record) -> 預定的 xlsx 路徑
+#     render(**kwargs) 預設在本程序呼叫 make_quote_xlsx；app 的 process 模式改交給工作 worker 執行
+#   LazyXlsx.pending(url_name) -> bool；LazyXlsx.materialize(url_name) -> Path | None
+
+import json, os, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from metrics import log_event
+from output_store import RECORD_NAME, OutputStore
+from result_cache import template_identity
+
+LAZY_XLSX_KEEP = int(os.getenv("LAZY_XLSX_KEEP", "200"))
+LAZY_XLSX_CONCURRENCY = int(os.getenv("LAZY_XLSX_CONCURRENCY", "2"))
+
+def quote_record(template_xlsx: str, sheet: str | None, sets: Dict[str, Any], items: list,
+                 template_row: int = 11, first_insert_row: int = 12) -> Dict[str, Any]:
+    """產生 xlsx 需要的全部輸入（JSON 可序列化）。"""
+    tpath, mtime_ns, size = template_identity(template_xlsx)
+    return {
+        "template": tpath, "template_version": [mtime_ns, size], "sheet": sheet,
+        "sets": sets, "items": items, "template_row": template_row, "first_insert_row": first_insert_row,
+    }
+
+class LazyXlsx:
+    def __init__(self, store: OutputStore, keep: int = LAZY_XLSX_KEEP, concurrency: int = LAZY_XLSX_CONCURRENCY,
+                 render: Callable[..., Any] | None = None):
+        self.store = store
+        self.render = render
+        self.keep = max(1, keep)
+        self._slots = threading.BoundedSemaphore(max(1, concurrency))
+        self._locks: Dict[str, list] = {}   # token -> [鎖, 使用中的人數]
+        self._locks_guard = threading.Lock()
+        self._materialized: "OrderedDict[str, None]" = OrderedDict()   # 已產生的 xlsx 路徑（LRU）
+        self.records = 0
+        self.renders = 0
+
+    def store_record(self, download_name: str, record: Dict[str, Any]) -> str:
+        path = Path(self.store.reserve(download_name))
+        data = {**record, "download_name": download_name}
+        (path.parent / RECORD_NAME).write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        self.store.commit(str(path))
+        self.records += 1
+        return str(path)
+
+    def _target(self, url_name: str) -> Path | None:
+        path = self.store.lookup(url_name)
+        if path is None or path.exists() or not (path.parent / RECORD_NAME).exists():
+            return None
+        return path
+
+    def pending(self, url_name: str) -> bool:
+        return self._target(url_name) is not None
+
+    def materialize(self, url_name: str) -> Path | None:
+        """需要時產生 xlsx（阻塞，請在 thread 裡呼叫）；回傳檔案路徑，非按需檔案回傳 None。"""
+        path = self._target(url_name)
+        if path is None:
+            return None
+        token = path.parent.name
+        with self._locks_guard:
+            entry = self._locks.setdefault(token, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if not path.exists():   # 等鎖時別人可能已經產好了
+                    self._render(path)
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[token]
+        self._touch(path)
+        return path
+
+    def _render(self, path: Path):
+        rec = json.loads((path.parent / RECORD_NAME).read_text(encoding="utf-8"))
+        _, mtime_ns, size = template_identity(rec["template"])
+        if [mtime_ns, size] != rec["template_version"]:
+            log_event("lazy_xlsx_template_changed", level="warn", file=path.name, template=rec["template"])
+        render = self.render
+        if render is None:
+            from quote_jobs import run_xlsx_job as render  # 第一次才載入 Aspose
+        with self._slots:
+            render(
+                xlsx_in=rec["template"], xlsx_out=str(path), sheet=rec["sheet"], sets=rec["sets"],
+                items=rec["items"], template_row=rec.get("template_row", 11),
+                first_insert_row=rec.get("first_insert_row", 12),
+            )
+        self.renders += 1
+        self.store.commit(str(path))
+
+    def _touch(self, path: Path):
+        key = str(path)
+        with self._locks_guard:
+            self._materialized[key] = None
+            self._materialized.move_to_end(key)
+            over = []
+            while len(self._materialized) > self.keep:
+                over.append(self._materialized.popitem(last=False)[0])
+        for old in over:
+            # 只刪實體 xlsx，紀錄留著：下次下載再產一次
+            Path(old).unlink(missing_ok=True)
+            self.store.commit(old)
+
+    def stats(self) -> Dict[str, int]:
+        return {"records": self.records, "renders": self.renders, "materialized": len(self._materialized)}
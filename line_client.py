@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# line_client.py
+# 非同步 LINE Messaging API 用戶端：reply / push 都走 aiohttp，不卡 uvicorn 的 event loop。
+#
+# - 全程共用一個 aiohttp ClientSession（keep-alive 連線池），不必每則訊息重新 TLS 握手
+# - 429 / 5xx / 連線錯誤會以指數退避 + 抖動重試；其他 4xx（例如 reply token 失效）不重試
+# - push 帶固定的 X-Line-Retry-Key，重試時 LINE 端不會重複送出同一則訊息
+# - 背景執行緒（工作佇列的完成回呼）用 push_threadsafe() 把訊息丟回 event loop 送出
+#
+# 設定（環境變數）：
+#   LINE_HTTP_POOL_SIZE : 連線池上限（預設 20）
+#   LINE_HTTP_TIMEOUT   : 單次請求逾時秒數（預設 10）
+#   LINE_HTTP_RETRIES   : 最多重試次數（預設 3）
+#   LINE_HTTP_BACKOFF   : 第一次重試前等待秒數，之後每次加倍（預設 0.5）
+#   LINE_API_ENDPOINT   : API 位址（預設 https://api.line.me；benchmark 以本機替身取代，見 benchmarks/bench_suite.py）
+#
+# 函式入口：
+#   client = LineClient(token); await client.start(); await client.reply(token, text); await client.close()
+
+import asyncio, os, random, uuid
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+import aiohttp
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from metrics import log_event
+
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "20"))
+LINE_HTTP_TIMEOUT = float(os.getenv("LINE_HTTP_TIMEOUT", "10"))
+LINE_HTTP_RETRIES = int(os.getenv("LINE_HTTP_RETRIES", "3"))
+LINE_HTTP_BACKOFF = float(os.getenv("LINE_HTTP_BACKOFF", "0.5"))
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, LineBotApiError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class LineClient:
+    def __init__(self, channel_token: str, pool_size: int = LINE_HTTP_POOL_SIZE,
+                 timeout: float = LINE_HTTP_TIMEOUT, retries: int = LINE_HTTP_RETRIES,
+                 backoff: float = LINE_HTTP_BACKOFF):
+        self.channel_token = channel_token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self._session: aiohttp.ClientSession | None = None
+        self._api: AsyncLineBotApi | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self):
+        """在 event loop 內呼叫（FastAPI startup）；連線池與 loop 綁定。"""
+        self._loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._api = AsyncLineBotApi(
+            self.channel_token,
+            endpoint=LINE_API_ENDPOINT,
+            async_http_client=AiohttpAsyncHttpClient(self._session, timeout=self.timeout),
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._api = None
+
+    async def _call(self, what: str, fn: Callable[[], Awaitable]):
+        if self._api is None:
+            raise RuntimeError("LineClient 尚未 start()")
+        for attempt in range(self.retries + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt >= self.retries or not _retryable(e):
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                log_event("line_retry", level="warn", call=what, attempt=attempt + 1, retries=self.retries,
+                          delay_s=round(delay, 2), error=str(e))
+                await asyncio.sleep(delay)
+
+    async def reply(self, reply_token: str, text: str):
+        msg = TextSendMessage(text=text)
+        await self._call("reply", lambda: self._api.reply_message(reply_token, msg))
+
+    async def push(self, to: str, text: str):
+        msg = TextSendMessage(text=text)
+        retry_key = str(uuid.uuid4())  # 同一則訊息的每次重試共用，LINE 端自動去重
+        await self._call("push", lambda: self._api.push_message(to, msg, retry_key=retry_key))
+
+    def push_threadsafe(self, to: str, text: str) -> Future:
+        """給非 event loop 執行緒用：排進 loop 送出，不等結果；失敗只記錄。"""
+        if self._loop is None:
+            raise RuntimeError("LineClient 尚未 start()")
+        fut = asyncio.run_coroutine_threadsafe(self.push(to, text), self._loop)
+
+        def _log(f: Future):
+            if f.exception() is not None:
+                log_event("line_push_failed", level="error", to=to, error=str(f.exception()))
+        fut.add_done_callback(_log)
+        return fut
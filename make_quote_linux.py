@@ -2,7 +2,12 @@
 # make_quote_linux.py
 # 1) 用 Aspose.Cells 生成 .xlsx（插入列 = Insert Copied Cells 效果，圖片/圖形跟著移動縮放）
 # 2) 預設用 LibreOffice (soffice --headless) 把「單一指定工作表」轉成 PDF（無浮水印）
-# 3) 找不到 soffice 時，回退用 Aspose 匯出（會出紅字），並印出警告
+#    設定 SOFFICE_POOL_SIZE>0 時改用常駐 soffice 轉檔池（見 soffice_pool.py），subprocess 為回退
+#    設定 SOFFICE_BATCH_WINDOW_MS>0 時，同時間的轉檔合併成一次 soffice 執行（見 soffice_batch.py）
+# 3) 找不到 soffice 時，回退用 Aspose 匯出，並印出警告（評估版紅字會在記憶體內去除，見 remove_watermark.py）
+# 4) pdf_engine="native"：不經試算表，直接用 PyMuPDF 依範本版面畫 PDF（見 pdf_native.py），
+#    xlsx 只在 want_xlsx=True 時才用 Aspose 產生
+#    pdf_engine="overlay"：同上，但靜態部分用快取底圖，只蓋動態文字（見 pdf_overlay.py）
 #
 # 依賴：
 #   pip install aspose-cells-python
@@ -12,17 +17,32 @@
 #   make_quote(xlsx_in, name=None, xlsx_out=None, pdf_out=None,
 #              sheet=None, sets=None, items=None,
 #              template_row=11, first_insert_row=12,
-#              pdf_engine="libreoffice", soffice_path=None) -> (xlsx_out, pdf_out)
-
-import argparse, os, sys, platform, subprocess, shutil, tempfile
-from typing import Dict, List, Tuple
+#              pdf_engine="libreoffice", soffice_path=None,
+#              calc_mode="chain", want_xlsx=True, report=None) -> (xlsx_out, pdf_out)
+#   make_quote_xlsx(xlsx_in, xlsx_out, sheet=None, sets=None, items=None, ...) -> xlsx_out   # 只出 Excel
+#   python make_quote_linux.py batch ...   # 批次產檔（多 process），見 quote_batch.py
+
+import argparse, io, os, sys, time, subprocess, shutil, tempfile, zipfile
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
 from datetime import datetime
 from pathlib import Path
 
 import aspose.cells as ac
 from aspose.cells.drawing import PlacementType
 from aspose.cells.rendering import SheetSet
-from aspose.cells import FontConfigs
+
+from metrics import FALLBACKS, log_event, observe_stage, timed
+from pdf_fonts import PDF_FONT_SUBSET, configure_fonts
+from pdf_native import render_quote_pdf
+from pdf_overlay import render_quote_pdf_overlay
+from quote_layout import load_layout
+from remove_watermark import strip_watermark_bytes, subset_pdf_fonts
+from soffice_batch import get_batcher
+from soffice_pool import get_pool
+from soffice_scheduler import SofficeBusy, find_soffice, get_scheduler
+from template_cache import TEMPLATE_CACHE
+from template_registry import template_index
 
 # ---------------- CLI 參數（仍保留相容） ----------------
 def parse_set_args(sets: List[str]) -> Dict[str, str]:
@@ -60,29 +80,60 @@ def decide_outputs(xlsx_in: str, name_arg: str | None, out_arg: str | None, pdf_
         pdf_base = pdf_arg or f"{os.path.splitext(xlsx_out)[0]}.pdf"
     return xlsx_out, pdf_base
 
+# ---------------- 輔助：分段計時與寫出量報告 ----------------
+class StageReport:
+    """
+    記錄 make_quote 每個階段的耗時與寫出 bytes：同時記進 metrics（/metrics 直方圖），
+    log_summary() 輸出一行結構化紀錄。
+    """
+    def __init__(self, engine: str = "", request: str | None = None):
+        self.stages: List[Dict[str, Any]] = []
+        self.engine = engine
+        self.request = request
+
+    @contextmanager
+    def stage(self, name: str):
+        rec = {"stage": name, "seconds": 0.0, "bytes": 0}
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["seconds"] = time.perf_counter() - t0
+            self.stages.append(rec)
+            observe_stage(name, rec["seconds"], rec["bytes"], self.engine)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(r["seconds"] for r in self.stages)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(r["bytes"] for r in self.stages)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"stages": list(self.stages), "seconds": self.total_seconds, "bytes": self.total_bytes,
+                "engine": self.engine}
+
+    def log_summary(self, **fields):
+        log_event(
+            "quote_stages",
+            request=self.request,
+            engine=self.engine,
+            total_ms=round(self.total_seconds * 1000, 1),
+            bytes=self.total_bytes,
+            stages={r["stage"]: round(r["seconds"] * 1000, 1) for r in self.stages},
+            **fields,
+        )
+
 # ---------------- 輔助：字型設定（避免 Aspose 匯出 PDF 中文亂碼） ----------------
 def setup_fonts_for_pdf() -> str | None:
-    sysname = platform.system()
-    try:
-        if sysname == "Windows":
-            FontConfigs.set_font_folder(r"C:\Windows\Fonts", True)
-            return "Microsoft JhengHei"
-        elif sysname == "Darwin":
-            FontConfigs.set_font_folders(
-                ["/System/Library/Fonts", "/Library/Fonts", os.path.expanduser("~/Library/Fonts")], True
-            )
-            return "PingFang TC"
-        else:
-            FontConfigs.set_font_folders(
-                ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.local/share/fonts")], True
-            )
-            return "Noto Sans CJK TC"
-    except Exception:
-        pass
-    return None
+    # 每個 process 只設定一次，且只載入挑好的字型檔（見 pdf_fonts.py）
+    return configure_fonts()
 
 # ---------------- 工作表取得（名稱/索引都通吃） ----------------
-def _get_ws(wb: ac.Workbook, sheet_name: str | None) -> ac.Worksheet:
+def _get_ws(wb: ac.Workbook, sheet_name: str | None, index: Dict[str, Any] | None = None) -> ac.Worksheet:
+    if index is not None:
+        return wb.worksheets[index["sheet_index"]]  # 版面索引已把名稱換成索引
     if sheet_name:
         ws = wb.worksheets.get(sheet_name)
         if ws is None:
@@ -90,9 +141,57 @@ def _get_ws(wb: ac.Workbook, sheet_name: str | None) -> ac.Worksheet:
         return ws
     return wb.worksheets[0]
 
+def load_index(xlsx_in: str, sheet: str | None) -> Dict[str, Any] | None:
+    """範本的版面索引（見 template_registry.py）；.xls 等無法解析時回傳 None，改用 Aspose 逐次查詢。"""
+    try:
+        return template_index(xlsx_in, sheet)
+    except (KeyError, zipfile.BadZipFile) as e:
+        log_event("template_index_unavailable", level="warn", template=xlsx_in, error=str(e))
+        return None
+
+def _name_cell(wb: ac.Workbook, name: str, index: Dict[str, Any] | None = None,
+               moved: Tuple[int, int] | None = None) -> ac.Cell | None:
+    """
+    命名範圍左上角的儲存格。有版面索引時直接用預先算好的座標，
+    moved=(首筆插入列 0-based, 插入列數) 換算插列之後的位置；索引沒有的才用 get_range_by_name。
+    """
+    ref = index["names"].get(name) if index is not None else None
+    if ref is not None:
+        row = ref["row"]
+        if moved and ref["sheet"] == index["sheet_index"] and row >= moved[0]:
+            row += moved[1]
+        return wb.worksheets[ref["sheet"]].cells.get(row, ref["col"])
+    if index is not None and name not in index["defined"]:
+        return None
+    rng = wb.worksheets.get_range_by_name(name)
+    return None if rng is None else rng.worksheet.cells.get(rng.first_row, rng.first_column)
+
 # ---------------- 基本操作（Aspose） ----------------
 def open_book(path: str) -> ac.Workbook:
-    return ac.Workbook(path)
+    # 範本只解析一次，之後從記憶體複製（檔案更新時自動失效，見 template_cache.py）
+    return TEMPLATE_CACHE.clone(path)
+
+def serialize_book(wb: ac.Workbook, fmt=ac.SaveFormat.XLSX) -> bytes:
+    """把 Workbook 序列化到記憶體（只序列化一次，之後各處共用這份 bytes）。"""
+    buf = io.BytesIO()
+    wb.save(buf, fmt)
+    return buf.getvalue()
+
+def write_bytes_unique(data: bytes, dst_path: str, max_tries: int = 3) -> str:
+    """寫檔；若同名被占用（例如 Excel 開著）就加時間戳另存，回傳實際路徑。"""
+    dst = Path(dst_path).resolve()
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    candidate = dst
+    for n in range(max_tries):
+        try:
+            candidate.write_bytes(data)
+            return str(candidate)
+        except OSError:
+            if n == max_tries - 1:
+                raise
+            ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+            candidate = dst.with_name(f"{dst.stem}_{ts}_{n + 1}{dst.suffix}")
+    return str(candidate)
 
 def ensure_shapes_move_and_size(ws: ac.Worksheet):
     for shp in ws.shapes:
@@ -113,21 +212,86 @@ def insert_like_copied_cells(ws: ac.Worksheet, template_row_1based: int, first_i
         return
     t0 = template_row_1based - 1
     i0 = first_insert_row_1based - 1
-    ws.cells.insert_rows(i0, extra_rows)  # 自動位移與更新參照
-    for k in range(extra_rows):
-        ws.cells.copy_row(ws.cells, t0, i0 + k)  # 複製範本列樣式到新列
+    cells = ws.cells
+    cells.insert_rows(i0, extra_rows)  # 自動位移與更新參照
+    # 先複製一列範本，之後每次把「已完成的列」整塊複製往下接（1 -> 2 -> 4 -> ...），
+    # N 列只需 O(log N) 次 .NET 呼叫，結果與逐列 copy_row 相同
+    cells.copy_row(cells, t0, i0)
+    done = 1
+    while done < extra_rows:
+        n = min(done, extra_rows - done)
+        cells.copy_rows(cells, i0, i0 + done, n)
+        done += n
+
+def _to_int(v):
+    try:
+        return int(float(v))
+    except Exception:
+        return v
+
+def _to_float(v):
+    try:
+        return float(v)
+    except Exception:
+        return v
+
+def item_rows(items: List[Dict[str, str]]) -> List[list]:
+    """把明細轉成 [項次, 產品, 說明, 數量, 單價, 優惠單價] 的二維陣列（型別在 Python 端先轉好）。"""
+    return [
+        [
+            i + 1,
+            it.get("Product", ""),
+            it.get("Desc", ""),
+            _to_int(it.get("Count", None)),
+            _to_float(it.get("Price", None)),
+            _to_float(it.get("ProvidePrice", None)),
+        ]
+        for i, it in enumerate(items)
+    ]
 
-def write_named_values(wb: ac.Workbook, updates: Dict[str, str]):
+def put_item_rows(ws: ac.Worksheet, rows: List[list], first_row0: int, first_col0: int = 0):
+    """整批寫入明細；Aspose 版本不支援二維匯入時退回逐格 put_value。"""
+    cells = ws.cells
+    if not rows:
+        return
+    try:
+        cells.import_two_dimension_array(rows, first_row0, first_col0)
+        return
+    except Exception as e:
+        log_event("item_import_fallback", level="warn", error=str(e))
+    for i, row in enumerate(rows):
+        for j, v in enumerate(row):
+            cells.get(first_row0 + i, first_col0 + j).put_value(v)
+
+def write_named_values(wb: ac.Workbook, updates: Dict[str, str], index: Dict[str, Any] | None = None):
+    # 寫入結果彙整成一筆紀錄：{名稱: "R列C欄"}、找不到的名稱、寫入失敗的名稱
+    written: Dict[str, str] = {}
+    missing: List[str] = []
+    failed: Dict[str, str] = {}
     for k, v in updates.items():
+        ref = index["names"].get(k) if index is not None else None
+        if ref is not None and ref["rows"] == 1 and ref["cols"] == 1:
+            try:
+                wb.worksheets[ref["sheet"]].cells.get(ref["row"], ref["col"]).put_value(v)
+                written[k] = f"R{ref['row']+1}C{ref['col']+1}"
+            except Exception as e:
+                failed[k] = str(e)
+            continue
+        if index is not None and k not in index["defined"]:
+            missing.append(k)
+            continue
         rng = wb.worksheets.get_range_by_name(k)
         if rng is None:
-            print(f"[WARN] 找不到 Named Range（或不是範圍）: {k}", file=sys.stderr)
+            missing.append(k)
             continue
         try:
             rng.value = v
-            print(f"[WRITE] {k} -> R{rng.first_row+1}C{rng.first_column+1} = {v}")
+            written[k] = f"R{rng.first_row+1}C{rng.first_column+1}"
         except Exception as e:
-            print(f"[WARN] 無法寫入 {k}: {e}", file=sys.stderr)
+            failed[k] = str(e)
+    log_event("write_named", cells=written)
+    if missing or failed:
+        log_event("write_named_skipped", level="warn", missing=missing, failed=failed)
 
 def write_items_and_total(
     wb: ac.Workbook,
@@ -135,59 +299,130 @@ def write_items_and_total(
     items: List[Dict[str, str]],
     template_row: int = 11,
     first_insert_row: int = 12,
+    recalc: bool = True,
+    index: Dict[str, Any] | None = None,
 ):
-    ws = _get_ws(wb, sheet_name)
-    ensure_shapes_move_and_size(ws)
+    ws = _get_ws(wb, sheet_name, index)
+    if index is None or not index["shapes_fixed"]:
+        ensure_shapes_move_and_size(ws)
     clear_row_contents(ws, template_row)
 
     extra = max(0, len(items) - 1)
-    insert_like_copied_cells(ws, template_row, first_insert_row, extra)
-
-    for i, it in enumerate(items):
-        r0 = (template_row - 1) + i
-        cells = ws.cells
-        cells.get(r0, 0).put_value(i + 1)                                # 項次
-        cells.get(r0, 1).put_value(it.get("Product", ""))                # 產品
-        cells.get(r0, 2).put_value(it.get("Desc", ""))                   # 說明
-        cnt = it.get("Count", None)
-        try:
-            cells.get(r0, 3).put_value(int(float(cnt)))
-        except Exception:
-            cells.get(r0, 3).put_value(cnt)
-        pri = it.get("Price", None)
-        try:
-            cells.get(r0, 4).put_value(float(pri))
-        except Exception:
-            cells.get(r0, 4).put_value(pri)
-        ppr = it.get("ProvidePrice", None)
-        try:
-            cells.get(r0, 5).put_value(float(ppr))
-        except Exception:
-            cells.get(r0, 5).put_value(ppr)
-
-    rng_cnt  = wb.worksheets.get_range_by_name("Count")
-    rng_prov = wb.worksheets.get_range_by_name("ProvidePrice")
-    rng_fp   = wb.worksheets.get_range_by_name("FinalPrice")
-
-    if len(items) > 0 and rng_fp is not None:
+    with timed("insert_rows"):
+        insert_like_copied_cells(ws, template_row, first_insert_row, extra)
+
+    # 項次 / 產品 / 說明 / 數量 / 單價 / 優惠單價 一次寫入
+    with timed("write_rows"):
+        put_item_rows(ws, item_rows(items), template_row - 1)
+
+    if index is not None:
+        # 欄位與總價位置都來自版面索引（總價在插入列之下時要往下位移）
+        cnt_col_1  = index["items"]["count_col"] + 1
+        prov_col_1 = index["items"]["provide_col"] + 1
+        c = _name_cell(wb, "FinalPrice", index, moved=(first_insert_row - 1, extra))
+    else:
+        rng_cnt  = wb.worksheets.get_range_by_name("Count")
+        rng_prov = wb.worksheets.get_range_by_name("ProvidePrice")
+        rng_fp   = wb.worksheets.get_range_by_name("FinalPrice")
+        cnt_col_1  = (rng_cnt.first_column + 1)  if rng_cnt  else 4
+        prov_col_1 = (rng_prov.first_column + 1) if rng_prov else 6
+        c = ws.cells.get(rng_fp.first_row, rng_fp.first_column) if rng_fp is not None else None
+
+    if len(items) > 0 and c is not None:
         start_row_1 = template_row
         end_row_1   = template_row + len(items) - 1
-        cnt_col_1   = (rng_cnt.first_column + 1)  if rng_cnt  else 4
-        prov_col_1  = (rng_prov.first_column + 1) if rng_prov else 6
-        c = ws.cells.get(rng_fp.first_row, rng_fp.first_column)
-        c.r1c1_formula = (
-            f"=SUMPRODUCT(R{start_row_1}C{cnt_col_1}:R{end_row_1}C{cnt_col_1},"
-            f"R{start_row_1}C{prov_col_1}:R{end_row_1}C{prov_col_1})"
+        cnt_col = ac.CellsHelper.column_index_to_name(cnt_col_1 - 1)
+        prov_col = ac.CellsHelper.column_index_to_name(prov_col_1 - 1)
+        # 公式留給 Excel 使用者；快取值直接用 Python 算好的總價填入，不必整本重算
+        c.set_formula(
+            f"=SUMPRODUCT({cnt_col}{start_row_1}:{cnt_col}{end_row_1},"
+            f"{prov_col}{start_row_1}:{prov_col}{end_row_1})",
+            compute_final_price(items),
         )
-        wb.calculate_formula()
-        print(f"[WRITE-TOTAL-FORMULA] FinalPrice = {c.r1c1_formula}")
-    elif rng_fp is not None and len(items) == 0:
-        ws.cells.get(rng_fp.first_row, rng_fp.first_column).put_value(0)
+        if recalc:
+            wb.calculate_formula()
+        log_event("write_total_formula", formula=c.r1c1_formula)
+    elif c is not None and len(items) == 0:
+        c.put_value(0)
     else:
-        print("[WARN] 找不到 Named Range: FinalPrice（略過公式寫入）")
+        log_event("write_named_skipped", level="warn", missing=["FinalPrice"], failed={})
+
+# ---------------- 計算：Python 端總價 + 只重算受影響的公式鏈 ----------------
+CALC_MODES = ("python", "chain", "full")
+
+def compute_final_price(items: List[Dict[str, str]]) -> float:
+    """與 SUMPRODUCT(數量, 優惠單價) 相同：非數字視為 0。"""
+    total = 0.0
+    for row in item_rows(items):
+        cnt, ppr = row[3], row[5]
+        if isinstance(cnt, (int, float)) and isinstance(ppr, (int, float)):
+            total += cnt * ppr
+    return total
+
+def recalc_dependents(wb: ac.Workbook, names: List[str], index: Dict[str, Any] | None = None,
+                      moved: Tuple[int, int] | None = None) -> int:
+    """
+    只重算引用到這些命名範圍的公式（含間接引用），回傳重算的儲存格數。
+    get_dependents(True) 只回傳直接引用（True 是「含其他工作表」），所以這裡自己往下走完整條鏈，
+    再依引用關係排成拓撲順序：每格都在它引用的公式格算完之後才算。
+    """
+    opts = ac.CalculationOptions()
+    cells: Dict[Tuple[int, int, int], Any] = {}
+    edges: Dict[Tuple[int, int, int], set] = {}  # 公式格 -> 直接引用它的公式格
+    pending = [c for c in (_name_cell(wb, n, index, moved) for n in names) if c is not None]
+    parents: List[Tuple[int, int, int] | None] = [None] * len(pending)
+    while pending:
+        cell, parent = pending.pop(), parents.pop()
+        for dep in cell.get_dependents(True) or []:
+            key = (dep.worksheet.index, dep.row, dep.column)
+            if parent is not None:
+                edges[parent].add(key)
+            if key not in cells:
+                cells[key] = dep
+                edges[key] = set()
+                pending.append(dep)
+                parents.append(key)
+
+    # Kahn 拓撲排序；循環參照的格子最後照發現順序補算
+    indeg = {k: 0 for k in cells}
+    for k, deps in edges.items():
+        for d in deps:
+            indeg[d] += 1
+    order = []
+    ready = [k for k, n in indeg.items() if n == 0]
+    while ready:
+        k = ready.pop()
+        order.append(k)
+        for d in edges.get(k, []):
+            indeg[d] -= 1
+            if indeg[d] == 0:
+                ready.append(d)
+    done = set(order)
+    order.extend(k for k in cells if k not in done)
+    for k in order:
+        cells[k].calculate(opts)
+    return len(order)
+
+def calculate_quote(wb: ac.Workbook, calc_mode: str, written_names: List[str],
+                    index: Dict[str, Any] | None = None, moved: Tuple[int, int] | None = None):
+    """
+    calc_mode：
+      python : 只用 Python 算好的 FinalPrice 快取值（最快；範本若有其他依賴公式不會更新）
+      chain  : 另外重算依賴已寫入命名範圍（含 FinalPrice）的公式鏈（預設）
+      full   : 整本 wb.calculate_formula()（舊行為）
+    """
+    if calc_mode == "full":
+        wb.calculate_formula()
+    elif calc_mode == "chain":
+        n = recalc_dependents(wb, written_names, index, moved)
+        log_event("calc", mode=calc_mode, cells=n)
+    elif calc_mode != "python":
+        raise ValueError(f"不支援的 calc_mode：{calc_mode}（{' / '.join(CALC_MODES)}）")
 
 # ---------------- PDF 匯出：A) Aspose（可能有紅字） ----------------
-def export_sheet_to_pdf_aspose(wb: ac.Workbook, sheet_name: str | None, pdf_base_path: str) -> str:
+def export_sheet_to_pdf_aspose(wb: ac.Workbook, sheet_name: str | None, pdf_base_path: str,
+                               recalc: bool = True, strip_watermark: bool = True) -> str:
+    """strip_watermark=True 時在記憶體內去掉評估版紅字後才寫檔（不另存 _clean.pdf）。"""
     base = Path(pdf_base_path).resolve()
     base.parent.mkdir(parents=True, exist_ok=True)
     ts = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -208,43 +443,47 @@ def export_sheet_to_pdf_aspose(wb: ac.Workbook, sheet_name: str | None, pdf_base
     if default_font:
         opt.default_font = default_font
 
-    wb.calculate_formula()
-    wb.save(str(out_pdf), opt)
-    print(f"[PDF/Aspose] 已輸出：{out_pdf}（注意：若未授權，PDF 上方會有紅字）")
+    if recalc:
+        wb.calculate_formula()
+    with timed("aspose_pdf_save", "aspose") as rec:
+        buf = io.BytesIO()
+        wb.save(buf, opt)
+        data = buf.getvalue()
+        rec["bytes"] = len(data)
+    if strip_watermark or PDF_FONT_SUBSET:
+        with timed("watermark", "aspose"):
+            data = strip_watermark_bytes(data, subset_fonts=PDF_FONT_SUBSET) if strip_watermark \
+                else subset_pdf_fonts(data)
+    out_pdf.write_bytes(data)
+    # watermark=False 時若未授權，PDF 上方會有評估版紅字
+    log_event("pdf_written", engine="aspose", path=str(out_pdf), watermark_stripped=strip_watermark)
     return str(out_pdf)
 
 # ---------------- PDF 匯出：B) LibreOffice（無紅字） ----------------
-def find_soffice(explicit_path: str | None = None) -> str | None:
-    if explicit_path:
-        p = Path(explicit_path)
-        return str(p) if p.exists() else None
-    p = shutil.which("soffice")
-    if p:
-        return p
-    candidates = [
-        r"C:\Program Files\LibreOffice\program\soffice.exe",
-        r"C:\Program Files (x86)\LibreOffice\program\soffice.exe",
-        "/usr/bin/soffice", "/usr/lib/libreoffice/program/soffice", "/snap/bin/libreoffice"
-    ]
-    for c in candidates:
-        if Path(c).exists():
-            return c
-    return None
-
-def save_single_sheet_temp_xlsx(wb: ac.Workbook, sheet_name: str | None, tmp_dir: Path) -> Path:
-    if not sheet_name:
-        raise RuntimeError("未指定 sheet_name，請在上層決定來源 xlsx。")
+def serialize_single_sheet(wb: ac.Workbook, sheet_name: str) -> Tuple[str, bytes]:
+    """把指定工作表單獨複製成一本 Workbook 並序列化到記憶體，回傳 (工作表名稱, xlsx bytes)。"""
     src_ws = _get_ws(wb, sheet_name)
     tmp_wb = ac.Workbook()
     tmp_ws = tmp_wb.worksheets[0]
     tmp_ws.copy(src_ws)
     tmp_ws.name = src_ws.name
-    tmp_xlsx = tmp_dir / f"__single_sheet_{src_ws.name}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.xlsx"
-    tmp_wb.save(str(tmp_xlsx))
+    return src_ws.name, serialize_book(tmp_wb)
+
+def save_single_sheet_temp_xlsx(wb: ac.Workbook, sheet_name: str | None, tmp_dir: Path) -> Path:
+    if not sheet_name:
+        raise RuntimeError("未指定 sheet_name，請在上層決定來源 xlsx。")
+    ws_name, data = serialize_single_sheet(wb, sheet_name)
+    tmp_xlsx = tmp_dir / f"__single_sheet_{ws_name}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.xlsx"
+    tmp_xlsx.write_bytes(data)
     return tmp_xlsx
 
 def export_sheet_to_pdf_libreoffice(wb: ac.Workbook, xlsx_out: str, sheet_name: str | None,
-                                    pdf_base_path: str, soffice_path: str | None) -> str:
+                                    pdf_base_path: str, soffice_path: str | None,
+                                    recalc: bool = True, save_xlsx: bool = True) -> str:
+    """
+    recalc / save_xlsx 預設維持舊行為（重算並覆寫 xlsx_out）；
+    make_quote 會先算好公式、寫好 xlsx_out 再呼叫，兩者皆傳 False 避免重複。
+    """
     base = Path(pdf_base_path).resolve()
     base.parent.mkdir(parents=True, exist_ok=True)
     ts = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -252,44 +491,172 @@ def export_sheet_to_pdf_libreoffice(wb: ac.Workbook, xlsx_out: str, sheet_name:
 
     soffice = find_soffice(soffice_path)
     if not soffice:
-        print("[WARN] 找不到 LibreOffice (soffice)。改用 Aspose 匯出（會有紅字）。", file=sys.stderr)
-        return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path)
+        log_event("pdf_fallback", level="warn", path="soffice_missing", to="aspose")
+        FALLBACKS.inc(path="soffice_missing", to="aspose")
+        return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path, recalc=recalc)
 
     with tempfile.TemporaryDirectory() as td:
         td_path = Path(td)
-        if sheet_name:
+        if recalc:
+            wb.calculate_formula()
+        if save_xlsx:
+            wb.save(xlsx_out)
+
+        # 只有一張工作表時，已寫好的 xlsx_out 就是轉檔來源，不必再另存單頁副本
+        if sheet_name and wb.worksheets.count > 1:
             src_xlsx = save_single_sheet_temp_xlsx(wb, sheet_name, td_path)
         else:
             src_xlsx = Path(xlsx_out)
 
-        wb.calculate_formula()
-        wb.save(xlsx_out)
+        produced = td_path / (Path(src_xlsx).stem + ".pdf")
 
-        cmd = [
-            soffice, "--headless", "--nologo", "--nodefault",
+        # 優先交給常駐轉檔池（SOFFICE_POOL_SIZE>0 時），失敗再走一次性 subprocess
+        pool = get_pool(soffice)
+        if pool is not None:
+            try:
+                with timed("soffice", "pool"):
+                    pool.convert(str(src_xlsx), str(produced))
+                shutil.move(str(produced), str(final_pdf))
+                log_event("pdf_written", engine="libreoffice", via="pool", path=str(final_pdf))
+                return str(final_pdf)
+            except Exception as e:
+                log_event("pdf_fallback", level="warn", path="soffice_pool", to="subprocess", error=str(e))
+                FALLBACKS.inc(path="soffice_pool", to="subprocess")
+
+        # 其次：微批次（SOFFICE_BATCH_WINDOW_MS>0 時），跟同時間的其他請求合併成一次 soffice
+        batcher = get_batcher(soffice)
+        if batcher is not None:
+            try:
+                with timed("soffice", "batch"):
+                    batcher.convert(str(src_xlsx), str(final_pdf))
+                log_event("pdf_written", engine="libreoffice", via="batch", path=str(final_pdf))
+                return str(final_pdf)
+            except Exception as e:
+                log_event("pdf_fallback", level="warn", path="soffice_batch", to="subprocess", error=str(e))
+                FALLBACKS.inc(path="soffice_batch", to="subprocess")
+
+        args = [
+            "--headless", "--nologo", "--nodefault",
             "--nolockcheck", "--nofirststartwizard",
             "--convert-to", "pdf:calc_pdf_Export",
             "--outdir", str(td_path),
             str(src_xlsx)
         ]
-        print(f"[PDF/LibreOffice] 執行：{' '.join(cmd)}")
+        log_event("soffice_run", cmd=[soffice, *args])
+        # 經排程器執行：獨立 profile、同時執行上限、排隊逾時（見 soffice_scheduler.py）
         try:
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            print(f"[ERROR] soffice 轉檔失敗：{e.stderr.decode(errors='ignore')}", file=sys.stderr)
-            print("[WARN] 回退用 Aspose 匯出（會有紅字）。", file=sys.stderr)
-            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path)
+            with timed("soffice", "subprocess"):
+                proc = get_scheduler(soffice).run(args)
+        except SofficeBusy as e:
+            log_event("pdf_fallback", level="warn", path="soffice_busy", to="aspose", error=str(e))
+            FALLBACKS.inc(path="soffice_busy", to="aspose")
+            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path, recalc=False)
+        except subprocess.TimeoutExpired:
+            log_event("pdf_fallback", level="warn", path="soffice_timeout", to="aspose")
+            FALLBACKS.inc(path="soffice_timeout", to="aspose")
+            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path, recalc=False)
+        if proc.returncode != 0:
+            log_event("pdf_fallback", level="error", path="soffice_error", to="aspose",
+                      returncode=proc.returncode, stderr=proc.stderr.decode(errors="ignore")[-2000:])
+            FALLBACKS.inc(path="soffice_error", to="aspose")
+            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path, recalc=False)
 
-        produced = td_path / (Path(src_xlsx).stem + ".pdf")
         if not produced.exists():
-            print("[ERROR] 未找到 LibreOffice 產生的 PDF。回退 Aspose。", file=sys.stderr)
-            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path)
+            log_event("pdf_fallback", level="error", path="soffice_no_output", to="aspose")
+            FALLBACKS.inc(path="soffice_no_output", to="aspose")
+            return export_sheet_to_pdf_aspose(wb, sheet_name, pdf_base_path, recalc=False)
 
         shutil.move(str(produced), str(final_pdf))
-        print(f"[PDF/LibreOffice] 已輸出：{final_pdf}")
+        log_event("pdf_written", engine="libreoffice", via="subprocess", path=str(final_pdf))
         return str(final_pdf)
 
+# ---------------- PDF 匯出：C) 原生 / 疊印（PyMuPDF 直接排版，不經試算表） ----------------
+def export_quote_pdf_native(xlsx_in: str, sheet_name: str | None, sets: Dict[str, str],
+                            items: List[Dict[str, str]], pdf_base_path: str,
+                            template_row: int = 11, overlay: bool = False) -> str:
+    base = Path(pdf_base_path).resolve()
+    base.parent.mkdir(parents=True, exist_ok=True)
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    out_pdf = base.with_name(f"{base.stem}_{ts}{base.suffix}")
+
+    layout = load_layout(xlsx_in, sheet_name)  # 範本版面只抽一次（檔案更新才重抽）
+    render = render_quote_pdf_overlay if overlay else render_quote_pdf
+    render(layout, sets, item_rows(items), compute_final_price(items), str(out_pdf), template_row=template_row)
+    log_event("pdf_written", engine="overlay" if overlay else "native", path=str(out_pdf))
+    return str(out_pdf)
+
 # ---------------- 核心：可呼叫的函式 ----------------
+def build_quote_workbook(
+    xlsx_in: str,
+    *,
+    sheet: str | None,
+    sets: Dict[str, str],
+    items: List[Dict[str, str]],
+    template_row: int = 11,
+    first_insert_row: int = 12,
+    calc_mode: str = "chain",
+    report: StageReport | None = None,
+) -> ac.Workbook:
+    """讀範本 → 寫入命名儲存格與明細 → 計算公式，回傳填好的 Workbook（make_quote / 按需產生 xlsx 共用）。"""
+    report = report if report is not None else StageReport()
+
+    # 1) 讀範本（記憶體快取的乾淨副本，直接在上面操作）
+    with report.stage("load"):
+        wb = open_book(xlsx_in)
+        index = load_index(xlsx_in, sheet)  # 命名範圍座標 / 工作表索引都預先算好
+
+    # 2) 填值：抬頭命名範圍 + 明細（此階段不重算公式）
+    moved = (first_insert_row - 1, max(0, len(items) - 1)) if items else None
+    with report.stage("fill"):
+        if sets:
+            write_named_values(wb, sets, index)
+        if items:
+            target_sheet_name = sheet if sheet else wb.worksheets[0].name
+            write_items_and_total(
+                wb,
+                sheet_name=target_sheet_name,
+                items=items,
+                template_row=template_row,
+                first_insert_row=first_insert_row,
+                recalc=False,
+                index=index,
+            )
+
+    # 3) 公式只算一次，xlsx 與 PDF 共用結果（FinalPrice 已在 Python 端算好）
+    with report.stage("calculate"):
+        calculate_quote(wb, calc_mode, list(sets) + (["FinalPrice"] if items else []), index, moved)
+    return wb
+
+def make_quote_xlsx(
+    xlsx_in: str,
+    xlsx_out: str,
+    *,
+    sheet: str | None = None,
+    sets: Dict[str, str] | None = None,
+    items: List[Dict[str, str]] | None = None,
+    template_row: int = 11,
+    first_insert_row: int = 12,
+    calc_mode: str = "chain",
+    report: StageReport | None = None,
+) -> str:
+    """只產生 xlsx（不出 PDF），直接寫到 xlsx_out：先寫暫存檔再 rename，下載端不會讀到寫一半的檔案。"""
+    report = report if report is not None else StageReport()
+    wb = build_quote_workbook(
+        xlsx_in, sheet=sheet, sets=sets or {}, items=items or [], template_row=template_row,
+        first_insert_row=first_insert_row, calc_mode=calc_mode, report=report,
+    )
+    with report.stage("serialize_xlsx") as rec:
+        data = serialize_book(wb)
+        rec["bytes"] = len(data)
+    with report.stage("write_xlsx") as rec:
+        tmp = Path(xlsx_out).with_name(f".{Path(xlsx_out).name}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, xlsx_out)
+        rec["bytes"] = len(data)
+    log_event("xlsx_done", path=xlsx_out)
+    report.log_summary()
+    return xlsx_out
+
 def make_quote(
     xlsx_in: str,
     name: str | None = None,
@@ -303,7 +670,10 @@ def make_quote(
     first_insert_row: int = 12,
     pdf_engine: str = "libreoffice",
     soffice_path: str | None = None,
-) -> Tuple[str, str]:
+    calc_mode: str = "chain",
+    want_xlsx: bool = True,
+    report: StageReport | None = None,
+) -> Tuple[str | None, str]:
     """
     產生報價單：寫入命名儲存格、插入 item 列（等同 Insert Copied Cells），並輸出單一分頁 PDF（無紅字：libreoffice）。
 
@@ -317,8 +687,12 @@ def make_quote(
       items          : 明細列 list[dict]，鍵包含 Product/Desc/Count/Price/ProvidePrice
       template_row   : 樣板列（預設 11）
       first_insert_row: 首筆插入列（預設 12）
-      pdf_engine     : "libreoffice"（無紅字，預設）或 "aspose"
+      pdf_engine     : "libreoffice"（無紅字，預設）、"aspose"、"native"（PyMuPDF 直接排版）
+                       或 "overlay"（快取靜態底圖 + 蓋動態文字）
       soffice_path   : 指定 soffice 路徑（找不到 PATH 時可用）
+      calc_mode      : "chain"（預設，只重算受影響公式）、"python"（只填 Python 算的總價）或 "full"（整本重算）
+      want_xlsx      : 是否產生 xlsx；僅 native / overlay 引擎可設 False（此時回傳的 xlsx 路徑為 None）
+      report         : 傳入 StageReport 可取回各階段耗時與寫出 bytes（不傳則只印出）
 
     回傳：
       (xlsx_out_path, pdf_out_path)
@@ -326,58 +700,66 @@ def make_quote(
     xlsx_out_final, pdf_base = decide_outputs(xlsx_in, name, xlsx_out, pdf_out)
     updates = sets or {}
     items_list = items or []
+    engine = pdf_engine.lower()
+    report = report if report is not None else StageReport()
+    report.engine = report.engine or engine
+
+    # 0) 原生 / 疊印引擎：PDF 直接從範本版面畫出，不需要 Workbook
+    direct_pdf = engine in ("native", "overlay")
+    if direct_pdf:
+        with report.stage("pdf") as rec:
+            pdf_out_final = export_quote_pdf_native(
+                xlsx_in, sheet, updates, items_list, pdf_base,
+                template_row=template_row, overlay=(engine == "overlay"),
+            )
+            rec["bytes"] = Path(pdf_out_final).stat().st_size
+        log_event("pdf_done", path=pdf_out_final)
+        if not want_xlsx:
+            report.log_summary()
+            return None, pdf_out_final
+    elif not want_xlsx:
+        raise ValueError("want_xlsx=False 只支援 pdf_engine=\"native\" 或 \"overlay\"")
+
+    # 1)~3) 讀範本、填值、計算
+    wb = build_quote_workbook(
+        xlsx_in, sheet=sheet, sets=updates, items=items_list, template_row=template_row,
+        first_insert_row=first_insert_row, calc_mode=calc_mode, report=report,
+    )
 
-    # 讀原檔
-    wb = open_book(xlsx_in)
-
-    # 存一份工作副本（若同名被占用就加時間戳）
-    dst = Path(xlsx_out_final).resolve()
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    candidate = dst
-    while True:
-        try:
-            wb.save(str(candidate))
-            break
-        except Exception:
-            ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-            candidate = dst.with_name(f"{dst.stem}_{ts}{dst.suffix}")
-    xlsx_out_final = str(candidate)
-
-    # 對副本操作
-    wb = ac.Workbook(xlsx_out_final)
-
-    # 抬頭命名範圍
-    if updates:
-        write_named_values(wb, updates)
-
-    # 明細
-    if items_list:
-        target_sheet_name = sheet if sheet else wb.worksheets[0].name
-        write_items_and_total(
-            wb,
-            sheet_name=target_sheet_name,
-            items=items_list,
-            template_row=template_row,
-            first_insert_row=first_insert_row,
-        )
-
-    # 存檔
-    wb.save(xlsx_out_final)
-    print(f"[DONE] Excel 已完成：{xlsx_out_final}")
-
-    # 匯出 PDF
-    if pdf_engine.lower() == "libreoffice":
-        pdf_out_final = export_sheet_to_pdf_libreoffice(
-            wb, xlsx_out_final, sheet if sheet else None, pdf_base, soffice_path
-        )
-    else:
-        pdf_out_final = export_sheet_to_pdf_aspose(wb, sheet if sheet else None, pdf_base)
+    # 4) xlsx 只序列化一次，寫檔（若同名被占用就加時間戳）
+    with report.stage("serialize_xlsx") as rec:
+        xlsx_bytes = serialize_book(wb)
+        rec["bytes"] = len(xlsx_bytes)
+    with report.stage("write_xlsx") as rec:
+        xlsx_out_final = write_bytes_unique(xlsx_bytes, xlsx_out_final)
+        rec["bytes"] = len(xlsx_bytes)
+    log_event("xlsx_done", path=xlsx_out_final)
+
+    # 5) 匯出 PDF（已寫好的 xlsx 直接當 LibreOffice 來源，不再重存）
+    if direct_pdf:
+        report.log_summary()
+        return xlsx_out_final, pdf_out_final
+    with report.stage("pdf") as rec:
+        if engine == "libreoffice":
+            pdf_out_final = export_sheet_to_pdf_libreoffice(
+                wb, xlsx_out_final, sheet if sheet else None, pdf_base, soffice_path,
+                recalc=False, save_xlsx=False,
+            )
+        else:
+            pdf_out_final = export_sheet_to_pdf_aspose(wb, sheet if sheet else None, pdf_base, recalc=False)
+        rec["bytes"] = Path(pdf_out_final).stat().st_size
 
-    print(f"[DONE] PDF 已完成：{pdf_out_final}")
+    log_event("pdf_done", path=pdf_out_final)
+    report.log_summary()
     return xlsx_out_final, pdf_out_final
 
 # ---------------- CLI 包裝（可選，用於相容原用法） ----------------
 def main():
+    # 子命令：python make_quote_linux.py batch ...（見 quote_batch.py）
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from quote_batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+
     ap = argparse.ArgumentParser(description="Excel 報價單產生器（Aspose 生成 + LibreOffice 無紅字轉 PDF）")
     ap.add_argument("--in", dest="xlsx_in", required=True)
     ap.add_argument("--out", dest="xlsx_out", default=None)
@@ -389,8 +771,13 @@ def main():
     ap.add_argument("--first-insert-row", type=int, default=12, help="首筆插入列（預設 12）")
     ap.add_argument("--set", dest="sets", action="append", default=[])
     ap.add_argument("--item", dest="items", action="append", default=[])
-    ap.add_argument("--pdf-engine", choices=["libreoffice", "aspose"], default="libreoffice",
-                   help="PDF 轉檔引擎：libreoffice（無紅字，預設）或 aspose（可能有紅字）")
+    ap.add_argument("--pdf-engine", choices=["libreoffice", "aspose", "native", "overlay"], default="libreoffice",
+                   help="PDF 轉檔引擎：libreoffice（無紅字，預設）、aspose（可能有紅字）、native（PyMuPDF 直接排版）"
+                        "或 overlay（快取底圖 + 蓋字）")
+    ap.add_argument("--no-xlsx", dest="want_xlsx", action="store_false",
+                   help="不產生 Excel（僅 --pdf-engine native / overlay 可用）")
+    ap.add_argument("--calc-mode", choices=list(CALC_MODES), default="chain",
+                   help="公式計算方式：chain（預設，只重算受影響公式）、python（只填總價）、full（整本重算）")
     ap.add_argument("--soffice", dest="soffice_path", default=None,
                    help="soffice 的路徑（找不到時可手動指定，例如 C:\\Program Files\\LibreOffice\\program\\soffice.exe）")
     args = ap.parse_args()
@@ -411,6 +798,8 @@ def main():
         first_insert_row=args.first_insert_row,
         pdf_engine=args.pdf_engine,
         soffice_path=args.soffice_path,
+        calc_mode=args.calc_mode,
+        want_xlsx=args.want_xlsx,
     )
 
 if __name__ == "__main__":
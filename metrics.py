@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+# 內建量測：各階段耗時 / 排隊等待 / 寫出 bytes 的直方圖、引擎回退次數等計數器，
+# 以 Prometheus 文字格式輸出（app.py 的 /metrics）；另提供單行 JSON 的結構化紀錄 log_event()。
+# 只用標準函式庫，不需要 prometheus_client。
+#
+# 設定（環境變數）：
+#   QUOTE_LOG_FORMAT : json（預設，每筆事件一行 JSON）或 text（一行 key=value）
+#
+# 函式入口：
+#   with timed("parse"): ...                       # 記到 quote_stage_seconds{stage="parse"}
+#   observe_stage(stage, seconds, nbytes=0, engine="")
+#   FALLBACKS.inc(path="soffice_pool", to="subprocess")
+#   log_event("quote_done", request=..., total_ms=...)
+#   with request_context(request_id): ...           # 期間的 log_event 自動帶 request 欄位
+#   render() -> str                                 # Prometheus exposition
+#   drain() -> dict / merge(dict)                   # process 模式：子程序的計數送回主程序合併
+
+import contextvars, json, math, os, sys, threading, time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+QUOTE_LOG_FORMAT = os.getenv("QUOTE_LOG_FORMAT", "json")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def _esc(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+REGISTRY: List["_Metric"] = []
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+class Gauge(_Metric):
+    """值由 callback 在輸出時讀取（例如佇列深度），不必到處呼叫 set()。"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn: Callable[[], float] | None = None):
+        super().__init__(name, help_text)
+        self.fn = fn
+
+    def collect(self) -> List[str]:
+        if self.fn is None:
+            return []
+        try:
+            value = float(self.fn())
+        except Exception:
+            return []
+        return self.header() + [f"{self.name} {_fmt(value)}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labels -> ([各 bucket 計數], sum, count)
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        k = self._key(labels)
+        with self._lock:
+            ent = self._values.get(k)
+            if ent is None:
+                ent = self._values[k] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    ent[0][i] += 1
+                    break
+            ent[1] += value
+            ent[2] += 1
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        out = self.header()
+        for k, (counts, total, n) in items:
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                le = 'le="' + _fmt(b) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {n}")
+        return out
+
+# ---------------- 報價流程用到的指標 ----------------
+STAGE_SECONDS = Histogram("quote_stage_seconds", "Latency of each quote pipeline stage", ("stage", "engine"))
+STAGE_BYTES = Histogram("quote_stage_bytes", "Bytes written by a quote pipeline stage", ("stage", "engine"),
+                        buckets=BYTES_BUCKETS)
+BYTES_WRITTEN = Counter("quote_bytes_written_total", "Total bytes written by quote stages", ("stage",))
+QUEUE_WAIT = Histogram("quote_queue_wait_seconds", "Time a quote job waited in the queue before running")
+JOB_SECONDS = Histogram("quote_job_seconds", "Run time of a quote job", ("status",))
+FALLBACKS = Counter("quote_engine_fallbacks_total", "PDF engine fallbacks (path -> to)", ("path", "to"))
+REQUESTS = Counter("quote_requests_total", "LINE text messages handled, by outcome", ("outcome",))
+
+def observe_stage(stage: str, seconds: float, nbytes: int = 0, engine: str = ""):
+    STAGE_SECONDS.observe(seconds, stage=stage, engine=engine)
+    if nbytes:
+        STAGE_BYTES.observe(nbytes, stage=stage, engine=engine)
+        BYTES_WRITTEN.inc(nbytes, stage=stage)
+
+@contextmanager
+def timed(stage: str, engine: str = ""):
+    """記錄一段程式碼的耗時；yield 的 dict 可填 bytes。"""
+    rec = {"stage": stage, "seconds": 0.0, "bytes": 0}
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        rec["seconds"] = time.perf_counter() - t0
+        observe_stage(stage, rec["seconds"], rec["bytes"], engine)
+
+_request: contextvars.ContextVar[str | None] = contextvars.ContextVar("quote_request", default=None)
+
+@contextmanager
+def request_context(request_id: str | None):
+    """這段期間（同一執行緒 / coroutine）的 log_event 沒給 request 時自動補上。"""
+    token = _request.set(request_id)
+    try:
+        yield
+    finally:
+        _request.reset(token)
+
+def log_event(event: str, **fields):
+    """結構化紀錄：一行 JSON（QUOTE_LOG_FORMAT=text 時為 key=value）。"""
+    if "request" not in fields and _request.get() is not None:
+        fields["request"] = _request.get()
+    fields = {"ts": round(time.time(), 3), "event": event, **fields}
+    if QUOTE_LOG_FORMAT == "text":
+        print(" ".join(f"{k}={v}" for k, v in fields.items()), file=sys.stderr)
+    else:
+        print(json.dumps(fields, ensure_ascii=False, default=str), file=sys.stderr)
+
+# ---------------- 跨程序合併（process 模式） ----------------
+_merge_lock = threading.Lock()
+
+def drain() -> Dict[str, Dict[str, Any]]:
+    """
+    取出並清空本程序 Counter / Histogram 目前累積的值（子程序每件工作結束後送回主程序）。
+    連同指標定義一起送：只在 worker 裡載入的模組（例如 soffice_scheduler）主程序也能補建。
+    """
+    out: Dict[str, Dict[str, Any]] = {}
+    for m in REGISTRY:
+        if isinstance(m, (Counter, Histogram)):
+            with m._lock:
+                if m._values:
+                    out[m.name] = {"kind": m.kind, "help": m.help, "labels": m.labelnames,
+                                   "buckets": getattr(m, "buckets", None), "values": m._values}
+                    m._values = {}
+    return out
+
+def merge(delta: Dict[str, Dict[str, Any]] | None):
+    """把 drain() 的結果加進本程序同名的指標；本程序沒有的照送來的定義建立。"""
+    if not delta:
+        return
+    for name, spec in delta.items():
+        with _merge_lock:
+            m = next((x for x in REGISTRY if x.name == name), None)
+            if m is None:
+                if spec["kind"] == "counter":
+                    m = Counter(name, spec["help"], spec["labels"])
+                else:
+                    m = Histogram(name, spec["help"], spec["labels"], spec["buckets"][:-1])  # 去掉 +Inf
+        with m._lock:
+            for k, v in spec["values"].items():
+                if isinstance(m, Counter):
+                    m._values[k] = m._values.get(k, 0.0) + v
+                elif isinstance(m, Histogram):
+                    ent = m._values.get(k)
+                    if ent is None:
+                        ent = m._values[k] = [[0] * len(m.buckets), 0.0, 0]
+                    ent[0] = [a + b for a, b in zip(ent[0], v[0])]
+                    ent[1] += v[1]
+                    ent[2] += v[2]
+
+def render() -> str:
+    lines: List[str] = []
+    for m in REGISTRY:
+        lines.extend(m.collect())
+    return "\n".join(lines) + "\n"
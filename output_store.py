@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# output_store.py
+# 產出檔案的存放與下載：
+#   - 每個檔案一個不透明的短 token，放在 <root>/<token 前兩碼>/<token>/<原檔名>（分片，目錄不會越長越大）
+#   - 下載網址只有 token（/files/<token>.pdf），客戶名稱只出現在 Content-Disposition 的下載檔名
+#   - TTL 過期與總容量上限（依最後存取時間 LRU）自動刪檔；啟動時掃描既有檔案重建索引
+#   - token 目錄裡以 . 開頭的檔案是附屬資料（例如按需產生 xlsx 的紀錄，見 lazy_xlsx.py），容量一起算
+#   - 下載走 Starlette FileResponse：ETag / Last-Modified、Range（206），另外處理 If-None-Match（304）；
+#     檔案內容由 Starlette 分塊讀出送出（uvicorn 不支援 ASGI pathsend 擴充，沒有零複製）
+#   - .staging 暫存區裡超過 OUTPUT_STAGING_TTL 的殘檔（工作中途當掉留下的）隨 sweep() 一起刪
+#
+# 設定（環境變數）：
+#   OUTPUT_TTL        : 檔案保留秒數（預設 7 天；0 = 不依時間刪）
+#   OUTPUT_MAX_BYTES  : 總容量上限（預設 2 GiB；0 = 不限）
+#   OUTPUT_STAGING_TTL: 暫存檔保留秒數（預設 3600；要比最慢的一件產檔工作還長）
+#
+# 函式入口：
+#   store = OutputStore(root); store.put(src_path) -> 存放後的路徑
+#   store.url_name(stored_path) -> "<token>.pdf"；store.response(request, url_name) -> Response
+
+import json, os, secrets, shutil, threading, time
+from pathlib import Path
+from typing import Any, Dict
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+from metrics import log_event
+
+OUTPUT_TTL = float(os.getenv("OUTPUT_TTL", str(7 * 24 * 3600)))
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(2 * 1024 ** 3)))
+OUTPUT_STAGING_TTL = float(os.getenv("OUTPUT_STAGING_TTL", "3600"))
+_SWEEP_INTERVAL = 60.0  # put() 觸發清理的最短間隔（秒）
+RECORD_NAME = ".quote.json"  # 檔案尚未產生時，記錄它該叫什麼名字、怎麼產生
+
+def _dir_size(d: Path) -> int:
+    return sum(f.stat().st_size for f in d.iterdir() if f.is_file())
+
+class OutputStore:
+    def __init__(self, root: str, ttl: float = OUTPUT_TTL, max_bytes: int = OUTPUT_MAX_BYTES,
+                 staging_ttl: float = OUTPUT_STAGING_TTL):
+        self.root = Path(root).resolve()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.staging_ttl = staging_ttl
+        self.staging_dir = self.root / ".staging"   # make_quote 先寫在這裡，put() 再搬進分片目錄
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        # token -> {"path", "size", "created", "accessed"}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self.evicted = 0
+        self._scan()
+
+    # ---- 索引 ----
+    def _scan(self):
+        """啟動時把磁碟上既有的 <shard>/<token>/<檔案> 讀回索引。"""
+        for shard in self.root.iterdir():
+            if not shard.is_dir() or len(shard.name) != 2 or shard.name.startswith("."):
+                continue
+            for tdir in shard.iterdir():
+                if not tdir.is_dir():
+                    continue
+                files = [f for f in tdir.iterdir() if f.is_file() and not f.name.startswith(".")]
+                record = tdir / RECORD_NAME
+                if files:
+                    path = files[0]
+                elif record.exists():
+                    try:
+                        path = tdir / json.loads(record.read_text(encoding="utf-8"))["download_name"]
+                    except (ValueError, KeyError):
+                        continue
+                else:
+                    continue
+                st = (path if path.exists() else record).stat()
+                size = _dir_size(tdir)
+                self._entries[tdir.name] = {"path": path, "size": size,
+                                            "created": st.st_mtime, "accessed": max(st.st_atime, st.st_mtime)}
+                self._total += size
+
+    def _new_token(self) -> str:
+        while True:
+            token = secrets.token_urlsafe(8)  # 11 碼，URL 安全
+            if token not in self._entries:
+                return token
+
+    # ---- 寫入 ----
+    def put(self, src_path: str, download_name: str | None = None) -> str:
+        """把產出檔搬進分片目錄（同一檔案系統內為 rename），回傳存放後的路徑。"""
+        src = Path(src_path)
+        name = download_name or src.name
+        with self._lock:
+            token = self._new_token()
+            tdir = self.root / token[:2] / token
+            tdir.mkdir(parents=True)
+            self._entries[token] = {"path": tdir / name, "size": 0, "created": time.time(), "accessed": time.time()}
+        dst = tdir / name
+        try:
+            shutil.move(str(src), str(dst))
+        except OSError:
+            with self._lock:
+                self._entries.pop(token, None)
+            shutil.rmtree(tdir, ignore_errors=True)
+            raise
+        size = dst.stat().st_size
+        with self._lock:
+            self._entries[token]["size"] = size
+            self._total += size
+        self.maybe_sweep()
+        return str(dst)
+
+    def reserve(self, download_name: str) -> str:
+        """先配好 token 與路徑，檔案稍後才寫進去（例如按需產生的 xlsx）。回傳預定路徑。"""
+        with self._lock:
+            token = self._new_token()
+            tdir = self.root / token[:2] / token
+            tdir.mkdir(parents=True)
+            self._entries[token] = {"path": tdir / download_name, "size": 0,
+                                    "created": time.time(), "accessed": time.time()}
+        return str(tdir / download_name)
+
+    def commit(self, stored_path: str):
+        """reserve() 的檔案（或附屬資料）寫好 / 刪掉之後呼叫，重新計算該 token 佔用的容量。"""
+        p = Path(stored_path)
+        size = _dir_size(p.parent) if p.parent.is_dir() else 0
+        with self._lock:
+            ent = self._entries.get(p.parent.name)
+            if ent is not None:
+                self._total += size - ent["size"]
+                ent["size"] = size
+        self.maybe_sweep()
+
+    # ---- 淘汰 ----
+    def maybe_sweep(self):
+        if time.monotonic() - self._last_sweep >= _SWEEP_INTERVAL:
+            self.sweep()
+
+    def _sweep_staging(self, now: float) -> int:
+        """暫存區只該有正在產生的檔案；放太久的是工作失敗 / 程序當掉留下的。"""
+        if self.staging_ttl <= 0:
+            return 0
+        n = 0
+        for f in self.staging_dir.iterdir():
+            try:
+                if now - f.stat().st_mtime <= self.staging_ttl:
+                    continue
+                if f.is_dir():
+                    shutil.rmtree(f, ignore_errors=True)
+                else:
+                    f.unlink(missing_ok=True)
+                n += 1
+            except OSError:
+                continue
+        return n
+
+    def sweep(self) -> int:
+        """刪掉過期檔案，再依最後存取時間由舊到新刪到容量以內，並清掉暫存區殘檔。回傳刪除筆數（不含暫存檔）。"""
+        self._last_sweep = time.monotonic()
+        now = time.time()
+        with self._lock:
+            victims = [t for t, e in self._entries.items() if self.ttl > 0 and now - e["created"] > self.ttl]
+            total = self._total - sum(self._entries[t]["size"] for t in victims)
+            if self.max_bytes > 0 and total > self.max_bytes:
+                rest = sorted((e["accessed"], t) for t, e in self._entries.items() if t not in victims)
+                for _, t in rest:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append(t)
+                    total -= self._entries[t]["size"]
+            removed = [(t, self._entries.pop(t)) for t in victims]
+            for _, e in removed:
+                self._total -= e["size"]
+            self.evicted += len(removed)
+        for t, e in removed:
+            shutil.rmtree(e["path"].parent, ignore_errors=True)
+        stale = self._sweep_staging(now)
+        if removed or stale:
+            log_event("store_sweep", removed=len(removed), staging=stale,
+                      total_mib=round(self._total / 1024 ** 2, 1))
+        return len(removed)
+
+    # ---- 查詢 / 下載 ----
+    def exists(self, stored_path: str) -> bool:
+        """token 還在索引裡就算存在（按需產生的 xlsx 可能還沒寫出實體檔）。"""
+        p = Path(stored_path)
+        with self._lock:
+            ent = self._entries.get(p.parent.name)
+            return ent is not None and ent["path"] == p
+
+    @staticmethod
+    def url_name(stored_path: str) -> str:
+        """網址上用的名字：token + 副檔名（不含客戶名稱）。"""
+        p = Path(stored_path)
+        return f"{p.parent.name}{p.suffix}"
+
+    def lookup(self, url_name: str) -> Path | None:
+        token = url_name.split(".", 1)[0]
+        with self._lock:
+            ent = self._entries.get(token)
+            if ent is None:
+                return None
+            ent["accessed"] = time.time()
+            return ent["path"]
+
+    def response(self, request: Request, url_name: str) -> Response:
+        path = self.lookup(url_name)
+        if path is None or not path.is_file():
+            raise HTTPException(status_code=404, detail="file not found")
+        resp = FileResponse(
+            path,
+            stat_result=path.stat(),
+            headers={
+                "Content-Disposition": f"inline; filename*=UTF-8''{quote(path.name)}",
+                "Cache-Control": "private, max-age=3600",
+                "Accept-Ranges": "bytes",
+            },
+        )
+        inm = request.headers.get("if-none-match")
+        if inm and resp.headers["etag"] in [t.strip().removeprefix("W/") for t in inm.split(",")]:
+            return Response(status_code=304, headers={k: resp.headers[k] for k in ("etag", "cache-control")})
+        return resp
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"files": len(self._entries), "bytes": self._total, "evicted": self.evicted,
+                    "ttl": self.ttl, "max_bytes": self.max_bytes}
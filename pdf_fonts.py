@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# pdf_fonts.py
+# Aspose 匯出 PDF 的字型設定：每個 process 只設定一次，且只把需要的字型檔交給 Aspose。
+#
+# 原本每次匯出都 FontConfigs.set_font_folders(["/usr/share/fonts", ...], True)，
+# Aspose 會遞迴解析資料夾內所有字型（映像檔裡光 fonts-noto-cjk 就很大），每個請求重來一次。
+# 現在：
+#   - 依檔名樣式（PDF_FONT_PATTERNS）從字型資料夾挑出中文 + 少量西文備援字型檔，
+#     以 FileFontSource 逐檔設定，Aspose 不再掃整個資料夾
+#   - 挑選結果寫進 JSON 快取（PDF_FONT_CACHE），下次啟動直接用；字型資料夾底下任何一層目錄
+#     有變動（mtime：新增 / 刪除字型或子資料夾）才重新挑選（只 stat 目錄，不讀字型檔）
+#   - 設定 PDF_FONT_BUNDLE（一個只放預先子集化 / 精選字型的資料夾）時只用它，完全不掃系統字型
+#
+# 設定（環境變數）：
+#   PDF_FONT_DIRS     : 字型資料夾，以 os.pathsep 分隔（預設依作業系統）
+#   PDF_FONT_PATTERNS : 檔名樣式，逗號分隔（fnmatch，不分大小寫）
+#   PDF_FONT_CACHE    : 挑選結果快取檔（預設 ~/.cache/quotation/pdf_fonts.json；空字串 = 不快取）
+#   PDF_FONT_BUNDLE   : 精選字型資料夾（可選）
+#   PDF_DEFAULT_FONT  : 找不到字時的預設字型名稱（預設依作業系統）
+#   PDF_FONT_SUBSET   : 1 = Aspose 產出的 PDF 再用 PyMuPDF 把內嵌字型子集化（檔案較小；預設 0）
+#
+# 函式入口：
+#   configure_fonts() -> 預設字型名稱或 None   # 可重複呼叫，只有第一次真的設定
+#   resolve_font_files(dirs, patterns) -> [字型檔路徑]
+
+import fnmatch, json, os, platform, threading, time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from metrics import log_event
+
+_SYSTEM = platform.system()
+if _SYSTEM == "Windows":
+    _DEFAULT_DIRS = [r"C:\Windows\Fonts"]
+    _DEFAULT_FONT = "Microsoft JhengHei"
+elif _SYSTEM == "Darwin":
+    _DEFAULT_DIRS = ["/System/Library/Fonts", "/Library/Fonts", os.path.expanduser("~/Library/Fonts")]
+    _DEFAULT_FONT = "PingFang TC"
+else:
+    _DEFAULT_DIRS = ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.local/share/fonts")]
+    _DEFAULT_FONT = "Noto Sans CJK TC"
+
+PDF_FONT_DIRS = [d for d in os.getenv("PDF_FONT_DIRS", os.pathsep.join(_DEFAULT_DIRS)).split(os.pathsep) if d]
+PDF_FONT_PATTERNS = [p.strip() for p in os.getenv(
+    "PDF_FONT_PATTERNS",
+    "NotoSansCJK*,NotoSerifCJK*,NotoSansTC*,msjh*,mingliu*,PingFang*,DejaVuSans*,LiberationSans*,LiberationSerif*",
+).split(",") if p.strip()]
+PDF_FONT_CACHE = os.getenv("PDF_FONT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "quotation", "pdf_fonts.json"))
+PDF_FONT_BUNDLE = os.getenv("PDF_FONT_BUNDLE")
+PDF_DEFAULT_FONT = os.getenv("PDF_DEFAULT_FONT", _DEFAULT_FONT)
+PDF_FONT_SUBSET = os.getenv("PDF_FONT_SUBSET", "0") == "1"
+
+_FONT_EXT = (".ttf", ".ttc", ".otf", ".otc")
+
+_lock = threading.Lock()
+_configured = False
+_default_font: str | None = None
+
+# ---------------- 挑字型檔（+ 磁碟快取） ----------------
+def _scan(dirs: List[str], patterns: List[str]) -> List[str]:
+    pats = [p.lower() for p in patterns]
+    found = []
+    for root in dirs:
+        for dirpath, _, files in os.walk(root):
+            for f in files:
+                low = f.lower()
+                if low.endswith(_FONT_EXT) and any(fnmatch.fnmatch(low, p) for p in pats):
+                    found.append(os.path.join(dirpath, f))
+    return sorted(found)
+
+def _tree_mtimes(dirs: List[str]) -> Dict[str, int | None]:
+    """各字型資料夾（含所有子目錄）的 mtime；新字型放進新的子資料夾時也只有上一層目錄會變。"""
+    out: Dict[str, int | None] = {}
+    for root in dirs:
+        if not os.path.isdir(root):
+            out[root] = None
+            continue
+        for dirpath, _, _ in os.walk(root):
+            try:
+                out[dirpath] = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                out[dirpath] = None
+    return out
+
+def _load_cache(key: Dict[str, List[str]]) -> List[str] | None:
+    if not PDF_FONT_CACHE:
+        return None
+    try:
+        data = json.loads(Path(PDF_FONT_CACHE).read_text(encoding="utf-8"))
+        if data.get("key") != key:
+            return None
+        files = data["files"]
+        # 字型有增刪（套件升級）時某一層資料夾的 mtime 會變，重新挑選
+        if _tree_mtimes(key["dirs"]) != data["mtimes"]:
+            return None
+        return files
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _save_cache(key: Dict[str, List[str]], files: List[str]):
+    if not PDF_FONT_CACHE:
+        return
+    try:
+        path = Path(PDF_FONT_CACHE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"key": key, "files": files, "mtimes": _tree_mtimes(key["dirs"])},
+                                  ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        log_event("font_cache_write_failed", level="warn", path=PDF_FONT_CACHE, error=str(e))
+
+def resolve_font_files(dirs: List[str] = PDF_FONT_DIRS, patterns: List[str] = PDF_FONT_PATTERNS) -> List[str]:
+    """依檔名樣式挑出要給 Aspose 的字型檔；結果快取在 PDF_FONT_CACHE。"""
+    key = {"dirs": list(dirs), "patterns": list(patterns)}
+    files = _load_cache(key)
+    if files is None:
+        files = _scan(dirs, patterns)
+        if files:
+            _save_cache(key, files)
+    return files
+
+# ---------------- 設定 Aspose（每個 process 一次） ----------------
+def _sources() -> Tuple[list, str]:
+    import aspose.cells as ac
+
+    if PDF_FONT_BUNDLE:
+        return [ac.FolderFontSource(PDF_FONT_BUNDLE, False)], f"bundle {PDF_FONT_BUNDLE}"
+    files = resolve_font_files()
+    if files:
+        return [ac.FileFontSource(f) for f in files], f"{len(files)} 個字型檔"
+    # 一個都沒挑到（樣式不合這台機器）：退回原本的整個資料夾遞迴掃描
+    dirs = [d for d in PDF_FONT_DIRS if os.path.isdir(d)]
+    return [ac.FolderFontSource(d, True) for d in dirs], f"遞迴掃描 {', '.join(dirs)}"
+
+def configure_fonts() -> str | None:
+    """設定 Aspose 字型來源並回傳 PDF 預設字型名稱；同一個 process 只做一次。"""
+    global _configured, _default_font
+    if _configured:
+        return _default_font
+    with _lock:
+        if _configured:
+            return _default_font
+        from aspose.cells import FontConfigs
+
+        t0 = time.perf_counter()
+        try:
+            sources, desc = _sources()
+            FontConfigs.set_font_sources(sources)
+            _default_font = PDF_DEFAULT_FONT
+            log_event("fonts_configured", sources=desc, ms=round((time.perf_counter() - t0) * 1000, 1))
+        except Exception as e:
+            log_event("fonts_failed", level="warn", to="aspose_default", error=str(e))
+            _default_font = None
+        _configured = True
+    return _default_font
+
+if __name__ == "__main__":
+    # python pdf_fonts.py：列出會交給 Aspose 的字型檔（並更新快取）
+    for f in resolve_font_files():
+        print(f)
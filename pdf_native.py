@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# pdf_native.py
+# 原生 PDF 引擎：不經 Aspose / LibreOffice，直接用 PyMuPDF 依範本版面（quote_layout.py）排版報價單。
+#   - 表頭 / 頁尾的靜態文字、框線、圖片照範本位置畫
+#   - Named Range（ClientName、QuoteDate...）填入 sets
+#   - 明細列以範本列（template_row）的樣式重複 N 次，超過一頁自動換頁並重畫表頭列
+#
+# 字型：預設用 PyMuPDF 內附的 CJK 字型（Droid Sans Fallback）；
+#      設定 NATIVE_PDF_FONT_FILE 可改用自備 TTF/OTF。兩者存檔時都只嵌入用到的字（subset）。
+#
+# 函式入口：
+#   render_quote_pdf(layout, sets, rows, total, out_pdf, template_row=11) -> str
+
+import math, os
+from typing import Any, Dict, List, Tuple
+
+import fitz  # PyMuPDF
+
+from quote_layout import format_value
+
+NATIVE_PDF_FONT_FILE = os.getenv("NATIVE_PDF_FONT_FILE")
+PAGE_W, PAGE_H = fitz.paper_size("a4")
+_font: fitz.Font | None = None
+
+def _get_font() -> fitz.Font:
+    global _font
+    if _font is None:
+        _font = fitz.Font(fontfile=NATIVE_PDF_FONT_FILE) if NATIVE_PDF_FONT_FILE else fitz.Font("cjk")
+    return _font
+
+def _new_page(doc: fitz.Document) -> fitz.Page:
+    return doc.new_page(width=PAGE_W, height=PAGE_H)
+
+def _insert_text(tw: fitz.TextWriter, rect: fitz.Rect, text: str, style: Dict[str, Any], scale: float):
+    """文字先累積在 TextWriter，每頁最後一次寫入（比逐格 insert_textbox 快很多）。"""
+    if not text:
+        return
+    font = _get_font()
+    size = style.get("size", 11.0) * scale
+    pad = 2 * scale
+    box = fitz.Rect(rect.x0 + pad, rect.y0, rect.x1 - pad, rect.y1)
+    align = style.get("align")
+    width = font.text_length(text, fontsize=size)
+    if style.get("wrap") and width > box.width > 0:
+        # 自動換行：列高固定，行數放不下就縮字直到塞得進（最小 5pt）
+        while size > 5 and math.ceil(font.text_length(text, fontsize=size) / box.width) * size * 1.2 > rect.height:
+            size -= 0.5
+        flag = {"center": fitz.TEXT_ALIGN_CENTER, "centerContinuous": fitz.TEXT_ALIGN_CENTER,
+                "right": fitz.TEXT_ALIGN_RIGHT}.get(align, fitz.TEXT_ALIGN_LEFT)
+        tw.fill_textbox(box, text, font=font, fontsize=size, align=flag, lineheight=1.2)
+        return
+    # 單行：放不下就縮字（最小 5pt），跟 Excel「縮小字型以適合欄寬」差不多
+    if width > box.width and width > 0:
+        size = max(5.0, size * box.width / width)
+        width = font.text_length(text, fontsize=size)
+    if align in ("center", "centerContinuous"):
+        x = box.x0 + (box.width - width) / 2
+    elif align == "right":
+        x = box.x1 - width
+    else:
+        x = box.x0
+    # 基線：依垂直對齊（字高約 ascender - descender）
+    asc, desc = font.ascender * size, font.descender * size
+    valign = style.get("valign", "bottom")
+    if valign == "center":
+        y = rect.y0 + (rect.height + asc + desc) / 2
+    elif valign == "top":
+        y = rect.y0 + asc
+    else:
+        y = rect.y1 + desc - scale
+    tw.append((x, y), text, font=font, fontsize=size)
+
+def _draw_borders(shape: fitz.Shape, rect: fitz.Rect, border: Dict[str, bool], skip: Dict[str, bool], scale: float):
+    # 框線累積在同一個 Shape，每頁 commit 一次
+    drawn = False
+    for side, a, b in (("l", rect.tl, rect.bl), ("r", rect.tr, rect.br),
+                       ("t", rect.tl, rect.tr), ("b", rect.bl, rect.br)):
+        if border.get(side) and not skip.get(side):
+            shape.draw_line(a, b)
+            drawn = True
+    if drawn:
+        shape.finish(width=max(0.5, 0.75 * scale), color=(0, 0, 0))
+
+class PageGeometry:
+    """範本版面換算成頁面座標：欄 x、列高、縮放、合併儲存格索引。"""
+    def __init__(self, layout: Dict[str, Any]):
+        self.layout = layout
+        self.styles = layout["styles"]
+        self.ncols = layout["max_col"] + 1
+        self.margins = layout["margins"]
+        widths = layout["col_widths"]
+        # 縮放到頁寬內，等同 Excel「調整成一頁寬」
+        avail_w = PAGE_W - self.margins["left"] - self.margins["right"]
+        self.scale = min(1.0, avail_w / sum(widths))
+        x0 = self.margins["left"] + ((avail_w - sum(widths) * self.scale) / 2 if layout["centered"] else 0)
+        self.xs = [x0]
+        for w in widths:
+            self.xs.append(self.xs[-1] + w * self.scale)
+        self.top = self.margins["top"]
+        self.bottom = PAGE_H - self.margins["bottom"]
+        self.grid: Dict[Tuple[int, int], Dict[str, Any]] = {(c["row"], c["col"]): c for c in layout["cells"]}
+        self.merged_at: Dict[Tuple[int, int], List[int]] = {}
+        for m in layout["merges"]:
+            for r in range(m[0], m[2] + 1):
+                for c in range(m[1], m[3] + 1):
+                    self.merged_at[(r, c)] = m
+
+    def row_h(self, src_row: int) -> float:
+        return self.layout["row_heights"].get(src_row, self.layout["default_row_height"]) * self.scale
+
+    def style(self, cell: Dict[str, Any] | None) -> Dict[str, Any]:
+        return self.styles[min(cell["style"], len(self.styles) - 1)] if cell else {}
+
+# 一列的擺放：(範本列, 明細 index 或 None, y)
+Placement = Tuple[int, int | None, float]
+
+def paginate(geo: PageGeometry, n_items: int, template_row: int = 11) -> List[List[Placement]]:
+    """決定每一頁要畫哪些列：明細列重複 N 次，超過一頁就換頁，新頁先重畫表頭列。"""
+    t0 = template_row - 1
+    header_row = t0 - 1
+    sequence: List[Tuple[int, int | None]] = [(r, None) for r in range(t0)]
+    sequence += [(t0, i) for i in range(max(n_items, 1))]
+    sequence += [(r, None) for r in range(t0 + 1, geo.layout["max_row"] + 1)]
+
+    pages: List[List[Placement]] = [[]]
+    y = geo.top
+    for src_row, item in sequence:
+        h = geo.row_h(src_row)
+        if y + h > geo.bottom and y > geo.top:
+            pages.append([])
+            y = geo.top
+            if item is not None and header_row >= 0:
+                pages[-1].append((header_row, None, y))
+                y += geo.row_h(header_row)
+        pages[-1].append((src_row, item, y))
+        y += h
+    return pages
+
+def image_pages(geo: PageGeometry, pages: List[List[Placement]]) -> Dict[int, List[Tuple[int, float]]]:
+    """圖片跟著錨點列走（取該列第一次出現的位置），回傳 {頁碼: [(圖片 index, 錨點列 y)]}。"""
+    row_pos: Dict[int, Tuple[int, float]] = {}
+    for pno, placements in enumerate(pages):
+        for src_row, item, y in placements:
+            if src_row not in row_pos or item == 0:
+                row_pos[src_row] = (pno, y)
+    out: Dict[int, List[Tuple[int, float]]] = {}
+    for idx, img in enumerate(geo.layout["images"]):
+        pos = row_pos.get(img["row"])
+        if pos is not None:
+            out.setdefault(pos[0], []).append((idx, pos[1]))
+    return out
+
+def dynamic_cells(layout: Dict[str, Any], sets: Dict[str, Any], total: float | None,
+                  template_row: int = 11) -> Dict[Tuple[int, int], Any]:
+    """命名範圍覆寫值（明細列以外）：sets 的鍵 + FinalPrice。"""
+    t0 = template_row - 1
+    out: Dict[Tuple[int, int], Any] = {}
+    for name, value in (sets or {}).items():
+        pos = layout["names"].get(name)
+        if pos and pos[0] != t0:
+            out[tuple(pos)] = value
+    fp = layout["names"].get("FinalPrice")
+    if fp:
+        out[tuple(fp)] = total
+    return out
+
+def draw_placement(shape: fitz.Shape, tw: fitz.TextWriter, geo: PageGeometry, src_row: int, item: int | None,
+                   y: float, rows: List[list], overrides: Dict[Tuple[int, int], Any],
+                   static: bool = True, dynamic: bool = True):
+    """
+    畫一列。static=框線/底色/範本固定文字，dynamic=明細值與命名範圍覆寫值；
+    overlay 引擎用 static-only 畫底圖、dynamic-only 蓋字。
+    """
+    h = geo.row_h(src_row)
+    scale = geo.scale
+    xs = geo.xs
+    for c in range(geo.ncols):
+        m = geo.merged_at.get((src_row, c))
+        cell = geo.grid.get((src_row, c))
+        st = geo.style(cell)
+        if m and (m[0], m[1]) != (src_row, c):
+            # 合併範圍內非左上角：只補外框
+            if cell and static:
+                skip = {"l": c > m[1], "r": c < m[3], "t": src_row > m[0], "b": src_row < m[2]}
+                _draw_borders(shape, fitz.Rect(xs[c], y, xs[c + 1], y + h), st.get("border", {}), skip, scale)
+            continue
+        rect = fitz.Rect(xs[c], y, xs[c + 1], y + h)
+        skip = {}
+        text_rect = rect
+        if m:
+            text_rect = fitz.Rect(xs[m[1]], y, xs[m[3] + 1], y + sum(geo.row_h(r) for r in range(m[0], m[2] + 1)))
+            skip = {"r": c < m[3], "b": src_row < m[2]}
+        if static:
+            if st.get("fill"):
+                shape.draw_rect(rect)
+                shape.finish(color=None, fill=tuple(int(st["fill"][i:i + 2], 16) / 255 for i in (0, 2, 4)))
+            _draw_borders(shape, rect, st.get("border", {}), skip, scale)
+
+        if item is not None:
+            is_dynamic = True
+            value = rows[item][c] if item < len(rows) and c < len(rows[item]) else None
+        elif (src_row, c) in overrides:
+            is_dynamic = True
+            value = overrides[(src_row, c)]
+        else:
+            is_dynamic = False
+            value = cell["value"] if cell else None
+        if (dynamic if is_dynamic else static):
+            _insert_text(tw, text_rect, format_value(value, st.get("numfmt", "")), st, scale)
+
+def draw_images(page: fitz.Page, geo: PageGeometry, placed: List[Tuple[int, float]]):
+    for idx, row_y in placed:
+        img = geo.layout["images"][idx]
+        ix = geo.xs[min(img["col"], len(geo.xs) - 1)] + img["col_off"] * geo.scale
+        iy = row_y + img["row_off"] * geo.scale
+        rect = fitz.Rect(ix, iy, ix + img["width"] * geo.scale, iy + img["height"] * geo.scale)
+        page.insert_image(rect, stream=img["data"], keep_proportion=True)
+
+def render_quote_pdf(
+    layout: Dict[str, Any],
+    sets: Dict[str, Any],
+    rows: List[list],
+    total: float,
+    out_pdf: str,
+    template_row: int = 11,
+) -> str:
+    """
+    依版面直接畫出報價單 PDF。
+      layout       : quote_layout.load_layout() 的結果
+      sets         : 命名儲存格寫入值，如 {"ClientName":"...", "QuoteDate":"..."}
+      rows         : 明細二維陣列（make_quote_linux.item_rows 的格式，由左而右從 A 欄寫起）
+      total        : FinalPrice
+      template_row : 範本中的明細列（1-based）
+    """
+    geo = PageGeometry(layout)
+    pages = paginate(geo, len(rows), template_row)
+    imgs = image_pages(geo, pages)
+    overrides = dynamic_cells(layout, sets, total, template_row)
+
+    doc = fitz.open()
+    for pno, placements in enumerate(pages):
+        page = _new_page(doc)
+        shape, tw = page.new_shape(), fitz.TextWriter(page.rect)
+        for src_row, item, y in placements:
+            draw_placement(shape, tw, geo, src_row, item, y, rows, overrides)
+        shape.commit()
+        tw.write_text(page)
+        draw_images(page, geo, imgs.get(pno, []))
+
+    doc.subset_fonts()
+    doc.save(out_pdf, garbage=3, deflate=True)
+    doc.close()
+    return out_pdf
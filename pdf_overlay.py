@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# pdf_overlay.py
+# 疊印 PDF 引擎：報價單大部分內容每次都一樣（Logo、公司資料、注意事項、表格框線），
+# 只有 ClientName / QuoteDate / 明細列 / FinalPrice 會變。
+#   1) 依「這一頁畫哪些列」把靜態部分畫成底圖 PDF，快取起來（範本更新時失效）
+#   2) 每個請求只把底圖貼上（show_pdf_page，同一份底圖在輸出檔內共用 XObject），
+#      再把動態文字蓋在命名範圍 / 明細列對應的座標上
+# 明細很多時沿用 pdf_native.paginate 的分頁規則（表格區跨頁重複、新頁重畫表頭列）。
+#
+# 函式入口：
+#   render_quote_pdf_overlay(layout, sets, rows, total, out_pdf, template_row=11) -> str
+
+import os, threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import fitz  # PyMuPDF
+
+from pdf_native import (
+    PAGE_W, PAGE_H, PageGeometry, Placement, _new_page,
+    paginate, image_pages, dynamic_cells, draw_placement, draw_images,
+)
+
+OVERLAY_CACHE_SIZE = int(os.getenv("OVERLAY_CACHE_SIZE", "64"))  # 快取幾種頁面底圖
+
+# (範本版本, 工作表, 頁面形狀) -> 單頁底圖 PDF bytes
+_backgrounds: "OrderedDict[Tuple, bytes]" = OrderedDict()
+_lock = threading.Lock()
+hits = 0
+misses = 0
+
+def _page_shape(placements: List[Placement], images: List[Tuple[int, float]]) -> Tuple:
+    # y 由列序決定，所以只要列序 + 是否為明細列 + 圖片相同，底圖就一樣
+    return (tuple((r, item is not None) for r, item, _ in placements), tuple(i for i, _ in images))
+
+def _render_background(geo: PageGeometry, placements: List[Placement],
+                       images: List[Tuple[int, float]], template_row: int) -> bytes:
+    # 命名範圍位置要當成動態格（不畫範本上的示範值），值本身不重要
+    blank = {pos: None for pos in dynamic_cells(geo.layout, {k: None for k in geo.layout["names"]}, None, template_row)}
+    doc = fitz.open()
+    page = _new_page(doc)
+    shape, tw = page.new_shape(), fitz.TextWriter(page.rect)
+    for src_row, item, y in placements:
+        draw_placement(shape, tw, geo, src_row, item, y, [], blank, static=True, dynamic=False)
+    shape.commit()
+    tw.write_text(page)
+    draw_images(page, geo, images)
+    doc.subset_fonts()
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+def _background(geo: PageGeometry, placements: List[Placement], images: List[Tuple[int, float]],
+                template_row: int) -> bytes:
+    global hits, misses
+    version = geo.layout.get("version")
+    key = (version, geo.layout["sheet"], template_row, _page_shape(placements, images))
+    with _lock:
+        data = _backgrounds.get(key)
+        if data is not None:
+            _backgrounds.move_to_end(key)
+            hits += 1
+            return data
+    data = _render_background(geo, placements, images, template_row)
+    with _lock:
+        misses += 1
+        # 同一範本（同路徑）的舊版本底圖一併丟掉
+        if version:
+            for k in [k for k in _backgrounds if k[0] and k[0][0] == version[0] and k[0] != version]:
+                del _backgrounds[k]
+        _backgrounds[key] = data
+        while len(_backgrounds) > OVERLAY_CACHE_SIZE:
+            _backgrounds.popitem(last=False)
+    return data
+
+def clear_cache():
+    with _lock:
+        _backgrounds.clear()
+
+def render_quote_pdf_overlay(
+    layout: Dict[str, Any],
+    sets: Dict[str, Any],
+    rows: List[list],
+    total: float,
+    out_pdf: str,
+    template_row: int = 11,
+) -> str:
+    """參數同 pdf_native.render_quote_pdf；靜態部分走快取底圖，只蓋動態文字。"""
+    geo = PageGeometry(layout)
+    pages = paginate(geo, len(rows), template_row)
+    imgs = image_pages(geo, pages)
+    overrides = dynamic_cells(layout, sets, total, template_row)
+
+    doc = fitz.open()
+    sources: Dict[bytes, fitz.Document] = {}
+    for pno, placements in enumerate(pages):
+        bg = _background(geo, placements, imgs.get(pno, []), template_row)
+        src = sources.get(bg)
+        if src is None:
+            src = sources[bg] = fitz.open(stream=bg, filetype="pdf")
+        page = _new_page(doc)
+        page.show_pdf_page(fitz.Rect(0, 0, PAGE_W, PAGE_H), src, 0)
+        shape, tw = page.new_shape(), fitz.TextWriter(page.rect)
+        for src_row, item, y in placements:
+            draw_placement(shape, tw, geo, src_row, item, y, rows, overrides, static=False, dynamic=True)
+        tw.write_text(page)
+
+    doc.subset_fonts()
+    doc.save(out_pdf, garbage=3, deflate=True)
+    doc.close()
+    for src in sources.values():
+        src.close()
+    return out_pdf
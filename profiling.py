@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# profiling.py
+# 可選的逐請求剖析：線上報價偶爾很慢、本機又重現不了時打開。
+#   - 抽樣選中的請求在 on_text（web 程序）與 make_quote（工作 worker）外面包 cProfile，
+#     可另開 tracemalloc 記錄這段期間的配置位置（前後 snapshot 差異）
+#   - 是否抽中以請求 ID 的雜湊決定：同一請求在 web 程序與 worker 子程序的判斷一致
+#   - soffice 子程序的實際耗時與 CPU 時間（見 soffice_scheduler.py）記進同一份紀錄
+#   - 每次擷取寫一個 .prof（pstats 格式）+ 一個 .json（請求、耗時、各階段、配置位置、soffice）；
+#     目錄有檔數 / 容量上限，超過就刪最舊的
+#   - python profiling.py：彙整目錄內所有擷取，列出最熱的函式、配置位置、各階段與
+#     parse / aspose / conversion / watermark 各區塊的自身耗時
+# 注意：tracemalloc 是整個程序共用的，同時有多個請求時配置位置會混在一起；
+#       on_text 是 coroutine，await 期間 event loop 跑的其他工作也會算進去；
+#       同一執行緒同時只剖析一段（其他同時抽中的 on_text 略過）。
+#
+# 設定（環境變數）：
+#   PROFILE_SAMPLE      : 抽樣比例 0~1（預設 0 = 關閉；1 = 每個請求）
+#   PROFILE_TRACEMALLOC : 1 = 同時記錄配置位置（較慢；預設 0）
+#   PROFILE_MIN_MS      : 比這快的擷取不存檔（預設 0 = 全存；只想抓慢的請求時設定）
+#   PROFILE_DIR         : 存放目錄（預設 <tmp>/quote_profiles）
+#   PROFILE_MAX_FILES   : 最多保留幾次擷取（預設 200）
+#   PROFILE_MAX_MB      : 目錄容量上限 MiB（預設 200）
+#   PROFILE_TOP         : 每次擷取保留幾個配置位置（預設 30）
+#
+# 函式入口：
+#   with profiled("make_quote", request_id) as cap: ...   # 沒抽中時 cap 為 None
+#     cap.note(stages=[...])                                # 附加欄位寫進 .json
+#   note_subprocess("soffice", wall, cpu, returncode)       # 記到目前執行緒 / coroutine 正在擷取的紀錄
+#   current() -> Capture | None；with attached(caps): ...    # 在別的執行緒代表這些請求跑（soffice 批次）
+#   summarize(profile_dir, top=25, kind=None) -> dict
+#   python profiling.py [--dir DIR] [--top 25] [--kind make_quote] [--json]
+
+import argparse, contextvars, cProfile, json, os, pstats, random, sys, tempfile, threading, time, tracemalloc, zlib
+from contextlib import contextmanager
+from pathlib import Path
+from statistics import median
+from typing import Any, Dict, Iterator, List
+
+from metrics import Counter, Histogram, log_event
+
+PROFILE_SAMPLE = float(os.getenv("PROFILE_SAMPLE", "0"))
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "0") == "1"
+PROFILE_MIN_MS = float(os.getenv("PROFILE_MIN_MS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", str(Path(tempfile.gettempdir()) / "quote_profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+PROFILE_MAX_MB = float(os.getenv("PROFILE_MAX_MB", "200"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "30"))
+
+PROFILES = Counter("quote_profiles_total", "Profiling captures, by kind and result", ("kind", "result"))
+SUBPROCESS_CPU = Histogram("quote_subprocess_cpu_seconds", "CPU time (user+sys) of external converter runs", ("name",))
+
+# 依檔名 / 函式名把 cProfile 的自身耗時歸到各區塊（summarize 用）
+AREAS = (
+    ("parse", ("user_input_parsing",)),
+    ("aspose", ("aspose", "make_quote_linux", "template_cache")),
+    ("conversion", ("soffice_", "subprocess", "selectors", "wait4", "pdf_native", "pdf_overlay", "pyuno")),
+    ("watermark", ("remove_watermark", "fitz", "pymupdf")),
+)
+
+_current: contextvars.ContextVar["Capture | None"] = contextvars.ContextVar("profile_capture", default=None)
+_attached: contextvars.ContextVar[tuple] = contextvars.ContextVar("profile_attached", default=())
+_local = threading.local()   # 同一執行緒只能有一個 cProfile 在跑
+_trace_lock = threading.Lock()
+_trace_users = 0
+_trace_owned = False
+
+def selected(request_id: str | None, rate: float | None = None) -> bool:
+    """這個請求要不要剖析：有 ID 時用 CRC32 決定（跨程序一致），沒有才擲骰子。"""
+    rate = PROFILE_SAMPLE if rate is None else rate
+    if rate <= 0:
+        return False
+    if rate >= 1:
+        return True
+    if request_id:
+        return zlib.crc32(str(request_id).encode("utf-8")) / 2**32 < rate
+    return random.random() < rate
+
+class Capture:
+    def __init__(self, kind: str, request_id: str | None):
+        self.kind = kind
+        self.request = request_id
+        self.fields: Dict[str, Any] = {}
+        self.subprocesses: List[Dict[str, Any]] = []
+
+    def note(self, **fields):
+        self.fields.update(fields)
+
+def current() -> Capture | None:
+    return _current.get()
+
+@contextmanager
+def attached(captures) -> Iterator[None]:
+    """
+    批次執行緒一次替多個請求跑 soffice：期間的 note_subprocess 記到每個請求各自的擷取
+    （紀錄帶 shared=同批請求數，CPU 時間是整批的）。
+    """
+    token = _attached.set(tuple(c for c in captures if c is not None))
+    try:
+        yield
+    finally:
+        _attached.reset(token)
+
+def note_subprocess(name: str, wall: float, cpu: float | None, returncode: int | None = None):
+    """外部轉檔程式（soffice）的耗時；CPU 時間一律進 /metrics，正在擷取時另記進紀錄。"""
+    if cpu is not None:
+        SUBPROCESS_CPU.observe(cpu, name=name)
+    entry = {"name": name, "wall": round(wall, 4),
+             "cpu": None if cpu is None else round(cpu, 4), "returncode": returncode}
+    shared = _attached.get()
+    if shared:
+        entry["shared"] = len(shared)
+    for cap in {id(c): c for c in (_current.get(), *shared) if c is not None}.values():
+        cap.subprocesses.append(entry)
+
+# ---------------- tracemalloc（程序共用，參考計數開關） ----------------
+def _trace_start():
+    global _trace_users, _trace_owned
+    with _trace_lock:
+        if _trace_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _trace_owned = True
+        _trace_users += 1
+
+def _trace_stop():
+    global _trace_users, _trace_owned
+    with _trace_lock:
+        _trace_users -= 1
+        if _trace_users == 0 and _trace_owned:
+            tracemalloc.stop()
+            _trace_owned = False
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+# ---------------- 擷取 ----------------
+@contextmanager
+def profiled(kind: str, request_id: str | None = None, rate: float | None = None) -> Iterator[Capture | None]:
+    """抽中時在這段程式碼外面包 cProfile（+ tracemalloc），結束後寫進 PROFILE_DIR；沒抽中 yield None。"""
+    if not selected(request_id, rate) or getattr(_local, "active", False):
+        yield None
+        return
+    cap = Capture(kind, request_id)
+    token = _current.set(cap)
+    _local.active = True
+    prof: cProfile.Profile | None = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        prof = None  # 已有其他剖析工具（如 py-spy / 另一個 cProfile）在跑
+    before = None
+    if PROFILE_TRACEMALLOC:
+        _trace_start()
+        before = _snapshot()
+    t0, c0 = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield cap
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        if prof is not None:
+            prof.disable()
+        allocs = None
+        if before is not None:
+            try:
+                after = _snapshot()
+                allocs = [{"site": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+                           "size_diff": s.size_diff, "count_diff": s.count_diff}
+                          for s in after.compare_to(before, "lineno")[:PROFILE_TOP]]
+            finally:
+                _trace_stop()
+        _local.active = False
+        _current.reset(token)
+        if wall * 1000 < PROFILE_MIN_MS:
+            PROFILES.inc(kind=kind, result="fast")
+        else:
+            try:
+                _dump(cap, prof, wall, cpu, allocs, error)
+                PROFILES.inc(kind=kind, result="saved")
+            except OSError as e:
+                PROFILES.inc(kind=kind, result="error")
+                log_event("profile_write_failed", level="warn", dir=PROFILE_DIR, error=str(e))
+
+def _dump(cap: Capture, prof: cProfile.Profile | None, wall: float, cpu: float,
+          allocs: List[Dict[str, Any]] | None, error: str | None):
+    root = Path(PROFILE_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    safe = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(cap.request or "-"))[:48]
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}_{cap.kind}_{os.getpid()}_{safe}"
+    if prof is not None:
+        prof.dump_stats(str(root / f"{stem}.prof"))
+    meta = {"kind": cap.kind, "request": cap.request, "pid": os.getpid(), "ts": round(time.time(), 3),
+            "wall": round(wall, 4), "cpu": round(cpu, 4), "error": error, "profile": prof is not None,
+            "allocations": allocs, "subprocesses": cap.subprocesses, **cap.fields}
+    tmp = root / f".{stem}.json.tmp"
+    tmp.write_text(json.dumps(meta, ensure_ascii=False, default=str), encoding="utf-8")
+    os.replace(tmp, root / f"{stem}.json")
+    _rotate(root)
+
+def _rotate(root: Path):
+    """依檔數 / 容量上限刪最舊的擷取（.prof 與 .json 一起刪）；多個程序同時刪也不會出錯。"""
+    groups: Dict[str, List[Path]] = {}
+    for p in root.iterdir():
+        if p.suffix in (".prof", ".json") and not p.name.startswith("."):
+            groups.setdefault(p.stem, []).append(p)
+    sizes = {}
+    for stem, files in groups.items():
+        try:
+            sizes[stem] = sum(f.stat().st_size for f in files)
+        except FileNotFoundError:
+            sizes[stem] = 0
+    total = sum(sizes.values())
+    stems = sorted(groups)  # 檔名以時間開頭，排序即新舊
+    limit = PROFILE_MAX_MB * 1024 * 1024
+    while stems and (len(stems) > PROFILE_MAX_FILES or total > limit):
+        stem = stems.pop(0)
+        for f in groups[stem]:
+            f.unlink(missing_ok=True)
+        total -= sizes[stem]
+
+# ---------------- 彙整 ----------------
+def _area(filename: str, func: str) -> str:
+    key = f"{filename} {func}".lower()
+    for area, needles in AREAS:
+        if any(n in key for n in needles):
+            return area
+    return "other"
+
+def _pct(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def summarize(profile_dir: str = PROFILE_DIR, top: int = 25, kind: str | None = None) -> Dict[str, Any]:
+    root = Path(profile_dir)
+    metas = []
+    for p in sorted(root.glob("*.json")):
+        try:
+            meta = json.loads(p.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        if kind is None or meta.get("kind") == kind:
+            metas.append((p, meta))
+
+    out: Dict[str, Any] = {"dir": str(root), "captures": len(metas), "kinds": {}, "stages": {},
+                           "areas": {}, "functions": [], "allocations": [], "subprocesses": {}}
+    for _, m in metas:
+        out["kinds"].setdefault(m["kind"], []).append(m["wall"])
+    out["kinds"] = {k: {"n": len(v), "p50_ms": median(v) * 1000, "p95_ms": _pct(v, 0.95) * 1000}
+                    for k, v in out["kinds"].items()}
+
+    # 各階段耗時（make_quote 的 StageReport）
+    stages: Dict[str, List[float]] = {}
+    for _, m in metas:
+        for rec in m.get("stages") or []:
+            stages.setdefault(rec["stage"], []).append(rec["seconds"])
+    out["stages"] = {s: {"n": len(v), "p50_ms": median(v) * 1000, "p95_ms": _pct(v, 0.95) * 1000,
+                         "max_ms": max(v) * 1000} for s, v in stages.items()}
+
+    # 熱點函式：所有 .prof 合併
+    profs = [str(p.with_suffix(".prof")) for p, m in metas if m.get("profile") and p.with_suffix(".prof").exists()]
+    if profs:
+        st = pstats.Stats(profs[0])
+        for f in profs[1:]:
+            try:
+                st.add(f)
+            except (OSError, EOFError, ValueError):
+                continue
+        rows = []
+        areas: Dict[str, float] = {}
+        for (filename, line, func), (_, ncalls, tt, ct, _) in st.stats.items():
+            area = _area(filename, func)
+            areas[area] = areas.get(area, 0.0) + tt
+            name = func if filename == "~" else f"{Path(filename).name}:{line}({func})"
+            rows.append({"function": name, "area": area, "calls": ncalls, "tottime": tt, "cumtime": ct})
+        total = sum(areas.values()) or 1.0
+        out["areas"] = {a: {"seconds": s, "share": s / total} for a, s in sorted(areas.items(), key=lambda x: -x[1])}
+        out["functions"] = sorted(rows, key=lambda r: -r["tottime"])[:top]
+        out["functions_cumulative"] = sorted(rows, key=lambda r: -r["cumtime"])[:top]
+
+    # 配置位置：各次擷取的差異加總
+    allocs: Dict[str, Dict[str, Any]] = {}
+    for _, m in metas:
+        for a in m.get("allocations") or []:
+            agg = allocs.setdefault(a["site"], {"site": a["site"], "size_diff": 0, "count_diff": 0, "captures": 0})
+            agg["size_diff"] += a["size_diff"]
+            agg["count_diff"] += a["count_diff"]
+            agg["captures"] += 1
+    out["allocations"] = sorted(allocs.values(), key=lambda a: -a["size_diff"])[:top]
+
+    subs: Dict[str, Dict[str, List[float]]] = {}
+    for _, m in metas:
+        for s in m.get("subprocesses") or []:
+            agg = subs.setdefault(s["name"], {"wall": [], "cpu": []})
+            agg["wall"].append(s["wall"])
+            if s.get("cpu") is not None:
+                agg["cpu"].append(s["cpu"])
+    out["subprocesses"] = {n: {"n": len(v["wall"]), "wall_p50_ms": median(v["wall"]) * 1000,
+                               "cpu_p50_ms": median(v["cpu"]) * 1000 if v["cpu"] else None}
+                           for n, v in subs.items()}
+    return out
+
+def _print_summary(s: Dict[str, Any]):
+    print(f"[PROFILE] {s['dir']}：{s['captures']} 次擷取")
+    for k, v in s["kinds"].items():
+        print(f"  {k:<12} n={v['n']:<5} p50={v['p50_ms']:.1f}ms p95={v['p95_ms']:.1f}ms")
+    if s["stages"]:
+        print("\n階段（make_quote）")
+        for name, v in s["stages"].items():
+            print(f"  {name:<16} n={v['n']:<5} p50={v['p50_ms']:>8.1f}ms p95={v['p95_ms']:>8.1f}ms max={v['max_ms']:>8.1f}ms")
+    if s["areas"]:
+        print("\n區塊（自身耗時）")
+        for name, v in s["areas"].items():
+            print(f"  {name:<12} {v['seconds']:>9.3f}s {v['share'] * 100:>5.1f}%")
+        print("\n最熱的函式（自身耗時）")
+        print(f"  {'tottime':>9} {'cumtime':>9} {'calls':>9}  {'area':<10} function")
+        for r in s["functions"]:
+            print(f"  {r['tottime']:>9.3f} {r['cumtime']:>9.3f} {r['calls']:>9}  {r['area']:<10} {r['function']}")
+    if s["allocations"]:
+        print("\n配置位置（擷取期間淨增加）")
+        for a in s["allocations"]:
+            print(f"  {a['size_diff'] / 1024:>10.1f} KiB {a['count_diff']:>8} 個  ×{a['captures']:<4} {a['site']}")
+    for name, v in s["subprocesses"].items():
+        cpu = f"{v['cpu_p50_ms']:.1f}ms" if v["cpu_p50_ms"] is not None else "-"
+        print(f"\n子程序 {name}：n={v['n']} wall p50={v['wall_p50_ms']:.1f}ms cpu p50={cpu}")
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="彙整 PROFILE_DIR 裡的剖析結果")
+    ap.add_argument("--dir", default=PROFILE_DIR)
+    ap.add_argument("--top", type=int, default=25)
+    ap.add_argument("--kind", default=None, help="只看 on_text 或 make_quote")
+    ap.add_argument("--json", action="store_true", help="輸出 JSON（給腳本比較用）")
+    args = ap.parse_args(argv)
+    s = summarize(args.dir, args.top, args.kind)
+    if args.json:
+        print(json.dumps(s, ensure_ascii=False, indent=1, default=str))
+    else:
+        _print_summary(s)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# quote_batch.py
+# 批次產生報價單（調價重發、月底補寄...）：一次讀進整份清單，分給多個 worker process 產檔。
+#   - 每個 worker 只載入一次 Aspose / 範本 / 版面（initializer），之後連續處理多筆
+#   - 逐筆回報成功 / 失敗 / 耗時，結果即時寫進 JSONL 報告，可用 --resume 從失敗處續跑
+#   - 每筆可用「範本」欄位（sets 的 Template）指定範本，或依客戶名稱對應（見 template_registry.py）；
+#     範本在主程序選好，worker 只管產檔
+#   - 單筆資料有問題（items 不是合法 JSON、範本不存在...）只記成那一筆失敗，不影響其他筆
+#   - 明確指定的 name 重複時，輸出檔名改成 name_<id>，不會互相覆蓋
+#
+# 輸入格式（依副檔名判斷，或用 --format 指定）：
+#   .jsonl : 每行一筆 {"id": "...", "name": "...", "template": "...", "sets": {...}, "items": [...]}
+#            或 {"id": "...", "text": "LINE 貼上的原文"}（交給 parse_user_text 解析）
+#   .csv   : 有 text 欄就用 parse_user_text；否則 items 欄放 JSON 陣列，其餘欄位（id/name/template 除外）當 sets
+#   .txt   : LINE 原文，每筆之間用一行「====」分隔
+#
+# 用法：
+#   python make_quote_linux.py batch --in 維修報價單範本.xlsx --records quotes.jsonl \
+#       --out-dir public/batch --jobs 4 --report batch_report.jsonl [--resume] [--order completion] \
+#       [--templates templates.json]
+#
+# 函式入口：
+#   load_records(path, fmt=None) -> list[dict]     # 每筆 {"id", "name", "template", "sets", "items", "error"}
+#   run_batch(records, *, template_xlsx, out_dir, templates=None, ...) -> list[dict]   # 逐筆結果
+
+import argparse, csv, json, multiprocessing, os, re, sys, time, zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from statistics import median
+from typing import Any, Dict, Iterator, List
+
+from template_registry import TEMPLATES_FILE, TemplateRegistry
+from user_input_parsing import parse_user_text
+
+BATCH_TEXT_SEPARATOR = re.compile(r"^={4,}\s*$")
+
+# ---------------- 讀入清單 ----------------
+def _record_from_dict(obj: Dict[str, Any], index: int) -> Dict[str, Any]:
+    if obj.get("text"):
+        sets, items = parse_user_text(obj["text"])
+    else:
+        sets, items = dict(obj.get("sets") or {}), list(obj.get("items") or [])
+    template = sets.pop("Template", None) or obj.get("template") or None
+    return {
+        "id": str(obj.get("id") or index),
+        "name": obj.get("name"),
+        "template": template,
+        "sets": sets,
+        "items": items,
+        "error": obj.get("error"),
+    }
+
+def _iter_jsonl(path: Path) -> Iterator[Dict[str, Any]]:
+    with path.open(encoding="utf-8-sig") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{lineno} 不是合法的 JSON：{e}") from e
+
+def _iter_csv(path: Path) -> Iterator[Dict[str, Any]]:
+    with path.open(encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            row = {k.strip(): (v or "").strip() for k, v in row.items() if k}
+            if row.get("text"):
+                yield row
+                continue
+            meta = {k: row.pop(k) for k in ("id", "name", "template") if k in row}
+            raw, items, error = row.pop("items", ""), [], None
+            if raw:
+                try:
+                    items = json.loads(raw)
+                except json.JSONDecodeError as e:
+                    error = f"items 欄不是合法的 JSON：{e}"
+            yield {**meta, "sets": {k: v for k, v in row.items() if v}, "items": items, "error": error}
+
+def _iter_texts(path: Path) -> Iterator[Dict[str, Any]]:
+    buf: List[str] = []
+    for line in path.read_text(encoding="utf-8-sig").splitlines():
+        if BATCH_TEXT_SEPARATOR.match(line):
+            if "".join(buf).strip():
+                yield {"text": "\n".join(buf)}
+            buf = []
+        else:
+            buf.append(line)
+    if "".join(buf).strip():
+        yield {"text": "\n".join(buf)}
+
+def load_records(path: str, fmt: str | None = None) -> List[Dict[str, Any]]:
+    p = Path(path)
+    fmt = fmt or {".jsonl": "jsonl", ".json": "jsonl", ".csv": "csv"}.get(p.suffix.lower(), "texts")
+    readers = {"jsonl": _iter_jsonl, "csv": _iter_csv, "texts": _iter_texts}
+    if fmt not in readers:
+        raise ValueError(f"不支援的批次格式：{fmt}（jsonl / csv / texts）")
+    records = [_record_from_dict(obj, i) for i, obj in enumerate(readers[fmt](p), 1)]
+    seen = set()
+    for r in records:
+        if r["id"] in seen:
+            raise ValueError(f"批次清單中 id 重複：{r['id']}（--resume 需要唯一 id）")
+        seen.add(r["id"])
+    return records
+
+# ---------------- worker（module 層級，spawn 後可 import） ----------------
+_worker_opts: Dict[str, Any] = {}
+
+def _init_worker(opts: Dict[str, Any]):
+    """每個 worker process 只跑一次：載入 Aspose、預讀範本與版面。"""
+    _worker_opts.update(opts)
+    if opts.get("quiet"):
+        sys.stdout = open(os.devnull, "w", encoding="utf-8")
+    from make_quote_linux import load_layout, open_book
+    if opts["pdf_engine"] in ("native", "overlay"):
+        load_layout(opts["template_xlsx"], opts["sheet"])
+    if opts["want_xlsx"] or opts["pdf_engine"] not in ("native", "overlay"):
+        open_book(opts["template_xlsx"])  # 觸發 .NET 啟動 + 範本快取
+
+def _safe_name(s: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", s).strip("_") or "quote"
+
+def _output_bases(records: List[Dict[str, Any]]) -> List[str]:
+    """每筆的輸出檔名基底；明確指定的 name（清理後）重複時加上 id，避免互相覆蓋。"""
+    bases = [_safe_name(r["name"] or f"{r['sets'].get('ClientName', '客戶')}_{r['id']}") for r in records]
+    counts: Dict[str, int] = {}
+    for b in bases:
+        counts[b] = counts.get(b, 0) + 1
+    return [f"{b}_{_safe_name(r['id'])}" if counts[b] > 1 else b for b, r in zip(bases, records)]
+
+def _run_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    from make_quote_linux import StageReport, make_quote
+
+    opts = _worker_opts
+    tpl = rec.get("tpl") or {"path": opts["template_xlsx"], "sheet": opts["sheet"],
+                             "template_row": 11, "first_insert_row": 12}
+    base = rec.get("base") or _safe_name(rec["name"] or f"{rec['sets'].get('ClientName', '客戶')}_{rec['id']}")
+    out = {"id": rec["id"], "status": "ok", "pid": os.getpid(), "xlsx": None, "pdf": None, "error": None}
+    report = StageReport()
+    t0 = time.perf_counter()
+    try:
+        if rec.get("error"):
+            raise ValueError(rec["error"])
+        if not rec["items"]:
+            raise ValueError("沒有任何明細")
+        out["xlsx"], out["pdf"] = make_quote(
+            xlsx_in=tpl["path"],
+            name=str(Path(opts["out_dir"]) / base),
+            sheet=tpl["sheet"],
+            sets=rec["sets"],
+            items=rec["items"],
+            template_row=tpl["template_row"],
+            first_insert_row=tpl["first_insert_row"],
+            pdf_engine=opts["pdf_engine"],
+            soffice_path=opts["soffice_path"],
+            calc_mode=opts["calc_mode"],
+            want_xlsx=opts["want_xlsx"],
+            report=report,
+        )
+    except Exception as e:
+        out["status"], out["error"] = "failed", f"{type(e).__name__}: {e}"
+    out["seconds"] = time.perf_counter() - t0
+    out["stages"] = {s["stage"]: round(s["seconds"], 4) for s in report.stages}
+    return out
+
+# ---------------- 報告 / 續跑 ----------------
+def load_done_ids(report_path: str) -> set:
+    """讀既有報告，回傳已成功的 id（同一 id 以最後一筆為準）。"""
+    last: Dict[str, str] = {}
+    p = Path(report_path)
+    if not p.exists():
+        return set()
+    with p.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中斷時可能寫了半行
+            last[r["id"]] = r["status"]
+    return {k for k, v in last.items() if v == "ok"}
+
+# ---------------- 主流程 ----------------
+def run_batch(
+    records: List[Dict[str, Any]],
+    *,
+    template_xlsx: str,
+    out_dir: str,
+    sheet: str | None = None,
+    pdf_engine: str = "libreoffice",
+    soffice_path: str | None = None,
+    calc_mode: str = "chain",
+    want_xlsx: bool = True,
+    jobs: int = 2,
+    order: str = "input",
+    report_path: str | None = None,
+    quiet: bool = True,
+    templates: TemplateRegistry | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    逐筆產檔並回傳結果 list（每筆含 id/status/seconds/xlsx/pdf/error/stages）。
+      jobs  : worker process 數；0 = 在目前程序內依序跑（除錯用）
+      order : "input"（報告依輸入順序輸出）或 "completion"（完成一筆寫一筆）
+      report_path : 結果追加寫入的 JSONL（--resume 依此略過已成功的 id）
+      templates   : 範本登錄；None = 只有 template_xlsx / sheet 這一個預設範本
+    """
+    if order not in ("input", "completion"):
+        raise ValueError(f"不支援的 order：{order}（input / completion）")
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    templates = templates or TemplateRegistry(None, template_xlsx, sheet)
+    prepared = []
+    for rec, base in zip(records, _output_bases(records)):
+        rec = {**rec, "base": base}
+        if not rec.get("error"):
+            try:
+                rec["tpl"] = templates.select(rec.get("template"), client=rec["sets"].get("ClientName"))
+            except (OSError, ValueError, zipfile.BadZipFile) as e:  # 含 UnknownTemplate
+                rec["error"] = f"{type(e).__name__}: {e}"
+        prepared.append(rec)
+    records = prepared
+    opts = {
+        "template_xlsx": template_xlsx, "out_dir": out_dir, "sheet": sheet,
+        "pdf_engine": pdf_engine.lower(), "soffice_path": soffice_path, "calc_mode": calc_mode,
+        "want_xlsx": want_xlsx, "quiet": quiet,
+    }
+    report_f = open(report_path, "a", encoding="utf-8") if report_path else None
+    results: List[Dict[str, Any]] = []
+    pending: Dict[int, Dict[str, Any]] = {}   # order="input" 時先暫存，等前面的完成
+    next_idx = 0
+
+    def emit(r: Dict[str, Any]):
+        results.append(r)
+        mark = "OK  " if r["status"] == "ok" else "FAIL"
+        print(f"[BATCH] {mark} {r['id']:<12} {r['seconds'] * 1000:8.1f} ms  {r['pdf'] or r['error']}")
+        if report_f:
+            report_f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            report_f.flush()
+
+    def collect(idx: int, r: Dict[str, Any]):
+        nonlocal next_idx
+        if order == "completion":
+            emit(r)
+            return
+        pending[idx] = r
+        while next_idx in pending:
+            emit(pending.pop(next_idx))
+            next_idx += 1
+
+    try:
+        if jobs <= 0:
+            _init_worker({**opts, "quiet": False})
+            for i, rec in enumerate(records):
+                collect(i, _run_record(rec))
+        else:
+            # spawn：父程序可能已載入 .NET runtime（例如從 make_quote_linux 進來），fork 會複製到不安全的狀態
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx,
+                                     initializer=_init_worker, initargs=(opts,)) as pool:
+                futs = {pool.submit(_run_record, rec): (i, rec) for i, rec in enumerate(records)}
+                for fut in as_completed(futs):
+                    i, rec = futs[fut]
+                    try:
+                        r = fut.result()
+                    except Exception as e:  # worker 整個掛掉（BrokenProcessPool 等）
+                        r = {"id": rec["id"], "status": "failed", "pid": None, "xlsx": None, "pdf": None,
+                             "error": f"{type(e).__name__}: {e}", "seconds": 0.0, "stages": {}}
+                    collect(i, r)
+    finally:
+        if report_f:
+            report_f.close()
+    return results
+
+def print_batch_summary(results: List[Dict[str, Any]], wall: float):
+    ok = [r for r in results if r["status"] == "ok"]
+    failed = [r for r in results if r["status"] != "ok"]
+    secs = sorted(r["seconds"] for r in ok)
+    print(f"[BATCH] 完成 {len(ok)} 筆，失敗 {len(failed)} 筆，總耗時 {wall:.1f} s"
+          + (f"，吞吐 {len(results) / wall:.2f} 筆/s" if wall > 0 and results else ""))
+    if secs:
+        print(f"[BATCH] 單筆耗時 p50 {median(secs) * 1000:.0f} ms，"
+              f"p95 {secs[min(len(secs) - 1, int(len(secs) * 0.95))] * 1000:.0f} ms，最慢 {secs[-1] * 1000:.0f} ms")
+    for r in failed:
+        print(f"[BATCH] 失敗 {r['id']}：{r['error']}", file=sys.stderr)
+
+# ---------------- CLI ----------------
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="make_quote_linux.py batch", description="批次產生報價單（多 process 平行）")
+    ap.add_argument("--in", dest="xlsx_in", required=True, help="範本路徑")
+    ap.add_argument("--records", required=True, help="批次清單（.jsonl / .csv / .txt）")
+    ap.add_argument("--format", choices=["jsonl", "csv", "texts"], default=None, help="清單格式（預設依副檔名）")
+    ap.add_argument("--out-dir", default="batch_out", help="輸出目錄（預設 batch_out）")
+    ap.add_argument("--sheet", default=None, help="報價單所在工作表（預設第一張）")
+    ap.add_argument("--templates", default=TEMPLATES_FILE,
+                    help=f"範本設定 JSON（預設 {TEMPLATES_FILE}；不存在時只用 --in / --sheet）")
+    ap.add_argument("--pdf-engine", choices=["libreoffice", "aspose", "native", "overlay"], default="libreoffice")
+    ap.add_argument("--no-xlsx", dest="want_xlsx", action="store_false",
+                    help="不產生 Excel（僅 --pdf-engine native / overlay 可用）")
+    ap.add_argument("--calc-mode", choices=["python", "chain", "full"], default="chain")
+    ap.add_argument("--soffice", dest="soffice_path", default=None)
+    ap.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                    help="worker process 數（預設 CPU 數的一半；0 = 不開 process，依序跑）")
+    ap.add_argument("--order", choices=["input", "completion"], default="input",
+                    help="結果輸出順序：input（依清單順序，預設）或 completion（完成即輸出）")
+    ap.add_argument("--report", default=None, help="逐筆結果 JSONL（預設 <out-dir>/batch_report.jsonl）")
+    ap.add_argument("--resume", action="store_true", help="略過報告中已成功的 id，只重跑失敗 / 未跑的")
+    ap.add_argument("--verbose", action="store_true", help="顯示 worker 內 make_quote 的逐步輸出")
+    args = ap.parse_args(argv)
+
+    records = load_records(args.records, args.format)
+    report_path = args.report or str(Path(args.out_dir) / "batch_report.jsonl")
+    if args.resume:
+        done = load_done_ids(report_path)
+        skipped = sum(1 for r in records if r["id"] in done)
+        records = [r for r in records if r["id"] not in done]
+        print(f"[BATCH] --resume：略過已成功 {skipped} 筆，剩 {len(records)} 筆")
+    elif Path(report_path).exists():
+        Path(report_path).unlink()  # 非續跑：重新開始一份報告
+
+    t0 = time.perf_counter()
+    results = run_batch(
+        records,
+        template_xlsx=args.xlsx_in,
+        out_dir=args.out_dir,
+        sheet=args.sheet,
+        pdf_engine=args.pdf_engine,
+        soffice_path=args.soffice_path,
+        calc_mode=args.calc_mode,
+        want_xlsx=args.want_xlsx,
+        jobs=args.jobs,
+        order=args.order,
+        report_path=report_path,
+        quiet=not args.verbose,
+        templates=TemplateRegistry(args.templates, args.xlsx_in, args.sheet),
+    )
+    print_batch_summary(results, time.perf_counter() - t0)
+    print(f"[BATCH] 報告：{report_path}")
+    return 1 if any(r["status"] != "ok" for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+# quote_jobs.py
+# 報價單非同步工作佇列：webhook 只負責收件與回覆「已收到」，實際產檔交給背景 worker，
+# 完成後由 on_done 回呼（在主程序執行）用 push_message 把連結送回去。
+#
+# - mode="thread"：ThreadPoolExecutor（Aspose/soffice 大多在原生程式碼裡跑，但 .NET 記憶體留在 web 程序裡）
+# - mode="process"：ProcessPoolExecutor（spawn；Aspose / .NET runtime 只在子程序裡，工作函式需可 pickle）
+#   worker 回收：pool 平均每個 worker 收滿 max_tasks 件，或任一 worker 回報的 RSS 超過 max_rss_mb 時，
+#   整個 pool 換新一代——舊 pool 不取消工作，執行中與已排進去的工作跑完後舊 worker 才結束，不會掉件
+#   （不用 max_tasks_per_child：Python 3.11 在還有排隊工作時換 worker 會卡死）
+# - 佇列有上限，滿了 submit() 直接丟 QueueFull，由呼叫端回覆「忙碌中」
+#
+# 函式入口：
+#   QuoteJobQueue(workers=2, mode="thread", max_pending=20, max_tasks=0, max_rss_mb=0)
+#   QuoteJobQueue.submit(fn, *args, on_done=None, **kwargs) -> QuoteJob
+#   QuoteJobQueue.run(fn, *args, **kwargs) -> 結果   # 同步在 worker 裡跑（不記成工作）
+#   QuoteJobQueue.stats() -> dict（含各 worker 的 pid / 件數 / RSS）
+#   QuoteJobQueue.warm(fn, **kwargs) -> [Future]   # 每個 worker 跑一次（啟動暖機，見 warmup.py）
+#   run_quote_job(**kwargs) -> dict   # 可給 process pool 用的產檔流程
+#   run_xlsx_job(**kwargs) -> str     # 只產 xlsx（按需 xlsx，見 lazy_xlsx.py）
+
+import multiprocessing as mp
+import os, sys, time, uuid, threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List
+
+from metrics import Counter, Gauge, JOB_SECONDS, QUEUE_WAIT, drain, log_event, merge, request_context
+from profiling import profiled
+
+class QueueFull(Exception):
+    """排隊中的工作已達上限。"""
+
+class QuoteJob:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        # queued -> running -> done / failed；process 模式主程序看不到開跑，queued 直接到 done / failed，
+        # started 為 worker 回報的實際開跑時間
+        self.status = "queued"
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.result: Any = None
+        self.error: str | None = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+            "error": self.error,
+        }
+
+# ---------------- worker 端（process 模式，子程序內執行） ----------------
+_worker_jobs = 0
+
+def _rss_bytes() -> int:
+    """目前程序的常駐記憶體（Linux 讀 /proc，其他平台用 ru_maxrss 近似）。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+def _worker_init(workers: int):
+    """
+    process 模式子程序啟動時執行：soffice 常駐池改成每個 worker 自己一份（各挑空閒 port、
+    以 pid 區分 profile），子程序結束（含換代回收）時由 atexit 收掉；一次性 soffice 的
+    同時執行上限按 worker 數平分，整台主機加總仍不超過上限。
+    """
+    import atexit
+    import soffice_pool, soffice_scheduler
+
+    soffice_pool.PER_PROCESS = True
+    soffice_scheduler.WORKER_SHARE = max(1, workers)
+    atexit.register(soffice_pool.close_pool)
+
+def _worker_call(fn: Callable, args, kwargs):
+    """
+    在子程序裡執行 fn，連同這個 worker 的 pid / 已處理件數 / RSS、實際開跑時間，以及這段期間累積的
+    metrics（子階段耗時、引擎回退、soffice 耗時等）一起回傳，由主程序合併進 /metrics。
+    fn 丟例外時計數留在子程序，隨下一件工作一起送回；開跑時間掛在例外上（pickle 會帶回 __dict__）。
+    """
+    global _worker_jobs
+    started = time.time()
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        e.worker_started = started
+        raise
+    _worker_jobs += 1
+    return result, {"pid": os.getpid(), "jobs": _worker_jobs, "rss": _rss_bytes(), "started": started,
+                    "metrics": drain()}
+
+def _worker_warm(fn: Callable, args, kwargs):
+    """暖機（假報價單）產生的 metrics 直接丟掉，不算進真實請求。"""
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        drain()
+
+# ---------------- 主程序端 ----------------
+WORKER_RECYCLES = Counter("quote_worker_recycles_total", "Quote worker pools replaced", ("reason",))
+
+class QuoteJobQueue:
+    def __init__(self, workers: int = 2, mode: str = "thread", max_pending: int = 20, keep_finished: int = 500,
+                 max_tasks: int = 0, max_rss_mb: float = 0):
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.max_pending = max(0, max_pending)
+        self.keep_finished = keep_finished
+        self.max_tasks = max(0, max_tasks)
+        self.max_rss = max(0.0, max_rss_mb) * 1024 * 1024
+        if mode not in ("thread", "process"):
+            raise ValueError(f"不支援的 JOB_MODE：{mode}（thread / process）")
+        self._generation = 0
+        self._gen_tasks = 0   # 這一代 pool 已收的件數
+        self._pool = self._new_pool()
+        self._jobs: "OrderedDict[str, QuoteJob]" = OrderedDict()
+        self._active = 0   # queued + running
+        self._lock = threading.Lock()
+        # pid -> {"jobs", "rss", "generation", "seen"}（process 模式，每件工作回報一次）
+        self._workers: Dict[int, Dict[str, Any]] = {}
+        self.recycles = 0
+        self.on_recycle: Callable[[], None] | None = None   # 換新 pool 後呼叫（例如重新暖機）
+        Gauge("quote_jobs_active", "Quote jobs queued or running", lambda: self._active)
+        Gauge("quote_worker_rss_max_bytes", "Largest RSS reported by a live quote worker",
+              lambda: max((w["rss"] for w in self._live_workers()), default=0))
+
+    def _new_pool(self):
+        if self.mode == "thread":
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="quote")
+        # spawn：子程序不繼承 uvicorn / aiohttp 的執行緒與連線
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=mp.get_context("spawn"),
+                                   initializer=_worker_init, initargs=(self.workers,))
+
+    def _submit_locked(self, fn: Callable, *args):
+        """持有 self._lock 時呼叫：送進目前這一代 pool；收滿件數就換代。回傳 (future, 代數, 被換掉的舊 pool)。"""
+        fut = self._pool.submit(fn, *args)
+        gen, old = self._generation, None
+        self._gen_tasks += 1
+        if self.mode == "process" and self.max_tasks and self._gen_tasks >= self.max_tasks * self.workers:
+            old = self._swap_locked()
+        return fut, gen, old
+
+    # ---- 提交 ----
+    def submit(self, fn: Callable, *args, on_done: Callable[[QuoteJob], None] | None = None, **kwargs) -> QuoteJob:
+        with self._lock:
+            # 允許同時有 workers 個在跑 + max_pending 個在排
+            if self._active >= self.workers + self.max_pending:
+                raise QueueFull(f"目前排隊 {self._active} 件，已達上限")
+            self._active += 1
+            job = QuoteJob(uuid.uuid4().hex[:12])
+            self._jobs[job.id] = job
+            self._trim()
+
+            if self.mode == "thread":
+                fut, gen, old = self._submit_locked(self._run_inline, job, fn, args, kwargs)
+            else:
+                # 維持 queued：實際開跑時間由 worker 在 wstats["started"] 回報（見 _finish）
+                fut, gen, old = self._submit_locked(_worker_call, fn, args, kwargs)
+        if old is not None:
+            self._retire(old, "tasks")
+        fut.add_done_callback(lambda f: self._finish(job, f, on_done, gen))
+        return job
+
+    def run(self, fn: Callable, *args, timeout: float | None = None, **kwargs) -> Any:
+        """同步在 worker 裡執行 fn 並等結果（不記成工作、不佔佇列名額；例如按需產生 xlsx）。"""
+        if self.mode == "thread":
+            return fn(*args, **kwargs)
+        with self._lock:
+            fut, gen, old = self._submit_locked(_worker_call, fn, args, kwargs)
+        if old is not None:
+            self._retire(old, "tasks")
+        result, wstats = fut.result(timeout=timeout)
+        self._worker_report(wstats, gen)
+        return result
+
+    def warm(self, fn: Callable, *args, **kwargs) -> List[Future]:
+        """
+        同時送出 workers 份 fn 直接給 pool（不佔佇列名額、不記成工作），
+        process 模式下會把子程序都啟動起來，各自執行一次。
+        """
+        with self._lock:
+            # 暖機不算進換代件數
+            if self.mode == "process":
+                return [self._pool.submit(_worker_warm, fn, args, kwargs) for _ in range(self.workers)]
+            return [self._pool.submit(fn, *args, **kwargs) for _ in range(self.workers)]
+
+    @staticmethod
+    def _run_inline(job: QuoteJob, fn: Callable, args, kwargs):
+        job.status = "running"
+        job.started = time.time()
+        return fn(*args, **kwargs)
+
+    def _finish(self, job: QuoteJob, fut: Future, on_done, gen: int):
+        job.finished = time.time()
+        # 關閉時 shutdown(cancel_futures=True) 取消的工作：fut.exception() 會直接丟 CancelledError
+        exc = CancelledError("工作已取消（服務關閉中）") if fut.cancelled() else fut.exception()
+        if exc is None:
+            result = fut.result()
+            if self.mode == "process":
+                result, wstats = result
+                job.started = wstats.get("started")
+                self._worker_report(wstats, gen)
+            job.status, job.result = "done", result
+        else:
+            if self.mode == "process":
+                job.started = getattr(exc, "worker_started", None)  # 沒開跑就失敗（pool 壞了）時為 None
+            job.status, job.error = "failed", str(exc)
+            if isinstance(exc, BrokenProcessPool) and gen == self._generation:
+                # worker 被 OOM killer 之類砍掉：整個 pool 不能再用，換一個新的
+                self._recycle("broken", gen)
+        self._observe(job)
+        with self._lock:
+            self._active -= 1
+        if on_done is not None:
+            try:
+                on_done(job)
+            except Exception as e:
+                log_event("job_callback_failed", level="error", job=job.id, error=repr(e))
+
+    # ---- worker 回收 ----
+    def _worker_report(self, wstats: Dict[str, Any] | None, gen: int):
+        if not wstats:
+            return
+        merge(wstats.get("metrics"))
+        with self._lock:
+            self._workers[wstats["pid"]] = {"jobs": wstats["jobs"], "rss": wstats["rss"],
+                                            "generation": gen, "seen": time.time()}
+            # 只留最近一小時回報過的，換掉的 worker 自然淘汰
+            for pid in [p for p, w in self._workers.items() if time.time() - w["seen"] > 3600]:
+                del self._workers[pid]
+        if self.max_rss and wstats["rss"] > self.max_rss:
+            self._recycle("rss", gen)
+
+    def _swap_locked(self):
+        old = self._pool
+        self._pool = self._new_pool()
+        self._generation += 1
+        self._gen_tasks = 0
+        self.recycles += 1
+        return old
+
+    def _recycle(self, reason: str, gen: int):
+        with self._lock:
+            if gen != self._generation:
+                return  # 同一代已經換過了
+            old = self._swap_locked()
+        self._retire(old, reason)
+
+    def _retire(self, old, reason: str):
+        """
+        新工作已改送新 pool；舊 pool shutdown(wait=False) 但不取消，
+        已送出（執行中 + 排隊中）的工作照常跑完後舊 worker 才結束。
+        """
+        old.shutdown(wait=False, cancel_futures=False)
+        WORKER_RECYCLES.inc(reason=reason)
+        log_event("worker_recycle", reason=reason, generation=self._generation)
+        if self.on_recycle is not None:
+            try:
+                self.on_recycle()
+            except Exception as e:
+                log_event("worker_recycle_callback_failed", level="error", error=repr(e))
+
+    def _live_workers(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [w for w in self._workers.values() if w["generation"] == self._generation]
+
+    def _observe(self, job: QuoteJob):
+        if job.started is not None:
+            QUEUE_WAIT.observe(job.started - job.created)
+            JOB_SECONDS.observe(job.finished - job.started, status=job.status)
+        # process 模式的各階段 / 子階段耗時已隨 wstats["metrics"] 合併（見 _worker_report）
+
+    def _trim(self):
+        # 只保留最近 keep_finished 筆已結束的紀錄，避免記憶體無限成長
+        finished = [k for k, j in self._jobs.items() if j.status in ("done", "failed")]
+        for k in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[k]
+
+    # ---- 查詢 ----
+    def get(self, job_id: str) -> QuoteJob | None:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = {
+                "mode": self.mode,
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "active": self._active,
+            }
+            if self.mode == "process":
+                out.update({
+                    "generation": self._generation, "recycles": self.recycles,
+                    "max_tasks": self.max_tasks, "max_rss_mb": self.max_rss / 1024 / 1024,
+                    "worker_stats": [
+                        {"pid": pid, "jobs": w["jobs"], "rss_mb": round(w["rss"] / 1024 / 1024, 1),
+                         "generation": w["generation"], "live": w["generation"] == self._generation}
+                        for pid, w in self._workers.items()
+                    ],
+                })
+            return out
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            pool = self._pool
+        pool.shutdown(wait=wait, cancel_futures=not wait)
+
+# ---------------- 產檔流程（module 層級，process pool 可 pickle） ----------------
+def run_quote_job(
+    *,
+    template_xlsx: str,
+    base_path: str,
+    sheet: str | None,
+    sets: Dict[str, str],
+    items: List[Dict[str, str]],
+    pdf_engine: str,
+    soffice_path: str | None,
+    want_xlsx: bool = True,
+    request_id: str | None = None,
+    template_row: int = 11,
+    first_insert_row: int = 12,
+) -> Dict[str, Any]:
+    """
+    產生 xlsx + PDF，回傳 {"xlsx": 路徑或 None, "pdf": 給使用者的 PDF 路徑, "stages": [...], "engine": ...}。
+    浮水印只在 Aspose 匯出時於記憶體內去除（見 export_sheet_to_pdf_aspose），不另存 _clean.pdf。
+    """
+    from make_quote_linux import StageReport, make_quote
+
+    report = StageReport(engine=pdf_engine.lower(), request=request_id)
+
+    with request_context(request_id), profiled("make_quote", request_id) as cap:
+        if cap is not None:
+            # stages 是同一個 list，失敗時也留得下已跑完的階段
+            cap.note(engine=report.engine, items=len(items), template=template_xlsx, stages=report.stages)
+        xlsx_out, pdf_out = make_quote(
+            xlsx_in=template_xlsx,
+            name=base_path,
+            sheet=sheet,
+            sets=sets,
+            items=items,
+            template_row=template_row,
+            first_insert_row=first_insert_row,
+            pdf_engine=pdf_engine,
+            soffice_path=soffice_path,
+            want_xlsx=want_xlsx,
+            report=report,
+        )
+    return {"xlsx": xlsx_out, "pdf": pdf_out, "stages": report.stages, "engine": report.engine}
+
+def run_xlsx_job(**kwargs) -> str:
+    """make_quote_xlsx 的 module 層級包裝：主程序不必為了 pickle 函式參照而載入 Aspose。"""
+    from make_quote_linux import make_quote_xlsx
+
+    xlsx_in, xlsx_out = kwargs.pop("xlsx_in"), kwargs.pop("xlsx_out")
+    return make_quote_xlsx(xlsx_in, xlsx_out, **kwargs)
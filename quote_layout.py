@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# quote_layout.py
+# 從範本 .xlsx（純 zip + XML，不需 Aspose）抽出版面資訊，給原生 PDF 引擎使用：
+#   欄寬 / 列高、儲存格文字與樣式（字級、粗體、對齊、框線、數字格式、底色）、
+#   合併儲存格、Named Range 座標、圖片（含錨點）、頁邊距
+#
+# 抽取結果以 (路徑, mtime_ns, size, 工作表) 為鍵快取在記憶體，範本更新時自動重抽。
+#
+# 函式入口：
+#   load_layout(xlsx_path, sheet=None) -> dict
+
+import os, re, threading, zipfile, posixpath
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+from xml.etree import ElementTree as ET
+
+NS = {
+    "m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "pr": "http://schemas.openxmlformats.org/package/2006/relationships",
+    "xdr": "http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing",
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+}
+EMU_PER_PT = 12700
+
+# 內建數字格式（只處理報價單會用到的幾類）
+_BUILTIN_NUMFMT = {
+    1: "0", 2: "0.00", 3: "#,##0", 4: "#,##0.00",
+    37: "#,##0", 38: "#,##0", 39: "#,##0.00", 40: "#,##0.00",
+}
+_BUILTIN_DATE_IDS = set(range(14, 23)) | {27, 30, 36, 50, 57}
+
+def _col_index(ref: str) -> int:
+    n = 0
+    for ch in ref:
+        if ch.isalpha():
+            n = n * 26 + (ord(ch.upper()) - 64)
+        else:
+            break
+    return n - 1
+
+def parse_ref(ref: str) -> Tuple[int, int]:
+    """'B11' / '$B$11' -> (row0, col0)"""
+    ref = ref.replace("$", "")
+    m = re.match(r"([A-Za-z]+)(\d+)", ref)
+    if not m:
+        raise ValueError(f"無法解析儲存格位置：{ref}")
+    return int(m.group(2)) - 1, _col_index(m.group(1))
+
+def _width_to_pt(width_chars: float) -> float:
+    # Excel 欄寬（字元數）-> 像素（預設字型 7px）-> pt
+    return (width_chars * 7 + 5) * 0.75
+
+def _rel_targets(z: zipfile.ZipFile, rels_path: str) -> Dict[str, str]:
+    if rels_path not in z.namelist():
+        return {}
+    base = posixpath.dirname(posixpath.dirname(rels_path))
+    out = {}
+    for rel in ET.fromstring(z.read(rels_path)).findall("pr:Relationship", NS):
+        target = rel.get("Target", "")
+        out[rel.get("Id")] = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(base, target))
+    return out
+
+def _parse_styles(z: zipfile.ZipFile) -> List[Dict[str, Any]]:
+    if "xl/styles.xml" not in z.namelist():
+        return [{}]
+    root = ET.fromstring(z.read("xl/styles.xml"))
+    numfmts = {int(n.get("numFmtId")): n.get("formatCode", "") for n in root.iterfind("m:numFmts/m:numFmt", NS)}
+    fonts = []
+    for f in root.iterfind("m:fonts/m:font", NS):
+        sz = f.find("m:sz", NS)
+        fonts.append({"size": float(sz.get("val")) if sz is not None else 11.0,
+                      "bold": f.find("m:b", NS) is not None})
+    fills = []
+    for f in root.iterfind("m:fills/m:fill", NS):
+        pf = f.find("m:patternFill", NS)
+        fg = pf.find("m:fgColor", NS) if pf is not None else None
+        rgb = fg.get("rgb") if fg is not None and pf.get("patternType") == "solid" else None
+        fills.append(rgb[-6:] if rgb else None)
+    borders = []
+    for b in root.iterfind("m:borders/m:border", NS):
+        side = {}
+        for name, key in (("left", "l"), ("right", "r"), ("top", "t"), ("bottom", "b")):
+            el = b.find(f"m:{name}", NS)
+            side[key] = el is not None and el.get("style") is not None
+        borders.append(side)
+
+    styles = []
+    for xf in root.iterfind("m:cellXfs/m:xf", NS):
+        font = fonts[int(xf.get("fontId", 0))] if fonts else {"size": 11.0, "bold": False}
+        al = xf.find("m:alignment", NS)
+        fmt_id = int(xf.get("numFmtId", 0))
+        code = numfmts.get(fmt_id, _BUILTIN_NUMFMT.get(fmt_id, ""))
+        is_date = fmt_id in _BUILTIN_DATE_IDS or bool(re.search(r"[ymd]", re.sub(r'"[^"]*"|\[[^\]]*\]', "", code), re.I))
+        styles.append({
+            "size": font["size"],
+            "bold": font["bold"],
+            "align": al.get("horizontal", "general") if al is not None else "general",
+            "valign": al.get("vertical", "bottom") if al is not None else "bottom",
+            "wrap": al is not None and al.get("wrapText") == "1",
+            "border": borders[int(xf.get("borderId", 0))] if borders else {"l": False, "r": False, "t": False, "b": False},
+            "fill": fills[int(xf.get("fillId", 0))] if fills else None,
+            "numfmt": "date" if is_date else code,
+        })
+    return styles or [{}]
+
+def _shared_strings(z: zipfile.ZipFile) -> List[str]:
+    if "xl/sharedStrings.xml" not in z.namelist():
+        return []
+    out = []
+    for si in ET.fromstring(z.read("xl/sharedStrings.xml")).iterfind("m:si", NS):
+        # 只取正文 <t>（略過注音 rPh）
+        out.append("".join(t.text or "" for t in si.findall("m:t", NS) + si.findall("m:r/m:t", NS)))
+    return out
+
+def format_value(value: Any, numfmt: str) -> str:
+    """依儲存格數字格式把值轉成顯示文字（日期 / 千分位 / 小數位）。"""
+    if value is None or value == "":
+        return ""
+    if isinstance(value, str):
+        try:
+            num = float(value)
+        except ValueError:
+            return value
+    else:
+        num = value
+    if isinstance(num, bool) or not isinstance(num, (int, float)):
+        return str(value)
+    if numfmt == "date":
+        return (date(1899, 12, 30) + timedelta(days=int(num))).strftime("%Y/%m/%d")
+    decimals = 2 if ".00" in numfmt else 0 if numfmt else None
+    if "#,##" in numfmt:
+        return f"{num:,.{decimals}f}"
+    if decimals is not None and numfmt:
+        return f"{num:.{decimals}f}"
+    return str(int(num)) if float(num).is_integer() else str(num)
+
+def extract_layout(xlsx_path: str, sheet: str | None = None) -> Dict[str, Any]:
+    with zipfile.ZipFile(xlsx_path) as z:
+        wb = ET.fromstring(z.read("xl/workbook.xml"))
+        wb_rels = _rel_targets(z, "xl/_rels/workbook.xml.rels")
+        sheets = wb.findall("m:sheets/m:sheet", NS)
+        if not sheets:
+            raise ValueError(f"範本沒有工作表：{xlsx_path}")
+        if sheet:
+            match = [s for s in sheets if s.get("name") == sheet]
+            if not match:
+                raise ValueError(f"找不到工作表：{sheet}")
+            sh = match[0]
+        else:
+            sh = sheets[0]
+        sheet_name = sh.get("name")
+        sheet_path = wb_rels[sh.get(f"{{{NS['r']}}}id")]
+
+        names: Dict[str, Tuple[int, int]] = {}
+        for dn in wb.iterfind("m:definedNames/m:definedName", NS):
+            text = (dn.text or "").strip()
+            if "!" not in text:
+                continue
+            ref_sheet, ref = text.rsplit("!", 1)
+            if ref_sheet.strip("'") != sheet_name:
+                continue
+            try:
+                names[dn.get("name")] = parse_ref(ref.split(":")[0])
+            except ValueError:
+                continue
+
+        strings = _shared_strings(z)
+        styles = _parse_styles(z)
+        root = ET.fromstring(z.read(sheet_path))
+
+        fmt = root.find("m:sheetFormatPr", NS)
+        default_w = float(fmt.get("defaultColWidth", 8.43)) if fmt is not None else 8.43
+        default_h = float(fmt.get("defaultRowHeight", 15)) if fmt is not None else 15.0
+
+        widths: Dict[int, float] = {}
+        for col in root.iterfind("m:cols/m:col", NS):
+            lo, hi = int(col.get("min")), int(col.get("max"))
+            for c in range(lo - 1, min(hi, 64)):  # 報價單不會用到 64 欄以外
+                widths[c] = _width_to_pt(float(col.get("width", default_w)))
+
+        heights: Dict[int, float] = {}
+        cells: List[Dict[str, Any]] = []
+        for row in root.iterfind("m:sheetData/m:row", NS):
+            r0 = int(row.get("r")) - 1
+            if row.get("ht"):
+                heights[r0] = float(row.get("ht"))
+            for c in row.iterfind("m:c", NS):
+                rr, cc = parse_ref(c.get("r"))
+                v = c.find("m:v", NS)
+                t = c.get("t")
+                if t == "s" and v is not None:
+                    value: Any = strings[int(v.text)]
+                elif t == "inlineStr":
+                    value = "".join(x.text or "" for x in c.iter(f"{{{NS['m']}}}t"))
+                elif v is not None and v.text is not None:
+                    try:
+                        value = float(v.text)
+                    except ValueError:
+                        value = v.text
+                else:
+                    value = None
+                cells.append({"row": rr, "col": cc, "value": value, "style": int(c.get("s", 0))})
+
+        merges = [
+            [*parse_ref(m.get("ref").split(":")[0]), *parse_ref(m.get("ref").split(":")[-1])]
+            for m in root.iterfind("m:mergeCells/m:mergeCell", NS)
+        ]
+
+        pm = root.find("m:pageMargins", NS)
+        margins = {k: float(pm.get(k, 0.5)) * 72 if pm is not None else 36.0
+                   for k in ("left", "right", "top", "bottom")}
+        po = root.find("m:printOptions", NS)
+        centered = po is not None and po.get("horizontalCentered") == "1"
+
+        images: List[Dict[str, Any]] = []
+        sheet_rels = _rel_targets(z, posixpath.join(posixpath.dirname(sheet_path), "_rels",
+                                                    posixpath.basename(sheet_path) + ".rels"))
+        drawing = root.find("m:drawing", NS)
+        if drawing is not None:
+            dpath = sheet_rels[drawing.get(f"{{{NS['r']}}}id")]
+            drels = _rel_targets(z, posixpath.join(posixpath.dirname(dpath), "_rels", posixpath.basename(dpath) + ".rels"))
+            droot = ET.fromstring(z.read(dpath))
+            for anchor in list(droot.iterfind("xdr:twoCellAnchor", NS)) + list(droot.iterfind("xdr:oneCellAnchor", NS)):
+                blip = anchor.find(".//a:blip", NS)
+                frm = anchor.find("xdr:from", NS)
+                if blip is None or frm is None:
+                    continue
+                ext = anchor.find(".//a:xfrm/a:ext", NS)
+                if ext is None:
+                    ext = anchor.find("xdr:ext", NS)
+                pos = [int(frm.find(f"xdr:{k}", NS).text) for k in ("col", "colOff", "row", "rowOff")]
+                images.append({
+                    "col": pos[0], "col_off": pos[1] / EMU_PER_PT,
+                    "row": pos[2], "row_off": pos[3] / EMU_PER_PT,
+                    "width": int(ext.get("cx")) / EMU_PER_PT if ext is not None else 0.0,
+                    "height": int(ext.get("cy")) / EMU_PER_PT if ext is not None else 0.0,
+                    "data": z.read(drels[blip.get(f"{{{NS['r']}}}embed")]),
+                })
+
+    max_row = max([c["row"] for c in cells] + [m[2] for m in merges] + [0])
+    # 只印有內容或有框線的欄（範本常把整排 H:U 設樣式但沒內容）
+    used_cols = [c["col"] for c in cells
+                 if (c["value"] not in (None, "") or any(styles[min(c["style"], len(styles) - 1)].get("border", {}).values()))]
+    used_cols += [m[3] for m in merges] + [i["col"] for i in images]
+    max_col = max(used_cols + [0])
+
+    return {
+        "sheet": sheet_name,
+        "col_widths": [widths.get(c, _width_to_pt(default_w)) for c in range(max_col + 1)],
+        "row_heights": heights,
+        "default_row_height": default_h,
+        "max_row": max_row,
+        "max_col": max_col,
+        "cells": [c for c in cells if c["col"] <= max_col],
+        "styles": styles,
+        "merges": merges,
+        "names": names,
+        "images": images,
+        "margins": margins,
+        "centered": centered,
+    }
+
+_layouts: Dict[Tuple[str, int, int, str | None], Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+def load_layout(xlsx_path: str, sheet: str | None = None) -> Dict[str, Any]:
+    """取得範本版面（同一檔案 + 工作表只抽取一次；檔案更新後自動重抽）。"""
+    path = str(Path(xlsx_path).resolve())
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size, sheet)
+    with _lock:
+        hit = _layouts.get(key)
+    if hit is not None:
+        return hit
+    layout = extract_layout(path, sheet)
+    layout["version"] = key[:3]  # 給下游快取（如 overlay 底圖）判斷範本是否更新
+    with _lock:
+        # 同一範本舊版本的抽取結果一併丟掉
+        for k in [k for k in _layouts if k[0] == path and k[3] == sheet]:
+            del _layouts[k]
+        _layouts[key] = layout
+    return layout
@@ -1,28 +1,61 @@
+import sys
+
 import fitz  # PyMuPDF
 
-def remove_watermark(input_pdf, output_to_user_pdf):
-    # 打开 PDF 文件
-    doc = fitz.open(input_pdf)
-    
-    watermark_text = "Evaluation Only. Created with Aspose.Cells for Python via .NET. Copyright 2003 - 2025 Aspose Pty Ltd."
-    # 遍历每一页
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text_instances = page.search_for(watermark_text)
-        
-        # 遍历找到的水印实例
-        for inst in text_instances:
-            page.add_redact_annot(inst, fill=(1, 1, 1))  # 用白色填充覆盖水印
+WATERMARK_TEXT = "Evaluation Only. Created with Aspose.Cells for Python via .NET. Copyright 2003 - 2025 Aspose Pty Ltd."
+
+def strip_watermark_bytes(pdf_bytes: bytes, watermark_text: str = WATERMARK_TEXT,
+                          subset_fonts: bool = False) -> bytes:
+    """
+    在記憶體內移除浮水印：每頁先標完所有命中位置，再一次 apply_redactions。
+    沒有命中任何浮水印時原樣回傳，不重新序列化（subset_fonts=True 時一律子集化內嵌字型後重寫）。
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        # 產生者不是 Aspose 就不用逐頁搜尋（例如 LibreOffice 產的 PDF）
+        producer = f"{doc.metadata.get('producer', '')} {doc.metadata.get('creator', '')}"
+        if producer.strip() and "aspose" not in producer.lower():
+            return _subset(doc) if subset_fonts else pdf_bytes
+        hit = False
+        for page in doc:
+            rects = page.search_for(watermark_text)
+            if not rects:
+                continue
+            for inst in rects:
+                page.add_redact_annot(inst, fill=(1, 1, 1))  # 用白色填充覆蓋水印
             page.apply_redactions()
-    
-    # 保存修改后的 PDF
-    doc.save(output_to_user_pdf)
+            hit = True
+        if subset_fonts:
+            return _subset(doc)
+        if not hit:
+            return pdf_bytes
+        return doc.tobytes(garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+def _subset(doc: fitz.Document) -> bytes:
+    doc.subset_fonts()
+    return doc.tobytes(garbage=3, deflate=True)
+
+def subset_pdf_fonts(pdf_bytes: bytes) -> bytes:
+    """只把內嵌字型子集化（不找浮水印）。"""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return _subset(doc)
+    finally:
+        doc.close()
+
+def remove_watermark(input_pdf, output_to_user_pdf):
+    # 舊介面：讀檔 -> 記憶體處理 -> 寫檔
+    with open(input_pdf, "rb") as f:
+        data = strip_watermark_bytes(f.read())
+    with open(output_to_user_pdf, "wb") as f:
+        f.write(data)
     print(f"水印已成功移除，保存为 {output_to_user_pdf}")
     return output_to_user_pdf
 
 if __name__ == "__main__":
-    input_pdf = r"C:\Users\j2096\OneDrive\Desktop\QuotationBot\凱凱超級公司.pdf"
-    output_pdf = "output.pdf"
-    watermark_text = "Confidential"  # 这里替换为你的水印文本
-
-    remove_watermark(input_pdf, output_pdf, watermark_text)
+    if len(sys.argv) != 3:
+        print("用法：python remove_watermark.py 輸入.pdf 輸出.pdf", file=sys.stderr)
+        sys.exit(2)
+    remove_watermark(sys.argv[1], sys.argv[2])
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# result_cache.py
+# 報價結果快取：同一份內容（sets/items）+ 同一個範本/分頁/引擎，直接回傳上次產好的 xlsx/PDF，不再重做。
+#
+# - 鍵 = 正規化後內容的 SHA-256（鍵排序、去空白、數字統一成數值），
+#   範本以 (絕對路徑, mtime_ns, size) 代表，範本被換掉時該範本的舊結果全部作廢
+# - 以 TTL + 筆數上限 + 檔案總 bytes 上限做 LRU 淘汰；淘汰只是忘記，不刪檔（檔案仍可下載）
+# - 產出檔案被刪掉時視同未命中（判斷方式可換成 output_store.exists，見 exists 屬性）
+#
+# 函式入口：
+#   RESULT_CACHE.key(template_xlsx, sheet, engine, sets, items, want_xlsx=True) -> str
+#   RESULT_CACHE.get(key) -> {"xlsx": ..., "pdf": ...} | None
+#   RESULT_CACHE.put(key, result)
+
+import hashlib, json, os, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))       # 秒；0 = 不快取
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_NUMERIC_KEYS = ("Count", "Price", "ProvidePrice")
+
+def _norm_value(key: str, v: Any) -> Any:
+    if isinstance(v, str):
+        v = v.strip()
+    if key in _NUMERIC_KEYS and v not in (None, ""):
+        # "3,000"、"3000"、3000.0 視為同一個值（輸出格式由範本 numfmt 決定，不受影響）
+        try:
+            return float(str(v).replace(",", ""))
+        except ValueError:
+            pass
+    return v
+
+def _norm_dict(d: Dict[str, Any]) -> Dict[str, Any]:
+    return {k.strip(): _norm_value(k.strip(), v) for k, v in sorted((d or {}).items())
+            if v not in (None, "")}
+
+def template_identity(path: str) -> Tuple[str, int, int]:
+    p = Path(path).resolve()
+    st = p.stat()
+    return str(p), st.st_mtime_ns, st.st_size
+
+class ResultCache:
+    def __init__(self, ttl: float = RESULT_CACHE_TTL, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> {"result", "template", "created", "bytes"}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._templates: Dict[str, Tuple[int, int]] = {}   # 範本路徑 -> 目前看到的 (mtime_ns, size)
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.exists: Callable[[str], bool] = os.path.exists
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def key(self, template_xlsx: str, sheet: str | None, engine: str,
+            sets: Dict[str, Any] | None, items: List[Dict[str, Any]] | None, want_xlsx: bool = True) -> str:
+        tpath, mtime_ns, size = template_identity(template_xlsx)
+        self._check_template(tpath, (mtime_ns, size))
+        payload = {
+            "template": [tpath, mtime_ns, size],
+            "sheet": sheet or "",
+            "engine": engine.lower(),
+            "xlsx": bool(want_xlsx),
+            "sets": _norm_dict(sets),
+            "items": [_norm_dict(it) for it in items or []],
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _check_template(self, tpath: str, ident: Tuple[int, int]):
+        # 範本換了：舊 key 不會再命中，順手把它們清掉，免得佔住容量
+        with self._lock:
+            old = self._templates.get(tpath)
+            self._templates[tpath] = ident
+            if old is not None and old != ident:
+                self._drop_where(lambda e: e["template"] == tpath)
+
+    def get(self, key: str) -> Dict[str, str | None] | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is not None:
+                expired = time.time() - ent["created"] > self.ttl
+                files = [p for p in ent["result"].values() if p]
+                if expired or not all(self.exists(p) for p in files):
+                    self._pop(key)
+                    ent = None
+            if ent is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(ent["result"])
+
+    def put(self, key: str, result: Dict[str, str | None], template_xlsx: str | None = None):
+        if not self.enabled:
+            return
+        nbytes = sum(os.path.getsize(p) for p in result.values() if p and os.path.exists(p))
+        tpath = str(Path(template_xlsx).resolve()) if template_xlsx else ""
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = {"result": dict(result), "template": tpath,
+                                  "created": time.time(), "bytes": nbytes}
+            self._total += nbytes
+            while self._entries and (len(self._entries) > self.max_entries or self._total > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str):
+        ent = self._entries.pop(key, None)
+        if ent is not None:
+            self._total -= ent["bytes"]
+
+    def _drop_where(self, pred):
+        for k in [k for k, e in self._entries.items() if pred(e)]:
+            self._pop(k)
+
+    def invalidate(self, template_xlsx: str | None = None):
+        with self._lock:
+            if template_xlsx is None:
+                self._entries.clear()
+                self._total = 0
+                return
+            tpath = str(Path(template_xlsx).resolve())
+            self._drop_where(lambda e: e["template"] == tpath)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total,
+                    "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+RESULT_CACHE = ResultCache()
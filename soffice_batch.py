@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# soffice_batch.py
+# soffice 微批次轉檔：同時間進來的多個轉檔請求，在一個短時間窗內（或湊滿上限）合併成一次
+# `soffice --convert-to pdf a.xlsx b.xlsx ...`，只付一次冷啟動成本，再把各自的 PDF 交回呼叫端。
+#
+# - 每個請求各自等自己的結果；某個檔案轉失敗只影響它自己
+# - 整批 soffice 異常結束時，缺檔的請求改為逐檔重跑一次（壞檔不會拖累同批其他檔案）
+# - soffice 經 soffice_scheduler.py 執行：每批獨立 profile，並和其他一次性 soffice 共用同時執行上限
+# - 窗口越長、批次越大 → 吞吐越高，但單筆 p50 也會多等一個窗口；用 benchmarks/bench_soffice_batch.py 量
+# - 呼叫端正在剖析（profiling.py）時，批次的 soffice 耗時也記進同批每個請求的擷取
+#
+# 設定（環境變數）：
+#   SOFFICE_BATCH_WINDOW_MS : 收集窗口（毫秒）；0 = 不啟用（預設）
+#   SOFFICE_BATCH_MAX       : 每批最多幾個檔案（預設 8）
+#   SOFFICE_BATCH_TIMEOUT   : 單次 soffice 執行逾時秒數（預設 120）
+#
+# 函式入口：
+#   get_batcher(soffice_path, window_ms=None, max_batch=None) -> SofficeBatcher | None
+#   SofficeBatcher.convert(src_path, out_pdf, timeout=None) -> str
+
+import os, time, shutil, subprocess, threading, queue, tempfile
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Dict, List
+
+from metrics import log_event
+from profiling import attached, current
+from soffice_scheduler import get_scheduler
+
+BATCH_WINDOW_MS = float(os.getenv("SOFFICE_BATCH_WINDOW_MS", "0"))
+BATCH_MAX = int(os.getenv("SOFFICE_BATCH_MAX", "8"))
+BATCH_TIMEOUT = float(os.getenv("SOFFICE_BATCH_TIMEOUT", "120"))
+
+class _Request:
+    def __init__(self, src_path: str, out_pdf: str):
+        self.src_path = src_path
+        self.out_pdf = out_pdf
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+        self.capture = current()   # 批次執行緒看不到呼叫端的剖析擷取，先帶過去
+
+class SofficeBatcher:
+    def __init__(self, soffice: str, window_ms: float = BATCH_WINDOW_MS, max_batch: int = BATCH_MAX,
+                 run_timeout: float = BATCH_TIMEOUT):
+        self.soffice = soffice
+        self.window = max(0.0, window_ms) / 1000
+        self.max_batch = max(1, max_batch)
+        self.run_timeout = run_timeout
+        self._queue: "queue.Queue[_Request | None]" = queue.Queue()
+        self._closed = False
+        # 統計
+        self.batches = 0
+        self.files = 0
+        self.failures = 0
+        self.retries = 0
+        self._thread = threading.Thread(target=self._loop, name="soffice-batch", daemon=True)
+        self._thread.start()
+
+    # ---- 呼叫端 ----
+    def convert(self, src_path: str, out_pdf: str, timeout: float | None = None) -> str:
+        """排進下一批，等到自己的 PDF 產生後回傳 out_pdf；失敗丟出該檔案自己的例外。"""
+        if self._closed:
+            raise RuntimeError("soffice 批次轉檔器已關閉")
+        req = _Request(src_path, out_pdf)
+        self._queue.put(req)
+        return req.future.result(timeout=timeout or (self.window + self.run_timeout * 2))
+
+    # ---- 收集 + 執行 ----
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if req is None:
+                    self._queue.put(None)  # 讓外層迴圈收到後結束
+                    break
+                batch.append(req)
+            try:
+                self._run_batch(batch)
+            except Exception as e:  # 保底：不能讓收集執行緒死掉，呼叫端會永遠等
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+
+    def _soffice(self, inputs: List[Path], outdir: Path) -> subprocess.CompletedProcess | None:
+        args = [
+            "--headless", "--nologo", "--nodefault",
+            "--nolockcheck", "--nofirststartwizard", "--norestore",
+            "--convert-to", "pdf:calc_pdf_Export",
+            "--outdir", str(outdir),
+            *[str(p) for p in inputs],
+        ]
+        try:
+            # 排不到空位（SofficeBusy）直接往上丟：整批的呼叫端各自改走 subprocess / Aspose
+            return get_scheduler(self.soffice).run(args, timeout=self.run_timeout)
+        except subprocess.TimeoutExpired:
+            log_event("soffice_batch_timeout", level="warn", files=len(inputs), timeout=self.run_timeout)
+            return None
+
+    def _run_batch(self, batch: List[_Request]):
+        t0 = time.perf_counter()
+        self.batches += 1
+        self.files += len(batch)
+        with tempfile.TemporaryDirectory(prefix="soffice_batch_") as td:
+            td_path = Path(td)
+            # soffice 以檔名決定輸出 PDF 名稱：每個輸入先換成唯一名字（硬連結，不行才複製）
+            staged: Dict[int, Path] = {}
+            for i, r in enumerate(batch):
+                dst = td_path / f"in{i:03d}{Path(r.src_path).suffix or '.xlsx'}"
+                try:
+                    try:
+                        os.link(r.src_path, dst)
+                    except OSError:
+                        shutil.copyfile(r.src_path, dst)
+                    staged[i] = dst
+                except OSError as e:
+                    r.future.set_exception(e)
+
+            outdir = td_path / "out"
+            outdir.mkdir()
+            with attached([batch[i].capture for i in staged]):
+                proc = self._soffice(list(staged.values()), outdir)
+            ok = proc is not None and proc.returncode == 0
+
+            missing = [i for i, p in staged.items() if not (outdir / (p.stem + ".pdf")).exists()]
+            if missing and not ok and len(staged) > 1:
+                # 整批異常：缺檔的逐一重跑，把壞檔隔離出來
+                for i in missing:
+                    self.retries += 1
+                    with attached([batch[i].capture]):
+                        self._soffice([staged[i]], outdir)
+
+            for i, p in staged.items():
+                r = batch[i]
+                produced = outdir / (p.stem + ".pdf")
+                if produced.exists():
+                    try:
+                        Path(r.out_pdf).parent.mkdir(parents=True, exist_ok=True)
+                        shutil.move(str(produced), r.out_pdf)
+                        r.future.set_result(r.out_pdf)
+                    except OSError as e:
+                        r.future.set_exception(e)
+                else:
+                    self.failures += 1
+                    err = proc.stderr.decode(errors="ignore").strip() if proc is not None else "逾時"
+                    r.future.set_exception(RuntimeError(f"soffice 未產生 PDF：{r.src_path}（{err[-300:]}）"))
+
+        waited = max(t0 - r.enqueued for r in batch)
+        log_event("soffice_batch", files=len(batch), max_wait_ms=round(waited * 1000, 1),
+                  ms=round((time.perf_counter() - t0) * 1000, 1), ok=ok)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window * 1000, "max_batch": self.max_batch,
+            "batches": self.batches, "files": self.files, "failures": self.failures,
+            "retries": self.retries, "queued": self._queue.qsize(),
+            "avg_batch": self.files / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=self.run_timeout)
+
+_batcher: SofficeBatcher | None = None
+_batcher_lock = threading.Lock()
+
+def get_batcher(soffice_path: str | None = None, window_ms: float | None = None,
+                max_batch: int | None = None) -> SofficeBatcher | None:
+    """取得（必要時建立）全域批次轉檔器。SOFFICE_BATCH_WINDOW_MS=0 或找不到 soffice 時回傳 None。"""
+    global _batcher
+    window_ms = BATCH_WINDOW_MS if window_ms is None else window_ms
+    if window_ms <= 0:
+        return _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            soffice = soffice_path or shutil.which("soffice")
+            if not soffice:
+                return None
+            _batcher = SofficeBatcher(soffice, window_ms, BATCH_MAX if max_batch is None else max_batch)
+    return _batcher
+
+def close_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is not None:
+            _batcher.close()
+            _batcher = None
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# soffice_pool.py
+# 常駐 LibreOffice 轉檔池：預先啟動 N 個 headless soffice（UNO socket 監聽），
+# 每個 worker 有自己的 -env:UserInstallation profile，轉檔時直接透過 UNO 載入/輸出 PDF，
+# 省掉每張報價單都要冷啟動 soffice 的數秒成本。
+#
+# 依賴：
+#   LibreOffice 附帶的 Python-UNO 橋接（Debian/Ubuntu：apt install python3-uno）
+#   python3-uno 只適用發行版自己的 python3（ABI / libpython 要一致），所以 Dockerfile 用
+#   Debian 的 python3 + --system-site-packages venv，建置時就驗證 import uno
+#   若 import uno 失敗，池子視為不可用（error 等級的 soffice_pool_unavailable 事件，
+#   /workers、/readyz 的 soffice_pool 欄位看得到原因），呼叫端回退到 subprocess --convert-to
+#
+# process 模式的工作 worker（見 quote_jobs._worker_init）各自有一個池：port 由系統挑空閒的、
+# profile 放在 <SOFFICE_POOL_PROFILE_DIR>/pid<pid>/ 底下，worker 結束時（atexit）連同 profile 一起收掉。
+#
+# 單次轉檔有期限（SOFFICE_POOL_RUN_TIMEOUT）：soffice 卡在某份文件時由看門狗直接砍掉該 worker 的
+# 整個程序群組，UNO 呼叫因此中斷、丟 TimeoutError，worker 重啟後交還池子；呼叫端改走一次性 soffice。
+#
+# 函式入口：
+#   get_pool(soffice_path=None) -> SofficePool | None
+#   pool_status() -> dict   # 設定大小、uno 能否載入（失敗原因）、池子是否在跑、各 worker 狀態
+#   SofficePool.convert(src_path, out_pdf, timeout=None) -> str   # timeout = 等空閒 worker 的上限
+
+import os, signal, sys, time, socket, shutil, subprocess, threading, queue, tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+from metrics import log_event
+
+# Debian 的 python3-uno 裝在系統 Python 的 dist-packages；用 Debian python3（見 Dockerfile）時本來就在 sys.path，
+# 其他 python（同版本、ABI 相容時）才需要補路徑
+UNO_PATHS = [p for p in os.getenv("SOFFICE_UNO_PATH", "/usr/lib/python3/dist-packages:/usr/lib/libreoffice/program").split(":") if p]
+
+POOL_SIZE       = int(os.getenv("SOFFICE_POOL_SIZE", "0"))       # 0 = 不啟用常駐池
+POOL_BASE_PORT  = int(os.getenv("SOFFICE_POOL_BASE_PORT", "2002"))
+POOL_PROFILE_DIR= os.getenv("SOFFICE_POOL_PROFILE_DIR", str(Path(tempfile.gettempdir()) / "soffice_pool"))
+POOL_START_TIMEOUT = float(os.getenv("SOFFICE_POOL_START_TIMEOUT", "30"))
+POOL_CONVERT_TIMEOUT = float(os.getenv("SOFFICE_POOL_CONVERT_TIMEOUT", "60"))  # 等空閒 worker
+POOL_RUN_TIMEOUT = float(os.getenv("SOFFICE_POOL_RUN_TIMEOUT", "120"))         # 單次轉檔
+
+PER_PROCESS = False  # True = 這個程序是多個工作 worker 之一，不能用固定 port / profile
+
+_uno = None
+_uno_error: str | None = None
+
+def _import_uno():
+    """延遲載入 uno；找不到時回傳 None（不讓整個服務因此起不來），原因留在 _uno_error。"""
+    global _uno, _uno_error
+    if _uno is not None:
+        return _uno
+    try:
+        import uno  # type: ignore
+    except ImportError:
+        for p in UNO_PATHS:
+            if Path(p, "uno.py").exists() and p not in sys.path:
+                sys.path.append(p)
+        try:
+            import uno  # type: ignore
+        except ImportError as e:
+            _uno_error = f"{type(e).__name__}: {e}（{sys.executable}）"
+            return None
+    _uno, _uno_error = uno, None
+    return _uno
+
+def _props(uno, **kw):
+    from com.sun.star.beans import PropertyValue  # type: ignore
+    out = []
+    for k, v in kw.items():
+        p = PropertyValue()
+        p.Name, p.Value = k, v
+        out.append(p)
+    return tuple(out)
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _port_open(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.5)
+        return s.connect_ex(("127.0.0.1", port)) == 0
+
+# ---------------- 單一常駐 soffice ----------------
+class SofficeWorker:
+    def __init__(self, soffice: str, port: int, profile_dir: Path):
+        self.soffice = soffice
+        self.port = port
+        self.profile_dir = profile_dir
+        self.proc: subprocess.Popen | None = None
+        self.desktop = None
+        self.jobs = 0
+        self.restarts = 0
+
+    def start(self):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        cmd = [
+            self.soffice, "--headless", "--invisible", "--nologo", "--nodefault",
+            "--nolockcheck", "--nofirststartwizard", "--norestore",
+            f"-env:UserInstallation={self.profile_dir.resolve().as_uri()}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+        ]
+        log_event("soffice_pool_start", port=self.port)
+        # 自己一個程序群組：soffice 啟動腳本底下還有 soffice.bin，逾時時要一起砍
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                     start_new_session=True)
+        self.desktop = None
+        deadline = time.monotonic() + POOL_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"soffice worker :{self.port} 啟動後立即結束（code={self.proc.returncode}）")
+            if _port_open(self.port):
+                try:
+                    self._connect()
+                    return
+                except Exception:
+                    pass
+            time.sleep(0.2)
+        self.stop()
+        raise TimeoutError(f"soffice worker :{self.port} 啟動逾時")
+
+    def _connect(self):
+        uno = _import_uno()
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        ctx = resolver.resolve(f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+        self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.kill()
+        self.proc = None
+
+    def kill(self):
+        """強制結束整個程序群組（轉檔卡住時由看門狗呼叫，進行中的 UNO 呼叫會因此丟例外）。"""
+        proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (OSError, AttributeError):
+            proc.kill()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def restart(self):
+        self.restarts += 1
+        log_event("soffice_pool_restart", level="warn", port=self.port, restarts=self.restarts)
+        self.stop()
+        self.start()
+
+    def healthy(self) -> bool:
+        if self.proc is None or self.proc.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()  # 走一趟 UNO bridge，確認還能回應
+            return True
+        except Exception:
+            return False
+
+    def convert(self, src_path: str, out_pdf: str, timeout: float = POOL_RUN_TIMEOUT):
+        uno = _import_uno()
+        src_url = uno.systemPathToFileUrl(str(Path(src_path).resolve()))
+        out_url = uno.systemPathToFileUrl(str(Path(out_pdf).resolve()))
+        fired = threading.Event()
+
+        def expire():
+            fired.set()
+            self.kill()
+
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            doc = self.desktop.loadComponentFromURL(src_url, "_blank", 0, _props(uno, Hidden=True, ReadOnly=True))
+            if doc is None:
+                raise RuntimeError(f"LibreOffice 無法開啟：{src_path}")
+            try:
+                doc.storeToURL(out_url, _props(uno, FilterName="calc_pdf_Export"))
+            finally:
+                try:
+                    doc.close(True)
+                except Exception:
+                    if not fired.is_set():
+                        raise
+        except Exception as e:
+            if fired.is_set():  # 看門狗已動手：原本的例外只是連線被切斷
+                raise TimeoutError(f"soffice worker :{self.port} 轉檔逾時（{timeout:g}s）：{src_path}") from e
+            raise
+        finally:
+            watchdog.cancel()
+        self.jobs += 1
+
+# ---------------- 轉檔池 ----------------
+class SofficePool:
+    """
+    固定大小的 soffice 常駐池。
+    - 每個 worker 一個 port + 一個獨立 profile（避免 profile lock 互卡）
+    - 取用前做健康檢查，掛掉就重啟；轉檔失敗也會重啟該 worker 再交還
+    """
+    def __init__(self, soffice: str, size: int = 2, base_port: int | None = POOL_BASE_PORT,
+                 profile_root: str = POOL_PROFILE_DIR):
+        self.size = max(1, size)
+        self._idle: "queue.Queue[SofficeWorker]" = queue.Queue()
+        # base_port=None：每個 soffice 各挑空閒 port，profile 放在這個程序專用的目錄，close() 時刪掉
+        self._private_root = Path(profile_root) / f"pid{os.getpid()}" if base_port is None else None
+        root = self._private_root or Path(profile_root)
+        self._workers = [
+            SofficeWorker(soffice, base_port + i if base_port is not None else _free_port(), root / f"worker{i}")
+            for i in range(self.size)
+        ]
+        started: list[SofficeWorker] = []
+        try:
+            for w in self._workers:
+                w.start()
+                started.append(w)
+                self._idle.put(w)
+        except BaseException:
+            # 第 k 個起不來：先把已啟動的 soffice 收掉，避免留下沒人管的常駐程序
+            for w in started:
+                w.stop()
+            if self._private_root is not None:
+                shutil.rmtree(self._private_root, ignore_errors=True)
+            raise
+
+    def convert(self, src_path: str, out_pdf: str, timeout: float | None = None) -> str:
+        try:
+            w = self._idle.get(timeout=timeout or POOL_CONVERT_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError("soffice 轉檔池忙碌中，等待逾時")
+        try:
+            if not w.healthy():
+                w.restart()
+            try:
+                w.convert(src_path, out_pdf)
+            except Exception:
+                try:
+                    w.restart()
+                except Exception:
+                    pass  # 重啟失敗：下次取用時 healthy() 不過會再試；先把原本的錯誤往上丟
+                raise
+        finally:
+            self._idle.put(w)
+        return out_pdf
+
+    def stats(self) -> list[dict]:
+        return [
+            {"port": w.port, "alive": w.proc is not None and w.proc.poll() is None,
+             "jobs": w.jobs, "restarts": w.restarts}
+            for w in self._workers
+        ]
+
+    def close(self):
+        for w in self._workers:
+            w.stop()
+        if self._private_root is not None:
+            shutil.rmtree(self._private_root, ignore_errors=True)
+
+_pool: SofficePool | None = None
+_pool_lock = threading.Lock()
+_pool_failed = False
+
+def get_pool(soffice_path: str | None = None, size: int | None = None) -> SofficePool | None:
+    """
+    取得（必要時建立）全域轉檔池。SOFFICE_POOL_SIZE=0、找不到 soffice 或 uno 時回傳 None。
+    建立失敗只會嘗試一次，之後一律回退 subprocess。
+    """
+    global _pool, _pool_failed
+    size = POOL_SIZE if size is None else size
+    if size <= 0 or _pool_failed:
+        return _pool
+    with _pool_lock:
+        if _pool is not None or _pool_failed:
+            return _pool
+        soffice = soffice_path or shutil.which("soffice")
+        if not soffice or _import_uno() is None:
+            log_event("soffice_pool_unavailable", level="error", size=size, to="subprocess",
+                      error="找不到 soffice" if not soffice else _uno_error)
+            _pool_failed = True
+            return None
+        try:
+            _pool = SofficePool(soffice, size, base_port=None if PER_PROCESS else POOL_BASE_PORT)
+        except Exception as e:
+            log_event("soffice_pool_unavailable", level="error", size=size, to="subprocess", error=str(e))
+            _pool_failed = True
+            return None
+    return _pool
+
+def pool_status() -> Dict[str, Any]:
+    """給 /workers、/readyz：池子有沒有啟用、能不能用；process 模式下池子在各工作 worker 裡，這裡只看得到 uno 能否載入。"""
+    out: Dict[str, Any] = {"size": POOL_SIZE}
+    if POOL_SIZE <= 0:
+        return out
+    out["uno"] = _import_uno() is not None
+    if not out["uno"]:
+        out["error"] = _uno_error
+    out["failed"] = _pool_failed
+    pool = _pool
+    if pool is not None:
+        out["workers"] = pool.stats()
+    return out
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# soffice_scheduler.py
+# soffice 一次性執行（subprocess / 微批次）的排程：
+#   - 每次執行都用自己的 -env:UserInstallation profile，同時跑的 soffice 不會搶同一個 profile lock
+#     （新 profile 從第一次成功執行後留下的種子複製，不必每次重做首次啟動初始化）
+#   - 同時執行數上限依 CPU 核心數與可用記憶體決定（可用 SOFFICE_MAX_CONCURRENCY 覆寫），
+#     突發流量不會一口氣開出一堆 soffice 把容器記憶體吃光
+#   - 超過上限的請求依先來後到排隊；排隊有上限、有等待逾時，也可用 cancel 事件取消
+#   - 排隊深度、執行中數量、等待時間與被拒次數都進 /metrics
+#   - 每次執行的實際耗時與 CPU 時間（wait4 的 rusage，含 soffice.bin 子程序）記進 /metrics，
+#     正在剖析的請求另記進剖析紀錄（見 profiling.py）
+# 常駐轉檔池（soffice_pool.py）的 worker 數固定、各有自己的 profile，不經過這裡。
+#
+# 設定（環境變數）：
+#   SOFFICE_MAX_CONCURRENCY : 整台主機的同時執行上限（預設 min(CPU 核心數, 可用記憶體 / SOFFICE_MEM_PER_PROC)）；
+#                             process 模式下由各工作 worker 平分（見 quote_jobs._worker_init）
+#   SOFFICE_MEM_PER_PROC    : 估計每個 soffice 佔用的記憶體 MiB（預設 400）
+#   SOFFICE_MAX_WAITING     : 排隊上限（預設 32）
+#   SOFFICE_WAIT_TIMEOUT    : 排隊最久等幾秒（預設 60）
+#   SOFFICE_RUN_TIMEOUT     : 單次執行逾時秒數（預設 120）
+#   SOFFICE_PROFILE_ROOT    : profile 暫存根目錄（預設 <tmp>/soffice_profiles）
+#
+# 函式入口：
+#   get_scheduler().run(args, timeout=None, cancel=None) -> subprocess.CompletedProcess
+#     args 為 soffice 之後的參數（不含 -env:UserInstallation）；排不到 / 逾時 / 取消丟 SofficeBusy
+#   find_soffice(explicit_path=None) -> str | None   # 不載入 Aspose，benchmark / warmup 也能用
+
+import os, shutil, subprocess, tempfile, threading, time
+from collections import deque
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from metrics import Counter, Gauge, Histogram, log_event
+from profiling import note_subprocess
+
+SOFFICE_MEM_PER_PROC = int(os.getenv("SOFFICE_MEM_PER_PROC", "400"))
+SOFFICE_MAX_WAITING = int(os.getenv("SOFFICE_MAX_WAITING", "32"))
+SOFFICE_WAIT_TIMEOUT = float(os.getenv("SOFFICE_WAIT_TIMEOUT", "60"))
+SOFFICE_RUN_TIMEOUT = float(os.getenv("SOFFICE_RUN_TIMEOUT", "120"))
+SOFFICE_PROFILE_ROOT = os.getenv("SOFFICE_PROFILE_ROOT", str(Path(tempfile.gettempdir()) / "soffice_profiles"))
+
+WORKER_SHARE = 1  # 同一台主機上各有一個排程器的程序數（process 模式的工作 worker 數）
+
+SOFFICE_WAIT = Histogram("soffice_wait_seconds", "Time a soffice run waited for a free slot")
+SOFFICE_RUN = Histogram("soffice_run_seconds", "Duration of a scheduled soffice run", ("result",))
+SOFFICE_REJECTED = Counter("soffice_rejected_total", "soffice runs that never got a slot", ("reason",))
+Gauge("soffice_queue_depth", "soffice runs waiting for a slot", lambda: _stat("waiting"))
+Gauge("soffice_running", "soffice runs in progress", lambda: _stat("running"))
+Gauge("soffice_concurrency_limit", "Maximum concurrent soffice runs", lambda: _stat("limit"))
+
+class SofficeBusy(RuntimeError):
+    """排隊已滿、等待逾時或被取消：呼叫端應改走其他路徑。"""
+
+def find_soffice(explicit_path: str | None = None) -> str | None:
+    """找 soffice 執行檔：明確指定 > PATH > 常見安裝位置。"""
+    if explicit_path:
+        p = Path(explicit_path)
+        return str(p) if p.exists() else None
+    p = shutil.which("soffice")
+    if p:
+        return p
+    candidates = [
+        r"C:\Program Files\LibreOffice\program\soffice.exe",
+        r"C:\Program Files (x86)\LibreOffice\program\soffice.exe",
+        "/usr/bin/soffice", "/usr/lib/libreoffice/program/soffice", "/snap/bin/libreoffice"
+    ]
+    for c in candidates:
+        if Path(c).exists():
+            return c
+    return None
+
+def _available_memory_mb() -> int | None:
+    # 容器的 cgroup 上限優先，其次是主機的 MemAvailable
+    try:
+        limit = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+        if limit != "max":
+            used = int(Path("/sys/fs/cgroup/memory.current").read_text().strip())
+            return max(0, int(limit) - used) // (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    try:
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def default_concurrency() -> int:
+    env = os.getenv("SOFFICE_MAX_CONCURRENCY")
+    if env:
+        n = int(env)
+    else:
+        n = os.cpu_count() or 1
+        mem = _available_memory_mb()
+        if mem is not None:
+            n = min(n, mem // max(1, SOFFICE_MEM_PER_PROC))
+    return max(1, n // WORKER_SHARE)
+
+class SofficeScheduler:
+    def __init__(self, soffice: str, limit: int | None = None, max_waiting: int = SOFFICE_MAX_WAITING,
+                 wait_timeout: float = SOFFICE_WAIT_TIMEOUT, run_timeout: float = SOFFICE_RUN_TIMEOUT,
+                 profile_root: str = SOFFICE_PROFILE_ROOT):
+        self.soffice = soffice
+        self.limit = limit or default_concurrency()
+        self.max_waiting = max(0, max_waiting)
+        self.wait_timeout = wait_timeout
+        self.run_timeout = run_timeout
+        self.profile_root = Path(profile_root)
+        self.profile_root.mkdir(parents=True, exist_ok=True)
+        self._seed = self.profile_root / "seed"
+        self._cond = threading.Condition()
+        self._waiting: "deque[object]" = deque()   # FIFO：排在最前面的才能拿到空位
+        self._running = 0
+        self._closed = False
+        self.runs = 0
+
+    # ---- 排隊 ----
+    def _acquire(self, timeout: float, cancel: threading.Event | None):
+        ticket = object()
+        t0 = time.perf_counter()
+        with self._cond:
+            if self._closed:
+                raise SofficeBusy("soffice 排程器已關閉")
+            if self._running < self.limit and not self._waiting:
+                self._running += 1
+                SOFFICE_WAIT.observe(0.0)
+                return
+            if len(self._waiting) >= self.max_waiting:
+                SOFFICE_REJECTED.inc(reason="queue_full")
+                raise SofficeBusy(f"soffice 排隊已滿（{len(self._waiting)} 件）")
+            self._waiting.append(ticket)
+            deadline = t0 + timeout
+            try:
+                while True:
+                    if self._closed:
+                        SOFFICE_REJECTED.inc(reason="closed")
+                        raise SofficeBusy("soffice 排程器已關閉")
+                    if cancel is not None and cancel.is_set():
+                        SOFFICE_REJECTED.inc(reason="cancelled")
+                        raise SofficeBusy("soffice 轉檔已取消")
+                    if self._waiting[0] is ticket and self._running < self.limit:
+                        self._running += 1
+                        break
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        SOFFICE_REJECTED.inc(reason="timeout")
+                        raise SofficeBusy(f"等待 soffice 空位逾時（{timeout:.0f}s）")
+                    # 有取消事件時定期醒來檢查
+                    self._cond.wait(min(remaining, 0.5) if cancel is not None else remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+        SOFFICE_WAIT.observe(time.perf_counter() - t0)
+
+    def _release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    # ---- profile ----
+    def _new_profile(self) -> Path:
+        prof = Path(tempfile.mkdtemp(prefix="run_", dir=self.profile_root))
+        if self._seed.is_dir():
+            try:
+                shutil.copytree(self._seed, prof, dirs_exist_ok=True)
+            except OSError:
+                pass  # 複製失敗就用空 profile，soffice 會自己初始化
+        return prof
+
+    def _keep_seed(self, prof: Path):
+        if self._seed.is_dir():
+            return
+        tmp = self.profile_root / f".seed_{os.getpid()}_{threading.get_ident()}"
+        try:
+            shutil.copytree(prof, tmp)
+            os.rename(tmp, self._seed)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)  # 別人先建好了
+
+    # ---- 執行 ----
+    @staticmethod
+    def _wait(proc: subprocess.Popen, limit: float, cancel: threading.Event | None) -> Tuple[str, float | None]:
+        """
+        等子程序結束，回傳 (結果, CPU 秒數)。有 os.wait4 時自己收屍拿 rusage（user + sys，
+        含 oosplash 等到的 soffice.bin），逾時 / 取消由看門狗執行緒 kill；沒有時退回 communicate 輪詢。
+        """
+        why: List[str] = []
+        if not hasattr(os, "wait4"):
+            deadline = time.perf_counter() + limit
+            while True:
+                try:
+                    proc.communicate(timeout=0.5 if cancel is not None else limit)
+                    return "done", None
+                except subprocess.TimeoutExpired:
+                    if (cancel is not None and cancel.is_set()) or time.perf_counter() >= deadline:
+                        proc.kill()
+                        proc.communicate()
+                        return ("cancelled" if cancel is not None and cancel.is_set() else "timeout"), None
+
+        done = threading.Event()
+        deadline = time.perf_counter() + limit
+
+        def watchdog():
+            while not done.wait(0.5 if cancel is not None else max(0.0, deadline - time.perf_counter())):
+                if cancel is not None and cancel.is_set():
+                    why.append("cancelled")
+                elif time.perf_counter() >= deadline:
+                    why.append("timeout")
+                else:
+                    continue
+                proc.kill()
+                return
+
+        threading.Thread(target=watchdog, name="soffice-watchdog", daemon=True).start()
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu = usage.ru_utime + usage.ru_stime
+        except ChildProcessError:
+            proc.wait()  # 看門狗 kill 時已被 Popen 收走
+            cpu = None
+        finally:
+            done.set()
+        return (why[0] if why else "done"), cpu
+
+    def run(self, args: List[str], timeout: float | None = None,
+            cancel: threading.Event | None = None) -> subprocess.CompletedProcess:
+        """
+        排到空位後以獨立 profile 執行 soffice；逾時會強制結束並丟 subprocess.TimeoutExpired。
+        排不到空位 / 排隊逾時 / 取消丟 SofficeBusy。
+        """
+        self._acquire(self.wait_timeout, cancel)
+        prof = None
+        t0 = time.perf_counter()
+        result = "error"
+        try:
+            prof = self._new_profile()
+            cmd = [self.soffice, f"-env:UserInstallation={prof.resolve().as_uri()}", *args]
+            limit = timeout or self.run_timeout
+            # 輸出寫暫存檔而不是 pipe：自己 wait4 收屍時不必同時讀 pipe，也不會因 pipe 塞滿卡住
+            with tempfile.TemporaryFile() as out_f, tempfile.TemporaryFile() as err_f:
+                proc = subprocess.Popen(cmd, stdout=out_f, stderr=err_f)
+                outcome, cpu = self._wait(proc, limit, cancel)
+                note_subprocess("soffice", time.perf_counter() - t0, cpu, proc.returncode)
+                if outcome != "done":
+                    result = outcome
+                    if result == "cancelled":
+                        raise SofficeBusy("soffice 轉檔已取消")
+                    raise subprocess.TimeoutExpired(cmd, limit)
+                out_f.seek(0)
+                err_f.seek(0)
+                out, err = out_f.read(), err_f.read()
+            result = "ok" if proc.returncode == 0 else "error"
+            self.runs += 1
+            if proc.returncode == 0:
+                self._keep_seed(prof)
+            return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+        finally:
+            SOFFICE_RUN.observe(time.perf_counter() - t0, result=result)
+            self._release()
+            if prof is not None:
+                shutil.rmtree(prof, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"limit": self.limit, "running": self._running, "waiting": len(self._waiting),
+                    "max_waiting": self.max_waiting, "runs": self.runs}
+
+    def close(self):
+        """叫醒所有排隊中的請求（改丟 SofficeBusy）；執行中的讓它跑完。"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+_scheduler: SofficeScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+def _stat(key: str) -> float:
+    return _scheduler.stats()[key] if _scheduler is not None else 0
+
+def get_scheduler(soffice: str) -> SofficeScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler._closed:
+            _scheduler = SofficeScheduler(soffice)
+            log_event("soffice_scheduler", limit=_scheduler.limit, max_waiting=_scheduler.max_waiting)
+    return _scheduler
+
+def close_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.close()
+            _scheduler = None
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# template_cache.py
+# 範本快取：範本 .xlsx 只從磁碟讀一次，保留一份原封不動的 bytes，
+# 每個請求從記憶體 buffer 載入一本新的 Workbook（彼此獨立，可隨意修改）。
+#
+# - 以 (絕對路徑) 為鍵，記錄 mtime_ns/size；檔案被換掉時自動重新讀取
+# - 多個範本時以總 bytes 上限做 LRU 淘汰
+#
+# 函式入口：
+#   TEMPLATE_CACHE.clone(path) -> ac.Workbook
+#   TEMPLATE_CACHE.get_bytes(path) -> bytes
+
+import io, os, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+import aspose.cells as ac
+
+TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+class TemplateCache:
+    def __init__(self, max_bytes: int = TEMPLATE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # key -> (mtime_ns, size, data)
+        self._entries: "OrderedDict[str, tuple[int, int, bytes]]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return str(Path(path).resolve())
+
+    def get_bytes(self, path: str) -> bytes:
+        key = self._key(path)
+        st = os.stat(key)
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is not None and ent[0] == st.st_mtime_ns and ent[1] == st.st_size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return ent[2]
+
+        # 未命中或範本已更新：在鎖外讀檔，避免卡住其他範本的請求
+        data = Path(key).read_bytes()
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= len(old[2])
+            if len(data) <= self.max_bytes:
+                self._entries[key] = (st.st_mtime_ns, st.st_size, data)
+                self._total += len(data)
+                self._evict()
+        return data
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            _, (_, _, data) = self._entries.popitem(last=False)
+            self._total -= len(data)
+
+    def clone(self, path: str) -> ac.Workbook:
+        """從快取的 bytes 載入一本全新的 Workbook（不碰磁碟）。"""
+        return ac.Workbook(io.BytesIO(self.get_bytes(path)))
+
+    def invalidate(self, path: str | None = None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._total = 0
+                return
+            old = self._entries.pop(self._key(path), None)
+            if old is not None:
+                self._total -= len(old[2])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total,
+                    "hits": self.hits, "misses": self.misses}
+
+TEMPLATE_CACHE = TemplateCache()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# template_registry.py
+# 範本登錄：可設定多個範本 / 工作表，依訊息指定（「範本: xxx」）或依客戶名稱選用。
+# 每個範本只解析一次（純 zip + XML，web 程序不需載入 Aspose），預先算好版面索引：
+#   - 工作表名稱 -> 索引
+#   - Named Range 座標（工作表索引、列、欄、範圍大小）
+#   - 明細表對應：樣板列 / 首筆插入列（由 Count 命名範圍所在列推得）、數量 / 優惠單價欄
+#   - 圖形錨點：全部已是「隨儲存格移動並調整大小」時，產檔不必再逐一設定
+# 產檔時直接用索引定位儲存格（見 make_quote_linux.py），不再每個請求 get_range_by_name / 以名稱找工作表。
+# 索引以 (路徑, mtime_ns, size, 工作表) 為鍵快取；範本檔或設定檔更新後，下一次查詢自動重建（熱更新）。
+#
+# 設定（環境變數）：
+#   TEMPLATES_FILE : 範本設定 JSON（預設 templates.json；檔案不存在時只有下面這一個預設範本）
+#   TEMPLATE_XLSX  : 預設範本路徑（預設 維修報價單範本.xlsx）
+#   SHEET_NAME     : 預設範本的工作表（不填 = 第一張）
+#
+# 設定檔格式（template_row / first_insert_row 可省略，由範本推得）：
+#   {"default": "repair",
+#    "templates": {"repair": {"path": "維修報價單範本.xlsx"},
+#                  "bella":  {"path": "報價單_凱凱.xlsx", "sheet": "貝拉5", "template_row": 11}},
+#    "clients": {"凱凱超級公司": "bella"}}
+#
+# 函式入口：
+#   template_index(xlsx_path, sheet=None) -> dict    # 版面索引（每個 process 各自快取）
+#   TemplateRegistry(config_path, default_path, default_sheet)
+#     .select(name=None, client=None) -> {"name", "path", "sheet", "template_row", "first_insert_row"}
+#       name 不存在丟 UnknownTemplate
+#     .load_all() -> {範本名稱: 索引摘要或錯誤}；.describe() -> dict
+
+import json, os, posixpath, threading, zipfile
+from pathlib import Path
+from typing import Any, Dict, Tuple
+from xml.etree import ElementTree as ET
+
+from metrics import log_event
+from quote_layout import NS, _rel_targets, parse_ref
+
+TEMPLATES_FILE = os.getenv("TEMPLATES_FILE", "templates.json")
+TEMPLATE_XLSX = os.getenv("TEMPLATE_XLSX", "維修報價單範本.xlsx")
+SHEET_NAME = os.getenv("SHEET_NAME")
+
+DEFAULT_TEMPLATE_ROW = 11
+
+class UnknownTemplate(ValueError):
+    """訊息或客戶對應到的範本名稱不在設定裡。"""
+
+# ---------------- 版面索引（純 XML） ----------------
+def _split_ref(text: str) -> Tuple[str, str] | None:
+    """'貝拉5'!$B$5 / 貝拉5!$B$5:$C$6 -> (工作表名稱, 'B5:C6')；公式或 #REF! 回傳 None。"""
+    text = text.strip()
+    if "!" not in text or text.startswith("="):
+        return None
+    sheet, ref = text.rsplit("!", 1)
+    sheet = sheet.strip()
+    if sheet.startswith("'") and sheet.endswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+    if "#REF" in ref or "," in ref:
+        return None
+    return sheet, ref.replace("$", "")
+
+def extract_index(xlsx_path: str, sheet: str | None = None) -> Dict[str, Any]:
+    with zipfile.ZipFile(xlsx_path) as z:
+        wb = ET.fromstring(z.read("xl/workbook.xml"))
+        wb_rels = _rel_targets(z, "xl/_rels/workbook.xml.rels")
+        sheet_els = wb.findall("m:sheets/m:sheet", NS)
+        if not sheet_els:
+            raise ValueError(f"範本沒有工作表：{xlsx_path}")
+        sheets = {s.get("name"): i for i, s in enumerate(sheet_els)}
+        if sheet and sheet not in sheets:
+            raise ValueError(f"找不到工作表：{sheet}")
+        sheet_index = sheets[sheet] if sheet else 0
+        sheet_el = sheet_els[sheet_index]
+        sheet_name = sheet_el.get("name")
+
+        # 活頁簿層級的名稱先放，目標工作表自己的（localSheetId）名稱覆蓋同名的
+        names: Dict[str, Dict[str, int]] = {}
+        defined = set()
+        scoped = sorted(wb.iterfind("m:definedNames/m:definedName", NS),
+                        key=lambda dn: dn.get("localSheetId") is not None)
+        for dn in scoped:
+            local = dn.get("localSheetId")
+            if local is not None and int(local) != sheet_index:
+                continue
+            name = dn.get("name")
+            defined.add(name)
+            parsed = _split_ref(dn.text or "")
+            if parsed is None or parsed[0] not in sheets:
+                names.pop(name, None)  # 交給 Aspose 解析（get_range_by_name）
+                continue
+            try:
+                parts = parsed[1].split(":")
+                r0, c0 = parse_ref(parts[0])
+                r1, c1 = parse_ref(parts[-1])
+            except ValueError:
+                names.pop(name, None)
+                continue
+            names[name] = {"sheet": sheets[parsed[0]], "row": r0, "col": c0,
+                           "rows": r1 - r0 + 1, "cols": c1 - c0 + 1}
+
+        # 圖形錨點：twoCellAnchor 且 editAs 省略或為 twoCell 才是「隨儲存格移動並調整大小」
+        shapes = []
+        sheet_path = wb_rels.get(sheet_el.get(f"{{{NS['r']}}}id"))
+        if sheet_path:
+            root = ET.fromstring(z.read(sheet_path))
+            drawing = root.find("m:drawing", NS)
+            if drawing is not None:
+                sheet_rels = _rel_targets(z, posixpath.join(posixpath.dirname(sheet_path), "_rels",
+                                                            posixpath.basename(sheet_path) + ".rels"))
+                dpath = sheet_rels.get(drawing.get(f"{{{NS['r']}}}id"))
+                if dpath and dpath in z.namelist():
+                    for anchor in ET.fromstring(z.read(dpath)):
+                        kind = anchor.tag.rsplit("}", 1)[-1]
+                        frm = anchor.find("xdr:from", NS)
+                        shapes.append({
+                            "anchor": kind,
+                            "edit_as": anchor.get("editAs", "twoCell" if kind == "twoCellAnchor" else ""),
+                            "row": int(frm.find("xdr:row", NS).text) if frm is not None else None,
+                            "col": int(frm.find("xdr:col", NS).text) if frm is not None else None,
+                        })
+
+    def col_of(name: str, default: int) -> int:
+        ref = names.get(name)
+        return ref["col"] if ref is not None and ref["sheet"] == sheet_index else default
+
+    cnt = names.get("Count")
+    template_row = cnt["row"] + 1 if cnt is not None and cnt["sheet"] == sheet_index else DEFAULT_TEMPLATE_ROW
+    return {
+        "sheet": sheet_name,
+        "sheet_index": sheet_index,
+        "sheets": sheets,
+        "names": names,
+        "defined": defined,
+        "items": {
+            "template_row": template_row,
+            "first_insert_row": template_row + 1,
+            "count_col": col_of("Count", 3),
+            "provide_col": col_of("ProvidePrice", 5),
+        },
+        "shapes": shapes,
+        "shapes_fixed": all(s["anchor"] == "twoCellAnchor" and s["edit_as"] == "twoCell" for s in shapes),
+    }
+
+_indexes: Dict[Tuple[str, int, int, str | None], Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+def template_index(xlsx_path: str, sheet: str | None = None) -> Dict[str, Any]:
+    """取得範本版面索引（同一檔案 + 工作表只解析一次；檔案更新後自動重建）。"""
+    path = str(Path(xlsx_path).resolve())
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size, sheet)
+    with _lock:
+        hit = _indexes.get(key)
+    if hit is not None:
+        return hit
+    index = extract_index(path, sheet)
+    index["version"] = key[:3]
+    with _lock:
+        for k in [k for k in _indexes if k[0] == path and k[3] == sheet]:
+            del _indexes[k]
+        _indexes[key] = index
+    return index
+
+# ---------------- 範本登錄 ----------------
+class TemplateRegistry:
+    def __init__(self, config_path: str | None = TEMPLATES_FILE,
+                 default_path: str = TEMPLATE_XLSX, default_sheet: str | None = SHEET_NAME):
+        self.config_path = config_path
+        self._fallback = {"default": "default",
+                          "templates": {"default": {"path": default_path, "sheet": default_sheet}},
+                          "clients": {}}
+        self._config = self._fallback
+        self._version: Tuple[int, int] | None = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _config_now(self) -> Dict[str, Any]:
+        # 每次查詢只 stat 一次設定檔；有變動才重讀（讀壞了沿用舊設定）
+        if not self.config_path:
+            return self._config
+        try:
+            st = os.stat(self.config_path)
+            version = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            version = None
+        if version == self._version:
+            return self._config
+        with self._lock:
+            if version == self._version:
+                return self._config
+            if version is None:
+                self._config = self._fallback
+            else:
+                try:
+                    self._config = self._parse(json.loads(Path(self.config_path).read_text(encoding="utf-8")))
+                    log_event("templates_loaded", config=self.config_path, templates=list(self._config["templates"]))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    log_event("templates_config_invalid", level="warn", config=self.config_path, error=str(e))
+            self._version = version
+            self.loads += 1
+        return self._config
+
+    def _parse(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        base = Path(self.config_path).resolve().parent
+        templates = {}
+        for name, spec in data["templates"].items():
+            if isinstance(spec, str):
+                spec = {"path": spec}
+            path = Path(spec["path"])
+            templates[name] = {**spec, "path": str(path if path.is_absolute() else base / path)}
+        if not templates:
+            raise ValueError("templates 不可為空")
+        default = data.get("default") or next(iter(templates))
+        if default not in templates:
+            raise ValueError(f"default 範本不存在：{default}")
+        clients = {str(k).strip(): v for k, v in (data.get("clients") or {}).items()}
+        for client, name in clients.items():
+            if name not in templates:
+                raise ValueError(f"客戶 {client} 對應的範本不存在：{name}")
+        return {"default": default, "templates": templates, "clients": clients}
+
+    def select(self, name: str | None = None, client: str | None = None) -> Dict[str, Any]:
+        """依訊息指定的範本名稱 > 客戶對應 > 預設，回傳產檔要用的範本設定。"""
+        cfg = self._config_now()
+        if name:
+            name = name.strip()
+            if name not in cfg["templates"]:
+                raise UnknownTemplate(f"找不到範本：{name}（可用：{'、'.join(cfg['templates'])}）")
+        else:
+            name = cfg["clients"].get((client or "").strip(), cfg["default"])
+        spec = cfg["templates"][name]
+        index = template_index(spec["path"], spec.get("sheet"))  # 範本更新時在這裡重建
+        template_row = int(spec.get("template_row") or index["items"]["template_row"])
+        return {
+            "name": name,
+            "path": spec["path"],
+            "sheet": spec.get("sheet"),
+            "template_row": template_row,
+            "first_insert_row": int(spec.get("first_insert_row") or template_row + 1),
+        }
+
+    def load_all(self) -> Dict[str, Any]:
+        """啟動時把每個範本的索引都建好；個別範本壞掉只記錄錯誤。"""
+        out: Dict[str, Any] = {}
+        for name, spec in self._config_now()["templates"].items():
+            try:
+                index = template_index(spec["path"], spec.get("sheet"))
+                out[name] = {"sheet": index["sheet"], "names": len(index["names"]),
+                             "shapes": len(index["shapes"]), "template_row": index["items"]["template_row"]}
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                out[name] = f"error: {type(e).__name__}: {e}"
+                log_event("template_unavailable", level="warn", template=name, error=str(e))
+        return out
+
+    def describe(self) -> Dict[str, Any]:
+        cfg = self._config_now()
+        return {"config": self.config_path if self._version is not None else None,
+                "default": cfg["default"], "clients": cfg["clients"],
+                "templates": self.load_all(), "loads": self.loads}
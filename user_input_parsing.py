@@ -1,9 +1,9 @@
 # user_input_parsing.py
-import re
-from typing import Dict, List, Tuple
-
-# 支援全形/半形冒號
-_COLON = r"[:：]"
+# 解析使用者貼在 LINE 的報價文字。單趟串流：逐行處理、不用 regex，鍵以預先建好的索引查表，
+# 每個商品在區塊結束時就轉好型別交出去（iter_user_items），大段貼文 / 批次檔案不必整份展開。
+# 效能見 benchmarks/bench_parse.py。
+import unicodedata
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
 # 中文鍵 ↔ 欄位名稱對應
 HEADER_MAP = {
@@ -15,6 +15,10 @@ HEADER_MAP = {
     "報價時間": "QuoteDate",
     "報價日期": "QuoteDate",
     "日期": "QuoteDate",
+    # 選用範本（見 template_registry.py），不寫進報價單
+    "範本": "Template",
+    "模板": "Template",
+    "template": "Template",
 }
 
 ITEM_MAP = {
@@ -34,74 +38,104 @@ ITEM_MAP = {
     "成交價": "ProvidePrice",
 }
 
+# 全形數字 / 標點 -> 半形（只用在數量、價格的數值轉換）
+_NUM_TRANS = str.maketrans("０１２３４５６７８９，．－＋", "0123456789,.-+")
+# 分隔線：三個以上的半形 / 全形橫線
+_DASHES = frozenset("-－—–─━")
+
 def _norm_key(k: str) -> str:
     return k.strip().lower()
 
-def parse_user_text(text: str) -> Tuple[Dict[str, str], List[Dict[str, str]]]:
-    """
-    解析使用者貼在 LINE 的文字：
-    - 頭部欄位：客戶名稱/報價時間 ...
-    - 多個商品區塊以 '----' 或空白行分隔
-    回傳： (sets_dict, items_list)
-    """
-    # 先切成行，清掉 BOM 與多餘空白
-    lines = [re.sub(r"\ufeff", "", l).strip() for l in text.splitlines()]
-    blocks: List[List[str]] = []
-    buf: List[str] = []
-    for ln in lines:
-        if not ln or re.fullmatch(r"-{3,}", ln):
-            if buf:
-                blocks.append(buf); buf = []
-            continue
-        buf.append(ln)
-    if buf: blocks.append(buf)
-
-    sets: Dict[str, str] = {}
-    items: List[Dict[str, str]] = []
-
-    # 第一個區塊可能同時含 header 與第一個 item
-    current_item: Dict[str, str] = {}
+def _build_key_index() -> Dict[str, Tuple[bool, str]]:
+    """鍵 -> (是否為 header, 欄位名稱)；同時收錄全形英數的寫法（例如 ｑｔｙ）。"""
+    index: Dict[str, Tuple[bool, str]] = {}
+    for is_header, table in ((False, ITEM_MAP), (True, HEADER_MAP)):
+        for k, field in table.items():
+            for variant in (_norm_key(k), unicodedata.normalize("NFKC", k).strip().lower()):
+                index[variant] = (is_header, field)
+    return index
 
-    def flush_item():
-        nonlocal current_item
-        if any(v for v in current_item.values()):
-            items.append(current_item)
-        current_item = {}
+_KEY_INDEX = _build_key_index()
 
-    for blk in blocks:
-        for ln in blk:
-            m = re.split(_COLON, ln, maxsplit=1)
-            if len(m) != 2:
-                continue
-            k_raw, v_raw = m[0].strip(), m[1].strip()
-            k = _norm_key(k_raw)
+def _lookup_slow(k: str) -> Tuple[bool, str] | None:
+    # 直接查不到時才做 NFKC（全形英數的鍵）
+    return None if k.isascii() else _KEY_INDEX.get(unicodedata.normalize("NFKC", k))
 
-            # 先試 header
-            key = HEADER_MAP.get(k)
-            if key:
-                sets[key] = v_raw
-                continue
+def _to_number(v: str, conv):
+    if not v.isascii():
+        v = v.translate(_NUM_TRANS)
+    try:
+        return conv(v.replace(",", ""))
+    except ValueError:
+        return v
 
-            # 再試 item
-            key = ITEM_MAP.get(k)
-            if key:
-                # 如果看到「產品」且當前已有產品，視為新商品開始
-                if key == "Product" and current_item.get("Product"):
-                    flush_item()
-                current_item[key] = v_raw
-                continue
+def _finish_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    # 型別微調（跟原本一樣：轉不過去就保留原字串）
+    if "Count" in item:
+        n = _to_number(item["Count"], float)
+        item["Count"] = int(n) if isinstance(n, float) and n == n and abs(n) != float("inf") else item["Count"]
+    for price_key in ("Price", "ProvidePrice"):
+        if price_key in item:
+            item[price_key] = _to_number(item[price_key], float)
+    return item
 
-        # 一個區塊結束就 flush 一次
-        flush_item()
+def _is_separator(ln: str) -> bool:
+    return len(ln) >= 3 and ln[0] in _DASHES and all(c in _DASHES for c in ln)
 
-    # 型別微調
-    for it in items:
-        if "Count" in it:
-            try: it["Count"] = int(float(str(it["Count"]).replace(",", "")))
-            except: pass
-        for price_key in ("Price", "ProvidePrice"):
-            if price_key in it:
-                try: it[price_key] = float(str(it[price_key]).replace(",", ""))
-                except: pass
+def iter_user_items(lines: Iterable[str] | str, sets: Dict[str, str] | None = None) -> Iterator[Dict[str, Any]]:
+    """
+    單趟串流解析：逐行讀入，每完成一個商品就 yield 出來；header 欄位寫進 sets（呼叫端傳入的 dict）。
+    lines 可以是整段文字或任何逐行的 iterable（例如開著的檔案），不必先整份讀進記憶體。
+    """
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    if sets is None:
+        sets = {}
+    item: Dict[str, Any] = {}
+    for raw in lines:
+        if "\ufeff" in raw:
+            raw = raw.replace("\ufeff", "")
+        ln = raw.strip()
+        # 空白行 / 分隔線：一個區塊結束就 flush 一次
+        if not ln or (ln[0] in _DASHES and _is_separator(ln)):
+            if item:
+                if any(item.values()):
+                    yield _finish_item(item)
+                item = {}
+            continue
+        # 冒號（半形或全形）取第一個出現的
+        i = ln.find(":")
+        j = ln.find("：")
+        if i < 0 or (0 <= j < i):
+            i = j
+        if i < 0:
+            continue
+        k = ln[:i].strip().lower()
+        hit = _KEY_INDEX.get(k) or _lookup_slow(k)
+        if hit is None:
+            continue
+        is_header, key = hit
+        value = ln[i + 1:].strip()
+        if is_header:
+            sets[key] = value
+            continue
+        # 如果看到「產品」且當前已有產品，視為新商品開始
+        if key == "Product" and item.get("Product"):
+            if any(item.values()):
+                yield _finish_item(item)
+            item = {}
+        item[key] = value
+    if item and any(item.values()):
+        yield _finish_item(item)
 
+def parse_user_text(text: str) -> Tuple[Dict[str, str], List[Dict[str, str]]]:
+    """
+    解析使用者貼在 LINE 的文字：
+    - 頭部欄位：客戶名稱/報價時間 ...
+    - 多個商品區塊以 '----'（半形或全形橫線）或空白行分隔
+    - 數量 / 價格可用全形數字與全形逗號
+    回傳： (sets_dict, items_list)
+    """
+    sets: Dict[str, str] = {}
+    items = list(iter_user_items(text, sets))
     return sets, items
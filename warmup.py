@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# warmup.py
+# 啟動暖機：app 先綁好 port（重的模組都延後載入），背景再把第一筆報價會碰到的冷啟動成本先付掉：
+#   1) 載入 Aspose（.NET runtime）/ PyMuPDF
+#   2) 範本 bytes、版面索引與版面（template_cache / template_registry / quote_layout）
+#   3) Aspose 字型資料夾掃描（只有 aspose / libreoffice 引擎需要）
+#   4) soffice 常駐轉檔池（libreoffice 引擎且 SOFFICE_POOL_SIZE>0）
+#   5) 產一張假的報價單（暫存目錄，產完即刪）
+# 每個工作 worker 各暖一次（process 模式下每個子程序都要自己載入），暖完 /readyz 才回 200，
+# 負載平衡器不會把第一個真實使用者導到冷的執行個體。
+# 個別步驟失敗只記錄在狀態裡（服務仍可用，只是第一筆會慢）；超過 WARMUP_TIMEOUT 秒也視為完成。
+#
+# 設定（環境變數）：
+#   WARMUP         : 1（預設）= 啟動時暖機；0 = 不暖機，/readyz 直接回 ready
+#   WARMUP_TIMEOUT : 暖機最長等待秒數（預設 180）
+#
+# 函式入口：
+#   WARMUP.start(job_queue, template_xlsx=..., sheet=..., pdf_engine=..., soffice_path=..., want_xlsx=...)
+#   WARMUP.ready -> bool；WARMUP.status() -> dict
+#   warm_worker(...) -> {步驟: 毫秒 或 錯誤訊息}   # 在 worker 裡執行（module 層級，process pool 可 pickle）
+
+import os, tempfile, threading, time
+from concurrent.futures import wait
+from typing import Any, Dict
+
+from metrics import Gauge, log_event
+
+WARMUP_ENABLED = os.getenv("WARMUP", "1") != "0"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "180"))
+
+def warm_worker(template_xlsx: str, sheet: str | None, pdf_engine: str, soffice_path: str | None,
+                want_xlsx: bool = True) -> Dict[str, Any]:
+    """在目前的 worker（thread 或子程序）裡把冷啟動成本付掉，回傳各步驟耗時（ms）或錯誤。"""
+    engine = pdf_engine.lower()
+    steps: Dict[str, Any] = {}
+
+    def step(name: str, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+            steps[name] = round((time.perf_counter() - t0) * 1000, 1)
+        except Exception as e:
+            steps[name] = f"error: {type(e).__name__}: {e}"
+
+    def load_modules():
+        import make_quote_linux  # noqa: F401  Aspose / PyMuPDF 都在這裡載入
+
+    def load_template():
+        from quote_layout import load_layout
+        from template_cache import TEMPLATE_CACHE
+        from template_registry import template_index
+
+        TEMPLATE_CACHE.get_bytes(template_xlsx)
+        template_index(template_xlsx, sheet)
+        load_layout(template_xlsx, sheet)
+
+    def load_fonts():
+        from make_quote_linux import setup_fonts_for_pdf
+
+        setup_fonts_for_pdf()
+
+    def start_soffice():
+        from soffice_pool import get_pool
+        from soffice_scheduler import find_soffice
+
+        get_pool(find_soffice(soffice_path))
+
+    def dummy_quote():
+        from quote_jobs import run_quote_job
+
+        with tempfile.TemporaryDirectory(prefix="warmup_") as td:
+            run_quote_job(
+                template_xlsx=template_xlsx, base_path=os.path.join(td, "warmup"), sheet=sheet,
+                sets={"ClientName": "warmup"},
+                items=[{"Product": "warmup", "Desc": "", "Count": 1, "Price": 1.0, "ProvidePrice": 1.0}],
+                pdf_engine=engine, soffice_path=soffice_path,
+                want_xlsx=want_xlsx or engine not in ("native", "overlay"), request_id="warmup",
+            )
+
+    step("modules", load_modules)
+    step("template", load_template)
+    if engine in ("aspose", "libreoffice"):
+        step("fonts", load_fonts)
+    if engine == "libreoffice":
+        step("soffice", start_soffice)
+    step("dummy_quote", dummy_quote)
+    steps["pid"] = os.getpid()
+    return steps
+
+class WarmUp:
+    def __init__(self, enabled: bool = WARMUP_ENABLED, timeout: float = WARMUP_TIMEOUT):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.state = "pending" if enabled else "ready"   # pending / running / ready
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.workers: list = []   # 每個 worker 的 warm_worker 結果
+        self.errors: list = []
+        self._thread: threading.Thread | None = None
+        Gauge("quote_ready", "1 once start-up warm-up has finished", lambda: 1 if self.ready else 0)
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def start(self, job_queue, **kwargs):
+        """在背景執行緒暖機，立即返回（不擋 uvicorn 啟動）。"""
+        if not self.enabled or self._thread is not None:
+            return
+        self.state, self.started = "running", time.time()
+        self._thread = threading.Thread(target=self._run, args=(job_queue, kwargs), name="warmup", daemon=True)
+        self._thread.start()
+
+    def _run(self, job_queue, kwargs):
+        try:
+            futs = job_queue.warm(warm_worker, **kwargs)
+            done, not_done = wait(futs, timeout=self.timeout)
+            for f in done:
+                if f.exception() is not None:
+                    self.errors.append(f"{type(f.exception()).__name__}: {f.exception()}")
+                else:
+                    self.workers.append(f.result())
+                    self.errors += [f"{k}: {v}" for k, v in f.result().items() if isinstance(v, str)]
+            if not_done:
+                self.errors.append(f"{len(not_done)} 個 worker 在 {self.timeout:.0f}s 內沒有暖完")
+        except Exception as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            self.finished = time.time()
+            self.state = "ready"
+        log_event("warmup", level="warn" if self.errors else "info",
+                  ms=round((self.finished - self.started) * 1000, 1),
+                  workers=self.workers, errors=self.errors)
+
+    def status(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"ready": self.ready, "state": self.state, "errors": list(self.errors)}
+        if self.started is not None:
+            out["elapsed_ms"] = round(((self.finished or time.time()) - self.started) * 1000, 1)
+        if self.workers:
+            out["workers"] = list(self.workers)
+        return out
+
+WARMUP = WarmUp()